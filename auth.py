@@ -0,0 +1,130 @@
+"""Pre-shared key authentication, done before a host reads any file bytes.
+
+When a key is set, senders open every connection (after TLS, if that is
+on) with:
+
+    client -> host   AUTH_MAGIC, 16 byte client nonce
+    host -> client   AUTH_MAGIC, 16 byte host nonce
+    client -> host   HMAC-SHA256(key, "client" + host nonce + client nonce)
+    host -> client   HMAC-SHA256(key, "server" + client nonce + host nonce)
+
+after which the connection carries on exactly as it would have without
+authentication.  Both sides prove they know the key without sending it,
+and the nonces stop a recorded exchange being replayed.  A host with a
+key hangs up on anyone who doesn't complete the handshake; a host
+without one hangs up on senders that try it, so the key has to be set
+on both ends.
+
+Must stay Python 2.7 compatible.
+"""
+import hashlib
+import hmac
+import os
+import socket
+import threading
+
+AUTH_MAGIC = b'FTAUTH01'
+NONCE_SIZE = 16
+MAC_SIZE = 32
+AUTH_TIMEOUT = 10  # Seconds a client gets to finish the handshake
+
+
+class AuthError(Exception):
+    """The other side didn't prove it knows the key"""
+
+
+class _Settings(object):
+    def __init__(self):
+        self.key = None
+
+
+settings = _Settings()
+_lock = threading.Lock()
+
+
+def configure(key):
+    """Set the shared key (text); an empty key switches authentication off"""
+    with _lock:
+        settings.key = key.encode('utf-8') if key else None
+
+
+def enabled():
+    return settings.key is not None
+
+
+def _mac(key, label, first, second):
+    return hmac.new(key, label + first + second, hashlib.sha256).digest()
+
+
+def _read(sock, size):
+    data = b''
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise AuthError("Connection closed during authentication")
+        data += chunk
+    return data
+
+
+def client_handshake(sock):
+    """Authenticate a new outgoing connection, if a key is set"""
+    key = settings.key
+    if key is None:
+        return
+    client_nonce = os.urandom(NONCE_SIZE)
+    sock.sendall(AUTH_MAGIC + client_nonce)
+    try:
+        reply = _read(sock, len(AUTH_MAGIC) + NONCE_SIZE)
+    except AuthError:
+        raise AuthError("Receiver hung up on authentication (no key set there?)")
+    if reply[:len(AUTH_MAGIC)] != AUTH_MAGIC:
+        raise AuthError("Receiver doesn't support authentication")
+    server_nonce = reply[len(AUTH_MAGIC):]
+    sock.sendall(_mac(key, b'client', server_nonce, client_nonce))
+    try:
+        proof = _read(sock, MAC_SIZE)
+    except AuthError:
+        raise AuthError("Receiver rejected our key")
+    if not hmac.compare_digest(proof, _mac(key, b'server', client_nonce, server_nonce)):
+        raise AuthError("Receiver doesn't know the key")
+
+
+def server_handshake(sock, first):
+    """Authenticate a client whose first 8 bytes were first.
+
+    Returns True if a handshake took place, in which case the caller reads
+    the real start of the stream next, and False if there is no key and the
+    client didn't try.  Raises AuthError if the client must be turned away.
+    """
+    key = settings.key
+    if key is None:
+        if first == AUTH_MAGIC:
+            raise AuthError("client tried to authenticate, but no key is set here")
+        return False
+    if first != AUTH_MAGIC:
+        raise AuthError("client didn't authenticate")
+    timeout = sock.gettimeout()
+    sock.settimeout(AUTH_TIMEOUT)
+    try:
+        client_nonce = _read(sock, NONCE_SIZE)
+        server_nonce = os.urandom(NONCE_SIZE)
+        sock.sendall(AUTH_MAGIC + server_nonce)
+        sock.sendall(server_proof(client_nonce, server_nonce, _read(sock, MAC_SIZE)))
+    except socket.timeout:
+        raise AuthError("client took too long to authenticate")
+    finally:
+        sock.settimeout(timeout)
+    return True
+
+
+def server_proof(client_nonce, server_nonce, mac):
+    """Check the client's MAC and return the host's reply to it.
+
+    The last step of server_handshake(), for hosts that can't block on
+    the socket.  Raises AuthError if the client used the wrong key.
+    """
+    key = settings.key
+    if key is None or not hmac.compare_digest(
+            mac, _mac(key, b'client', server_nonce, client_nonce)):
+        raise AuthError("client used the wrong key")
+    return _mac(key, b'server', client_nonce, server_nonce)
@@ -0,0 +1,108 @@
+"""Time print rendering cold and from the cache.
+
+Usage: python benchmarks/bench_print.py [--files 8] [--pages 50] [--workers 1 2 4] [--format postscript]
+
+Makes --files different text documents of --pages pages (and, if
+Ghostscript is installed, a PDF of each), then submits them all to a
+PrintPipeline with each --workers count and waits until every job is
+ready for the printer.  Then the same files are submitted again, which
+should be answered from the cache without rendering.  Nothing is sent
+to a printer: the spool step only reads the rendered file.
+"""
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import printing  # noqa: E402
+
+
+def make_documents(workdir, files, pages):
+    words = "the quick brown fox jumps over the lazy dog ( ) \\ 0123456789".split()
+    paths = []
+    for number in range(files):
+        path = os.path.join(workdir, 'doc%d.txt' % number)
+        with open(path, 'w') as f:
+            for line in range(pages * 60):
+                f.write("%d.%d %s\n" % (number, line, " ".join(
+                    words[(line + i) % len(words)] for i in range(12))))
+        paths.append(path)
+    gs = printing.find_ghostscript()
+    if gs:
+        for path in list(paths):
+            pdf = path[:-4] + '.pdf'
+            printing.TextToPostScript().convert(path, path[:-4] + '.ps')
+            printing.run([gs, '-q', '-dSAFER', '-dBATCH', '-dNOPAUSE', '-sDEVICE=pdfwrite',
+                          '-sOutputFile=' + pdf, path[:-4] + '.ps'])
+            os.remove(path[:-4] + '.ps')
+            paths.append(pdf)
+    return paths
+
+
+def print_all(pipeline, paths):
+    """Seconds until every job reached the (pretend) printer, and the notes"""
+    finished = threading.Event()
+    notes = []
+
+    def done(ok, message):
+        notes.append(message if ok else "FAILED " + message)
+        if len(notes) == len(paths):
+            finished.set()
+
+    started = time.time()
+    for path in paths:
+        pipeline.submit(path, None, done)
+    if not finished.wait(600):
+        raise RuntimeError("Jobs didn't finish")
+    return time.time() - started, notes
+
+
+def read_only(path, printer, title):
+    with open(path, 'rb') as f:
+        while f.read(printing.SPOOL_CHUNK):
+            pass
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--files', type=int, default=8, help="Different documents")
+    parser.add_argument('--pages', type=int, default=50, help="Pages per document")
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4],
+                        help="Worker process counts to try")
+    parser.add_argument('--format', default='postscript',
+                        choices=[name for name in printing.FORMAT_NAMES if name != printing.VIEWER])
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='ft_bench_')
+    try:
+        paths = make_documents(workdir, args.files, args.pages)
+        print("%d documents (%s), Ghostscript: %s" % (
+            len(paths), ", ".join(sorted(set(os.path.splitext(p)[1] for p in paths))),
+            printing.find_ghostscript() or "not found, text only"))
+        print("%-8s %12s %12s %10s" % ("workers", "cold s", "cached s", "speedup"))
+        for workers in args.workers:
+            base = os.path.join(workdir, 'w%d' % workers)
+            os.mkdir(base)
+            pipeline = printing.PrintPipeline(base, args.format, workers=workers,
+                                              spool=read_only, viewer=None)
+            try:
+                cold, notes = print_all(pipeline, paths)
+                if any("rendered" not in note for note in notes):
+                    raise RuntimeError("Not rendered: %s" % [n for n in notes if "rendered" not in n])
+                cached, notes = print_all(pipeline, paths)
+                if any("cached" not in note for note in notes):
+                    raise RuntimeError("Not cached: %s" % [n for n in notes if "cached" not in n])
+            finally:
+                pipeline.close()
+            print("%-8d %12.3f %12.3f %9.0fx" % (workers, cold, cached, cold / cached))
+    finally:
+        shutil.rmtree(workdir)
+
+
+if __name__ == '__main__':
+    main()
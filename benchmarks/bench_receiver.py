@@ -0,0 +1,179 @@
+"""Compare the thread-per-connection receiver with the single-threaded one.
+
+Usage: python benchmarks/bench_receiver.py [--senders 1 8 32] [--size 16] [--connections 450]
+
+Each receiver runs in its own process on 127.0.0.1.  Throughput is the
+aggregate rate of --senders sessions each sending one --size MB file at
+the same time.  Then --connections sessions are opened and left idle, as
+slow senders would, and the receiver's memory and thread count are read
+(from /proc, so those columns are only filled in on Linux).  The
+threaded receiver's threads use the platform's default stack size.  Both
+hash what they receive, as the real receivers do for the catalog.
+"""
+import argparse
+import hashlib
+import multiprocessing
+import os
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import fastio  # noqa: E402
+import multiplex  # noqa: E402
+import protocol  # noqa: E402
+import session  # noqa: E402
+
+
+def threaded(workdir, ports):
+    """A session-only version of the usual accept loop: one thread per connection"""
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.bind(('127.0.0.1', 0))
+    server.listen(socket.SOMAXCONN)
+    ports.put(server.getsockname()[1])
+
+    def handle(sock):
+        try:
+            if protocol.recv_exact(sock, len(session.SESSION_MAGIC)) == session.SESSION_MAGIC:
+                # Hashed like simpleXP's receiver does for the catalog
+                session.serve_session(sock, lambda name, size: fastio.receive_file(
+                    sock, os.path.join(workdir, name), size, digest=hashlib.sha256()))
+        except Exception:
+            pass
+        finally:
+            sock.close()
+
+    while True:
+        sock, _ = server.accept()
+        sock.settimeout(protocol.CONNECT_TIMEOUT)
+        worker = threading.Thread(target=handle, args=(sock,))
+        worker.daemon = True
+        worker.start()
+
+
+def single(workdir, ports):
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.bind(('127.0.0.1', 0))
+    server.listen(socket.SOMAXCONN)
+    ports.put(server.getsockname()[1])
+    multiplex.Receiver(server, lambda name, client: os.path.join(workdir, name),
+                       max_connections=100000).serve()
+
+
+def start(target, workdir):
+    ports = multiprocessing.Queue()
+    process = multiprocessing.Process(target=target, args=(workdir, ports))
+    process.daemon = True
+    process.start()
+    return process, ports.get(timeout=30)
+
+
+def usage(pid):
+    """(resident MB, threads) of a process, or (None, None) without /proc"""
+    try:
+        with open('/proc/%d/status' % pid) as f:
+            fields = dict(line.split(':', 1) for line in f if ':' in line)
+    except IOError:
+        return None, None
+    return int(fields['VmRSS'].split()[0]) / 1024.0, int(fields['Threads'])
+
+
+def send(port, path, name, results):
+    try:
+        sock = session.open_session('127.0.0.1', port)
+        try:
+            size = os.path.getsize(path)
+            sock.sendall(protocol.encode_header(name, size))
+            fastio.send_body(sock, path, size)
+            results.append(protocol.decode_ack(protocol.recv_exact(sock, protocol.ACK_SIZE))[1])
+            sock.sendall(session.END_OF_SESSION)
+        finally:
+            sock.close()
+    except Exception as e:
+        results.append(str(e))
+
+
+def throughput(port, path, senders):
+    results = []
+    workers = [threading.Thread(target=send, args=(port, path, 'f%d.bin' % i, results))
+               for i in range(senders)]
+    start_time = time.time()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    elapsed = time.time() - start_time
+    if results.count(protocol.OK) != senders:
+        raise RuntimeError("Transfers failed: %r" % [r for r in results if r != protocol.OK][:3])
+    return senders * os.path.getsize(path) / (1024.0 * 1024) / elapsed
+
+
+def hold(port, pid, connections):
+    """Open idle sessions; returns (held, resident MB, threads)"""
+    socks = []
+    try:
+        for _ in range(connections):
+            try:
+                socks.append(session.open_session('127.0.0.1', port))
+            except (socket.error, protocol.ProtocolError, session.SessionUnsupported):
+                break
+        time.sleep(0.5)  # Let the receiver settle
+        rss, threads = usage(pid)
+        return len(socks), rss, threads
+    finally:
+        for sock in socks:
+            sock.close()
+
+
+def raise_file_limit(wanted):
+    try:
+        import resource
+    except ImportError:
+        return  # Windows
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft != resource.RLIM_INFINITY and soft < wanted:
+        limit = wanted if hard == resource.RLIM_INFINITY else min(wanted, hard)
+        resource.setrlimit(resource.RLIMIT_NOFILE, (limit, hard))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--senders', type=int, nargs='+', default=[1, 8, 32],
+                        help="Concurrent senders for the throughput runs")
+    parser.add_argument('--size', type=float, default=16, help="File size per sender in MB")
+    parser.add_argument('--connections', type=int, default=450,
+                        help="Idle connections to hold open")
+    args = parser.parse_args()
+    raise_file_limit(2 * args.connections + 256)
+
+    workdir = tempfile.mkdtemp(prefix='ft_bench_')
+    try:
+        path = os.path.join(workdir, 'source.bin')
+        with open(path, 'wb') as f:
+            f.write(os.urandom(int(args.size * 1024 * 1024)))
+
+        print("%-10s %s %10s %10s %10s" % (
+            "receiver", " ".join("%9s" % ("MB/s x%d" % n) for n in args.senders),
+            "held", "RSS MB", "threads"))
+        for name, target in (("threaded", threaded), ("single", single)):
+            target_dir = os.path.join(workdir, name)
+            os.mkdir(target_dir)
+            process, port = start(target, target_dir)
+            try:
+                rates = [throughput(port, path, n) for n in args.senders]
+                held, rss, threads = hold(port, process.pid, args.connections)
+            finally:
+                process.terminate()
+            print("%-10s %s %10d %10s %10s" % (
+                name, " ".join("%9.1f" % rate for rate in rates), held,
+                "-" if rss is None else "%.1f" % rss, "-" if threads is None else threads))
+    finally:
+        shutil.rmtree(workdir)
+
+
+if __name__ == '__main__':
+    main()
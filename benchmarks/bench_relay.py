@@ -0,0 +1,150 @@
+"""Time files crossing chains of relays on loopback.
+
+Usage: python benchmarks/bench_relay.py [--size 64] [--small 4] [--repeat 20] [--no-spill]
+
+Runs a direct transfer and chains of two and three hops (one and two
+relays in between, see relay.py), each host in its own process on
+127.0.0.1.  Latency is the
+median time from starting to send a --small KB file until its
+acknowledgement arrives from the end of the chain; throughput is for one
+--size MB file.  "store&fwd" is what the large file would take if every
+relay waited for the whole file before passing it on.
+"""
+import argparse
+import multiprocessing
+import os
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import fastio  # noqa: E402
+import protocol  # noqa: E402
+import relay  # noqa: E402
+import session  # noqa: E402
+
+
+def serve(receive, ports):
+    """Serve sessions on a free loopback port with receive(sock), forever"""
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.bind(('127.0.0.1', 0))
+    server.listen(5)
+    ports.put(server.getsockname()[1])
+
+    def handle(sock):
+        try:
+            if protocol.recv_exact(sock, len(session.SESSION_MAGIC)) == session.SESSION_MAGIC:
+                receive(sock)
+        finally:
+            sock.close()
+
+    while True:
+        sock, _ = server.accept()
+        sock.settimeout(protocol.CONNECT_TIMEOUT)
+        worker = threading.Thread(target=handle, args=(sock,))
+        worker.daemon = True
+        worker.start()
+
+
+def receiver(workdir, ports):
+    def receive(sock):
+        session.serve_session(sock, lambda name, size: fastio.receive_file(
+            sock, os.path.join(workdir, name), size))
+    serve(receive, ports)
+
+
+def relay_host(port, spill, ports):
+    forwarding = relay.Relay('127.0.0.1', port, spill)
+
+    def receive(sock):
+        forwarder = forwarding.open()
+        try:
+            session.serve_session(sock, lambda name, size: forwarder.forward(sock, name, size))
+        finally:
+            forwarder.close()
+    serve(receive, ports)
+
+
+def start(target, *args):
+    """Run a host in its own process, so hops don't share one interpreter; returns (process, port)"""
+    ports = multiprocessing.Queue()
+    process = multiprocessing.Process(target=target, args=args + (ports,))
+    process.daemon = True
+    process.start()
+    return process, ports.get(timeout=30)
+
+
+def send(sock, path, name, seq):
+    size = os.path.getsize(path)
+    start = time.time()
+    sock.sendall(protocol.encode_header(name, size))
+    fastio.send_body(sock, path, size)
+    ack = protocol.decode_ack(protocol.recv_exact(sock, protocol.ACK_SIZE))
+    elapsed = time.time() - start
+    if ack[:2] != (seq, protocol.OK):
+        raise RuntimeError("Transfer failed: %r" % (ack,))
+    return elapsed
+
+
+def run_chain(relays, small, large, repeat, spill, workdir):
+    hosts = []
+    try:
+        process, port = start(receiver, workdir)
+        hosts.append(process)
+        for _ in range(relays):
+            process, port = start(relay_host, port, spill)
+            hosts.append(process)
+        sock = session.open_session('127.0.0.1', port)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        try:
+            latencies = [send(sock, small, 'small.bin', seq) for seq in range(1, repeat + 1)]
+            bulk = send(sock, large, 'large.bin', repeat + 1)
+            sock.sendall(session.END_OF_SESSION)
+        finally:
+            sock.close()
+    finally:
+        for process in hosts:
+            process.terminate()
+    latencies.sort()
+    return latencies[len(latencies) // 2], bulk
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--size', type=float, default=64, help="Large file size in MB")
+    parser.add_argument('--small', type=float, default=4, help="Small file size in KB")
+    parser.add_argument('--repeat', type=int, default=20, help="Small files per chain")
+    parser.add_argument('--no-spill', action='store_true', help="Relays don't spill to disk")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='ft_bench_')
+    try:
+        source = os.path.join(workdir, 'source')
+        target = os.path.join(workdir, 'target')
+        os.mkdir(source)
+        os.mkdir(target)
+        small = os.path.join(source, 'small.bin')
+        large = os.path.join(source, 'large.bin')
+        with open(small, 'wb') as f:
+            f.write(os.urandom(int(args.small * 1024)))
+        with open(large, 'wb') as f:
+            f.write(os.urandom(int(args.size * 1024 * 1024)))
+        size_mb = os.path.getsize(large) / (1024.0 * 1024)
+
+        print("%-8s %14s %10s %14s" % ("hops", "latency ms", "MB/s", "store&fwd MB/s"))
+        direct = None
+        for relays in (0, 1, 2):
+            latency, bulk = run_chain(relays, small, large, args.repeat, not args.no_spill, target)
+            direct = direct or bulk
+            print("%-8d %14.2f %10.1f %14.1f" % (relays + 1, latency * 1000, size_mb / bulk,
+                                                 size_mb / (direct * (relays + 1))))
+    finally:
+        shutil.rmtree(workdir)
+
+
+if __name__ == '__main__':
+    main()
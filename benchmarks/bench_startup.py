@@ -0,0 +1,94 @@
+"""Time how long the GUI takes to put its window up and finish loading.
+
+Usage: python benchmarks/bench_startup.py [--repeat 5] [--exe dist/file_transfer.exe]
+
+Each launch reports three moments, counted from when it was started:
+imported (Python and our modules loaded), window (the window is built
+and the event loop is idle) and loaded (printers and network interfaces
+found, which happens in the background).  Cold launches run without the
+startup cache and, when timing the script, without compiled bytecode;
+warm launches reuse both.  The app exits by itself once loaded.  Needs a
+display.
+"""
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+STARTUP_CACHE_FILE = '.startup_cache.json'  # As in file_transfer.py
+STAGES = ['imported', 'window', 'loaded']
+
+
+def launch(command, cwd):
+    fd, report = tempfile.mkstemp(prefix='ft_startup_')
+    os.close(fd)
+    env = dict(os.environ, FT_STARTUP_BENCH=report)
+    try:
+        start = time.time()
+        process = subprocess.Popen(command, cwd=cwd, env=env,
+                                   stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        output = process.communicate()[0]
+        if process.returncode != 0:
+            raise RuntimeError("Launch failed:\n%s" % output.decode('utf-8', 'replace')[-2000:])
+        with open(report) as f:
+            stamps = dict(line.split() for line in f if line.strip())
+        return dict((stage, (float(stamps[stage]) - start) * 1000) for stage in STAGES)
+    finally:
+        os.remove(report)
+
+
+def make_cold(app_dir, script):
+    cache = os.path.join(app_dir, STARTUP_CACHE_FILE)
+    if os.path.exists(cache):
+        os.remove(cache)
+    if script:
+        shutil.rmtree(os.path.join(app_dir, '__pycache__'), ignore_errors=True)
+        for name in os.listdir(app_dir):
+            if name.endswith('.pyc'):
+                os.remove(os.path.join(app_dir, name))
+
+
+def median(values):
+    values = sorted(values)
+    return values[len(values) // 2]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--exe', help="Time a frozen build instead of file_transfer.py")
+    args = parser.parse_args()
+
+    if args.exe:
+        command, app_dir = [os.path.abspath(args.exe)], os.path.dirname(os.path.abspath(args.exe))
+    else:
+        command, app_dir = [sys.executable, os.path.join(BASE_DIR, 'file_transfer.py')], BASE_DIR
+
+    # Put the user's startup cache back afterwards
+    cache = os.path.join(app_dir, STARTUP_CACHE_FILE)
+    saved = None
+    if os.path.exists(cache):
+        with open(cache, 'rb') as f:
+            saved = f.read()
+    try:
+        print("%-6s %12s %12s %12s" % tuple(["launch"] + ["%s ms" % stage for stage in STAGES]))
+        for mode in ('cold', 'warm'):
+            results = []
+            for _ in range(args.repeat):
+                if mode == 'cold':
+                    make_cold(app_dir, not args.exe)
+                results.append(launch(command, app_dir))
+            print("%-6s %12.0f %12.0f %12.0f" % tuple(
+                [mode] + [median([r[stage] for r in results]) for stage in STAGES]))
+    finally:
+        if saved is not None:
+            with open(cache, 'wb') as f:
+                f.write(saved)
+
+
+if __name__ == '__main__':
+    main()
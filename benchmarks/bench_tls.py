@@ -0,0 +1,129 @@
+"""Measure what TLS costs: bulk throughput per cipher and handshake time.
+
+Usage: python benchmarks/bench_tls.py [--size 64] [--files 200] [--repeat 3]
+
+The throughput test sends one --size MB file over loopback in plain TCP
+and with each cipher choice.  The handshake test sends --files small files
+one connection each, with and without session resumption.  Loopback
+hides network latency, so on a real network resumption saves more than
+shown here.
+"""
+import argparse
+import os
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import fastio  # noqa: E402
+import protocol  # noqa: E402
+import secure  # noqa: E402
+
+SMALL_FILE = 4096
+CHOICES = [None, secure.AUTO, secure.AESGCM, secure.CHACHA20]  # None = plain TCP
+
+
+class Receiver(object):
+    """Accepts single-file connections on loopback and throws the bodies away"""
+
+    def __init__(self):
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server.bind(('127.0.0.1', 0))
+        self.server.listen(16)
+        self.port = self.server.getsockname()[1]
+        thread = threading.Thread(target=self.run)
+        thread.daemon = True
+        thread.start()
+
+    def run(self):
+        while True:
+            conn, _ = self.server.accept()
+            try:
+                conn = secure.accept(conn)
+                name_length = int(protocol.recv_exact(conn, protocol.NAME_LENGTH_SIZE))
+                protocol.recv_exact(conn, name_length)
+                size = int(protocol.recv_exact(conn, protocol.FILE_SIZE_SIZE))
+                protocol.drain(conn, size, fastio.MMAP_CHUNK_SIZE)
+            except Exception:
+                pass  # e.g. the connection that only checks the negotiated cipher
+            finally:
+                conn.close()
+
+
+def send(port, path, size):
+    sock = protocol.connect('127.0.0.1', port)
+    try:
+        sock.sendall(protocol.encode_header('bench.bin', size))
+        fastio.send_body(sock, path, size)
+        protocol.wait_for_close(sock)
+    finally:
+        sock.close()
+
+
+def use(choice):
+    secure.configure(enabled=choice is not None, cipher=choice or secure.AUTO)
+    secure.clear_sessions()
+
+
+def label(choice):
+    return choice or 'plain'
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--size', type=float, default=64, help="Bulk file size in MB")
+    parser.add_argument('--files', type=int, default=200, help="Small files for the handshake test")
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='ft_bench_tls_')
+    try:
+        secure.configure(workdir)
+        secure.ensure_certificate()
+        receiver = Receiver()
+        big = os.path.join(workdir, 'big.bin')
+        size = int(args.size * 1024 * 1024)
+        with open(big, 'wb') as f:
+            f.write(os.urandom(size))
+        small = os.path.join(workdir, 'small.bin')
+        with open(small, 'wb') as f:
+            f.write(os.urandom(SMALL_FILE))
+
+        print("Throughput, %gMB file" % args.size)
+        print("%-10s %-30s %10s" % ("cipher", "negotiated", "MB/s"))
+        for choice in CHOICES:
+            use(choice)
+            sock = protocol.connect('127.0.0.1', receiver.port)
+            negotiated = "%s %s" % (sock.version(), sock.cipher()[0]) if choice else "-"
+            sock.close()
+            best = None
+            for _ in range(args.repeat):
+                start = time.time()
+                send(receiver.port, big, size)
+                elapsed = time.time() - start
+                best = elapsed if best is None else min(best, elapsed)
+            print("%-10s %-30s %10.1f" % (label(choice), negotiated, size / best / (1024 * 1024)))
+
+        print("\nHandshakes, %d files of %d bytes, one connection each" % (args.files, SMALL_FILE))
+        print("%-10s %-10s %12s" % ("cipher", "resume", "ms/file"))
+        for choice in CHOICES:
+            for resume in ([False, True] if choice else [False]):
+                use(choice)
+                start = time.time()
+                for _ in range(args.files):
+                    if not resume:
+                        secure.clear_sessions()
+                    send(receiver.port, small, SMALL_FILE)
+                elapsed = time.time() - start
+                print("%-10s %-10s %12.2f" % (label(choice), "yes" if resume else "no",
+                                              elapsed * 1000 / args.files))
+    finally:
+        shutil.rmtree(workdir)
+
+
+if __name__ == '__main__':
+    main()
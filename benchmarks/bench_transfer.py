@@ -0,0 +1,92 @@
+"""Compare the buffered, sendfile and mmap body transfer paths on loopback.
+
+Usage: python benchmarks/bench_transfer.py [--sizes 1,64,256] [--repeat 3]
+
+Sizes are in MB.  Every combination runs over a real TCP connection to a
+receiver thread and reports the best of --repeat runs.
+"""
+import argparse
+import os
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import fastio  # noqa: E402
+
+PAIRS = [
+    (fastio.BUFFERED, fastio.BUFFERED),
+    (fastio.SENDFILE, fastio.BUFFERED),
+    (fastio.MMAP, fastio.MMAP),
+    (None, None),  # Whatever the thresholds pick
+]
+
+
+def available(method):
+    if method == fastio.SENDFILE:
+        return fastio.HAS_SENDFILE
+    if method == fastio.MMAP:
+        return fastio.HAS_MMAP
+    return True
+
+
+def run_once(src, dst, size, send_method, receive_method):
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.bind(('127.0.0.1', 0))
+    server.listen(1)
+    result = {}
+
+    def receive():
+        conn, _ = server.accept()
+        result['status'] = fastio.receive_file(conn, dst, size, method=receive_method)
+        conn.close()
+
+    receiver = threading.Thread(target=receive)
+    receiver.start()
+    sock = socket.create_connection(server.getsockname())
+    start = time.time()
+    fastio.send_body(sock, src, size, method=send_method)
+    receiver.join()
+    elapsed = time.time() - start
+    sock.close()
+    server.close()
+    if result['status'][0] != 'ok':
+        raise RuntimeError("Transfer failed: %r" % (result['status'],))
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', default='1,16,128', help="File sizes in MB")
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='ft_bench_')
+    try:
+        print("%-8s %-14s %-14s %10s" % ("size", "send", "receive", "MB/s"))
+        for size_mb in [float(s) for s in args.sizes.split(',')]:
+            size = int(size_mb * 1024 * 1024)
+            src = os.path.join(workdir, 'src.bin')
+            dst = os.path.join(workdir, 'dst.bin')
+            with open(src, 'wb') as f:
+                f.write(os.urandom(size))
+            for send_method, receive_method in PAIRS:
+                if not (available(send_method) and available(receive_method)):
+                    continue
+                best = min(run_once(src, dst, size, send_method, receive_method)
+                           for _ in range(args.repeat))
+                print("%-8s %-14s %-14s %10.1f" % (
+                    "%gMB" % size_mb,
+                    send_method or "auto:" + fastio.choose_send_method(size),
+                    receive_method or "auto:" + fastio.choose_receive_method(size),
+                    size / best / (1024 * 1024)))
+    finally:
+        shutil.rmtree(workdir)
+
+
+if __name__ == '__main__':
+    main()
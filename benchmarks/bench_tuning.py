@@ -0,0 +1,124 @@
+"""Watch tuning.py settle on settings for a link.
+
+Usage: python benchmarks/bench_tuning.py [--size 16] [--rounds 40] [--chunk 8] [--host ip:port]
+
+Sends --rounds files of --size MB one after another the way
+simpleXP_file_sender.py does (buffered writes, as on Python 2), first
+--baseline of them with tuning off at the fixed --chunk KB, then with
+tuning on, printing the settings and rate of every tuned round.  By
+default the receiver is a plain host in another process on 127.0.0.1;
+--host sends to a running receiver instead, e.g. across a WAN link.
+Nothing is written to this checkout's .link_tuning.json.
+"""
+import argparse
+import multiprocessing
+import os
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import fastio  # noqa: E402
+import protocol  # noqa: E402
+import tuning  # noqa: E402
+
+
+def receiver(workdir, ports):
+    """A host that takes single files like the basic receiver, forever"""
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.bind(('127.0.0.1', 0))
+    server.listen(5)
+    ports.put(server.getsockname()[1])
+
+    def handle(sock):
+        try:
+            name_length = int(protocol.recv_exact(sock, protocol.NAME_LENGTH_SIZE).decode('ascii'))
+            name = protocol.recv_exact(sock, name_length).decode('utf-8')
+            size = int(protocol.recv_exact(sock, protocol.FILE_SIZE_SIZE).decode('ascii'))
+            fastio.receive_file(sock, os.path.join(workdir, name), size, method=fastio.BUFFERED)
+        finally:
+            sock.close()
+
+    while True:
+        sock, _ = server.accept()
+        sock.settimeout(protocol.CONNECT_TIMEOUT)
+        worker = threading.Thread(target=handle, args=(sock,))
+        worker.daemon = True
+        worker.start()
+
+
+def send(host, port, path, chunk):
+    """One file the way send_file does it; returns MB/s"""
+    size = os.path.getsize(path)
+    sock = protocol.connect(host, port)
+    try:
+        start = time.time()
+        sock.sendall(protocol.encode_header('tuning.bin', size))
+        fastio.send_body(sock, path, size, chunk_size=tuning.chunk_size(host, chunk),
+                         method=fastio.BUFFERED)
+        protocol.wait_for_close(sock)
+        elapsed = time.time() - start
+    finally:
+        sock.close()
+    tuning.record(host, size, elapsed)
+    return size / 1048576.0 / elapsed
+
+
+def median(values):
+    values = sorted(values)
+    return values[len(values) // 2]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--size', type=float, default=16, help="File size in MB")
+    parser.add_argument('--rounds', type=int, default=40, help="Files sent with tuning on")
+    parser.add_argument('--baseline', type=int, default=5, help="Files sent with tuning off")
+    parser.add_argument('--chunk', type=int, default=8, help="Starting chunk size in KB")
+    parser.add_argument('--host', help="ip:port of a running receiver")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='ft_bench_')
+    process = None
+    try:
+        if args.host:
+            host, port = protocol.parse_destinations(args.host)[0]
+        else:
+            target = os.path.join(workdir, 'target')
+            os.mkdir(target)
+            ports = multiprocessing.Queue()
+            process = multiprocessing.Process(target=receiver, args=(target, ports))
+            process.daemon = True
+            process.start()
+            host, port = '127.0.0.1', ports.get(timeout=30)
+        path = os.path.join(workdir, 'source.bin')
+        with open(path, 'wb') as f:
+            f.write(os.urandom(int(args.size * 1024 * 1024)))
+        chunk = args.chunk * 1024
+
+        tuning.configure(workdir, enabled=False)
+        fixed = median([send(host, port, path, chunk) for _ in range(args.baseline)])
+        print("fixed %d KB chunks, OS buffers, Nagle on: %.1f MB/s" % (args.chunk, fixed))
+
+        tuning.configure(enabled=True)
+        rates = []
+        for round_number in range(1, args.rounds + 1):
+            settings = tuning.describe(host)
+            rates.append(send(host, port, path, chunk))
+            print("%3d  %7.1f MB/s  %s" % (round_number, rates[-1], settings))
+        last = rates[-max(1, args.rounds // 4):]
+        print("tuned, last %d rounds: %.1f MB/s (%.2fx)" % (len(last), median(last),
+                                                             median(last) / fixed))
+        print(tuning.describe(host))
+    finally:
+        if process is not None:
+            process.terminate()
+        shutil.rmtree(workdir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,420 @@
+"""Simulate a burst of senders against a host and find where it saturates.
+
+Usage:
+    python benchmarks/loadgen.py simplexp [--rates 10 25 50 100 200 400] [--duration 10]
+    python benchmarks/loadgen.py simplexp-single ...   (SINGLE_THREADED_RECEIVER)
+    python benchmarks/loadgen.py gui ...               (needs a display)
+    python benchmarks/loadgen.py 192.168.1.5:25565 [--pid 1234]
+
+Clients speak the basic protocol send_file uses: name length, name,
+size, body, then wait for the host to hang up.  Files arrive at random
+(Poisson) at each --rates files per second for --duration seconds, and
+are sent by a pool of up to --clients simultaneous senders, spread over
+--procs processes so the generator isn't the bottleneck.  --sizes picks
+file sizes: one size (64KB), weighted sizes (4KB:70,1MB:25,20MB:5) or
+lognormal:MEDIAN:SIGMA.  A --slow fraction of clients trickle their file
+at --slow-rate KB/s and a --drop fraction hang up part way through.
+Each rate stops waiting --timeout seconds after its last arrival.
+
+For each rate it reports completed files and MB per second, how long
+connecting took (the host's accept backlog), how long files took from
+arriving to being acknowledged (normal clients only), failures, and the
+host's peak thread count and memory (from /proc, so Linux only).  Named
+hosts are started on 127.0.0.1 from a scratch copy of the scripts, so
+nothing lands in this checkout; --python picks their interpreter, e.g. a
+Python 2.7 to stand in for the XP build.
+"""
+import argparse
+import math
+import multiprocessing
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import filters  # noqa: E402
+import protocol  # noqa: E402
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SIMPLEXP = 'simplexp'
+SIMPLEXP_SINGLE = 'simplexp-single'
+GUI = 'gui'
+
+CHUNK_SIZE = 65536
+SLOW_CHUNK_SIZE = 4096
+MAX_FILE_SIZE = 1024 ** 3
+CLIENT_STACK_SIZE = 256 * 1024  # Thousands of client threads shouldn't need GBs
+PAYLOAD = os.urandom(1024 * 1024)  # File bodies are cut from this
+
+# What happened to a file
+OK = 'ok'
+DROPPED = 'dropped'    # The client hung up on purpose
+REFUSED = 'refused'    # Couldn't connect
+RESET = 'reset'        # The host hung up or reset before acknowledging
+TIMEOUT = 'timeout'
+UNFINISHED = 'unfinished'  # Still sending when the step ended
+
+# How a client behaves
+NORMAL = 'normal'
+SLOW = 'slow'
+DROP = 'drop'
+
+
+def parse_size(text):
+    number = text.strip().rstrip('bBkKmMgG')
+    unit = text.strip()[len(number):].lower()
+    try:
+        return int(float(number) * filters.SIZE_UNITS[unit])
+    except (ValueError, KeyError):
+        raise argparse.ArgumentTypeError("not a size: %r" % text)
+
+
+class Sizes(object):
+    """File sizes to draw from, as given to --sizes"""
+
+    def __init__(self, text):
+        self.text = text
+        self.choices = None
+        if text.startswith('lognormal:'):
+            try:
+                _, median, sigma = text.split(':')
+                self.mu, self.sigma = math.log(parse_size(median)), float(sigma)
+            except ValueError:
+                raise argparse.ArgumentTypeError("expected lognormal:MEDIAN:SIGMA, not %r" % text)
+        else:
+            self.choices = []
+            for part in text.split(','):
+                size, _, weight = part.partition(':')
+                self.choices.append((parse_size(size), float(weight or 1)))
+            self.total = sum(weight for _, weight in self.choices)
+
+    def draw(self, rng):
+        if self.choices is None:
+            return int(min(rng.lognormvariate(self.mu, self.sigma), MAX_FILE_SIZE))
+        pick = rng.random() * self.total
+        for size, weight in self.choices:
+            pick -= weight
+            if pick < 0:
+                return size
+        return self.choices[-1][0]
+
+
+def send_one(host, port, name, size, behaviour, rng, timeout, slow_rate):
+    """Send one file like send_file; returns (seconds to connect or None, status)"""
+    start = time.time()
+    try:
+        sock = socket.create_connection((host, port), timeout)
+    except socket.timeout:
+        return None, TIMEOUT
+    except socket.error:
+        return None, REFUSED
+    connected = time.time() - start
+    try:
+        stop = int(size * rng.random()) if behaviour == DROP else size
+        chunk = SLOW_CHUNK_SIZE if behaviour == SLOW else CHUNK_SIZE
+        view = memoryview(PAYLOAD)
+        sock.sendall(protocol.encode_header(name, size))
+        sent = 0
+        while sent < stop:
+            offset = sent % len(PAYLOAD)
+            n = min(chunk, stop - sent, len(PAYLOAD) - offset)
+            sock.sendall(view[offset:offset + n])
+            sent += n
+            if behaviour == SLOW:
+                time.sleep(n / slow_rate)
+        if behaviour == DROP:
+            protocol.abort(sock)
+            return connected, DROPPED
+        protocol.wait_for_close(sock)
+        return connected, OK
+    except socket.timeout:
+        return connected, TIMEOUT
+    except (socket.error, protocol.ProtocolError):
+        return connected, RESET
+    finally:
+        sock.close()
+
+
+def generate(host, port, rate, duration, clients, sizes, slow, drop, slow_rate, timeout,
+             seed, results):
+    """One generator process: put a list of per-file records on results"""
+    rng = random.Random(seed)
+    arrivals = []
+    at = rng.expovariate(rate)
+    while at < duration:
+        draw = rng.random()
+        behaviour = DROP if draw < drop else SLOW if draw < drop + slow else NORMAL
+        arrivals.append((at, sizes.draw(rng), behaviour))
+        at += rng.expovariate(rate)
+
+    lock = threading.Lock()
+    next_file = [0]
+    records = {}
+    begin = time.time() + 0.5  # Give the client threads time to start
+
+    def client(client_rng):
+        while True:
+            with lock:
+                if next_file[0] >= len(arrivals):
+                    return
+                index = next_file[0]
+                next_file[0] += 1
+            at, size, behaviour = arrivals[index]
+            delay = begin + at - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            connect, status = send_one(host, port, 'load_%d_%d.bin' % (seed, index), size,
+                                       behaviour, client_rng, timeout, slow_rate)
+            # Latency counts from when the file arrived, so a backed up
+            # client pool shows up in it rather than hiding it
+            with lock:
+                records[index] = (at, time.time() - begin - at, connect, status, size, behaviour)
+
+    threading.stack_size(CLIENT_STACK_SIZE)
+    threads = [threading.Thread(target=client, args=(random.Random(rng.random()),))
+               for _ in range(min(clients, len(arrivals)))]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    # A slow client with a big file could take all day; stop waiting
+    # timeout seconds after the last arrival
+    deadline = begin + duration + timeout
+    for thread in threads:
+        thread.join(max(0, deadline - time.time()))
+    with lock:
+        for index, (at, size, behaviour) in enumerate(arrivals):
+            if index not in records:
+                records[index] = (at, None, None, UNFINISHED, size, behaviour)
+        results.put(list(records.values()))
+
+
+def usage(pid):
+    """(resident MB, threads) of a process, or (None, None) without /proc"""
+    try:
+        with open('/proc/%d/status' % pid) as f:
+            fields = dict(line.split(':', 1) for line in f if ':' in line)
+    except IOError:
+        return None, None
+    return int(fields['VmRSS'].split()[0]) / 1024.0, int(fields['Threads'])
+
+
+class Sampler(threading.Thread):
+    """Peak memory and thread count of the host while a step runs"""
+
+    def __init__(self, pid):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.pid = pid
+        self.rss = self.threads = None
+        self.running = True
+
+    def run(self):
+        while self.running and self.pid:
+            rss, threads = usage(self.pid)
+            if rss is None:
+                return
+            self.rss = max(self.rss or 0, rss)
+            self.threads = max(self.threads or 0, threads)
+            time.sleep(0.1)
+
+    def stop(self):
+        self.running = False
+        self.join()
+
+
+def free_port():
+    probe = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    probe.bind(('127.0.0.1', 0))
+    port = probe.getsockname()[1]
+    probe.close()
+    return port
+
+
+def spawn(kind, python, workdir):
+    """Start a host from a scratch copy of the scripts; returns (process, port)"""
+    for name in os.listdir(BASE_DIR):
+        if name.endswith('.py'):
+            shutil.copy(os.path.join(BASE_DIR, name), workdir)
+    port = free_port()
+    env = dict(os.environ)
+    if kind == GUI:
+        command = [python, 'file_transfer.py']
+        env['FT_HOST_BENCH'] = str(port)
+    else:
+        command = [python, '-c', "import simpleXP_file_sender as s; "
+                   "s.SINGLE_THREADED_RECEIVER = %r; s.receive_files('127.0.0.1', %d)" %
+                   (kind == SIMPLEXP_SINGLE, port)]
+    log_path = os.path.join(workdir, 'host.log')
+    with open(log_path, 'wb') as log:
+        process = subprocess.Popen(command, cwd=workdir, env=env, stdout=log,
+                                   stderr=subprocess.STDOUT)
+    deadline = time.time() + 30
+    while True:
+        try:
+            socket.create_connection(('127.0.0.1', port), 1).close()
+            return process, port
+        except socket.error:
+            if process.poll() is not None or time.time() > deadline:
+                process.kill()
+                with open(log_path, 'rb') as log:
+                    raise RuntimeError("Host didn't start:\n%s" %
+                                       log.read().decode('utf-8', 'replace')[-2000:])
+            time.sleep(0.2)
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def run_step(host, port, pid, rate, args):
+    results = multiprocessing.Queue()
+    workers = [multiprocessing.Process(target=generate, args=(
+        host, port, float(rate) / args.procs, args.duration,
+        max(1, args.clients // args.procs), args.sizes, args.slow, args.drop,
+        args.slow_rate * 1024.0, args.timeout, rate * 1000 + i, results))
+        for i in range(args.procs)]
+    sampler = Sampler(pid)
+    sampler.start()
+    for worker in workers:
+        worker.start()
+    records = []
+    for _ in workers:
+        records.extend(results.get())
+    for worker in workers:
+        worker.join()
+    sampler.stop()
+
+    done = [r for r in records if r[3] == OK]
+    normal = [r for r in records if r[5] == NORMAL]
+    elapsed = max([r[0] + r[1] for r in normal if r[1] is not None] + [args.duration])
+    return {
+        # Measured on normal clients, against the files that actually
+        # arrived, since random arrivals stray from the rate asked for
+        'arrived/s': len(normal) / args.duration,
+        'files/s': len([r for r in normal if r[3] == OK]) / elapsed,
+        'MB/s': sum(r[4] for r in done) / 1048576.0 / elapsed,
+        'accept': [r[2] for r in records if r[2] is not None],
+        'refused': len([r for r in records if r[3] == REFUSED]),
+        'latency': [r[1] for r in normal if r[3] == OK],
+        'failed': len([r for r in records if r[3] not in (OK, DROPPED, UNFINISHED) or
+                       (r[3] == UNFINISHED and r[5] == NORMAL)]),
+        'unfinished': len([r for r in records if r[3] == UNFINISHED and r[5] == SLOW]),
+        'expected': len([r for r in records if r[5] != DROP]),
+        'threads': sampler.threads,
+        'rss': sampler.rss,
+    }
+
+
+def ms(seconds):
+    return "-" if seconds is None else "%.0f" % (seconds * 1000)
+
+
+def raise_file_limit(wanted):
+    try:
+        import resource
+    except ImportError:
+        return  # Windows
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft != resource.RLIM_INFINITY and soft < wanted:
+        limit = wanted if hard == resource.RLIM_INFINITY else min(wanted, hard)
+        resource.setrlimit(resource.RLIMIT_NOFILE, (limit, hard))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('target', help="simplexp, simplexp-single, gui or ip:port of a running host")
+    parser.add_argument('--pid', type=int, help="Process to watch when giving ip:port")
+    parser.add_argument('--python', default=sys.executable, help="Interpreter for started hosts")
+    parser.add_argument('--rates', type=float, nargs='+', default=[10, 25, 50, 100, 200, 400],
+                        help="Files per second to try, in turn")
+    parser.add_argument('--duration', type=float, default=10, help="Seconds per rate")
+    parser.add_argument('--clients', type=int, default=500, help="Most senders at once")
+    parser.add_argument('--procs', type=int, default=min(4, multiprocessing.cpu_count()),
+                        help="Generator processes")
+    parser.add_argument('--sizes', type=Sizes, default=Sizes('4KB:60,256KB:30,4MB:10'),
+                        help="File sizes, e.g. 64KB, 4KB:70,1MB:30 or lognormal:200KB:1.5")
+    parser.add_argument('--slow', type=float, default=0, help="Fraction of slow clients")
+    parser.add_argument('--slow-rate', type=float, default=32, help="Slow clients' KB/s")
+    parser.add_argument('--drop', type=float, default=0,
+                        help="Fraction of clients that hang up part way")
+    parser.add_argument('--timeout', type=float, default=30, help="Client socket timeout")
+    args = parser.parse_args()
+    raise_file_limit(2 * args.clients + 1024)  # Started hosts inherit it too
+
+    workdir = tempfile.mkdtemp(prefix='ft_load_')
+    process = None
+    try:
+        if args.target in (SIMPLEXP, SIMPLEXP_SINGLE, GUI):
+            process, port = spawn(args.target, args.python, workdir)
+            host, pid = '127.0.0.1', process.pid
+        else:
+            host, port = protocol.parse_destinations(args.target)[0]
+            pid = args.pid
+
+        print("%s, sizes %s, %d clients, %d%% slow, %d%% dropping" % (
+            args.target, args.sizes.text, args.clients, args.slow * 100, args.drop * 100))
+        print("%8s %8s %8s %9s %9s %9s %9s %7s %8s %7s" % (
+            "offered", "files/s", "MB/s", "conn p50", "conn p99", "done p50", "done p99",
+            "failed", "threads", "RSS MB"))
+        steps = []
+        for rate in args.rates:
+            step = run_step(host, port, pid, rate, args)
+            steps.append((rate, step))
+            print("%8g %8.1f %8.1f %9s %9s %9s %9s %7d %8s %7s" % (
+                rate, step['files/s'], step['MB/s'],
+                ms(percentile(step['accept'], 0.5)), ms(percentile(step['accept'], 0.99)),
+                ms(percentile(step['latency'], 0.5)), ms(percentile(step['latency'], 0.99)),
+                step['failed'], step['threads'] or "-",
+                "-" if step['rss'] is None else "%.0f" % step['rss']))
+            if step['unfinished']:
+                print("%8s (%d slow clients were still sending when it ended)" % (
+                    "", step['unfinished']))
+            sys.stdout.flush()
+        report(steps, args)
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def report(steps, args):
+    """Say where the host stopped keeping up"""
+    base_p99 = percentile(steps[0][1]['latency'], 0.99)
+    best = 0
+    for rate, step in steps:
+        reasons = []
+        if step['files/s'] < 0.9 * step['arrived/s']:
+            reasons.append("completes %.0f of %.0f files/s" % (step['files/s'],
+                                                              step['arrived/s']))
+        if step['failed'] > 0.01 * max(step['expected'], 1):
+            reasons.append("%d of %d files failed" % (step['failed'], step['expected']))
+        accept_p99 = percentile(step['accept'], 0.99)
+        if accept_p99 is None and step['refused']:
+            reasons.append("all %d connections refused" % step['refused'])
+        elif accept_p99 is not None and accept_p99 > 1:
+            reasons.append("connecting takes over a second (accept backlog full)")
+        p99 = percentile(step['latency'], 0.99)
+        if base_p99 and p99 and p99 > 10 * max(base_p99, 0.01):
+            reasons.append("p99 latency %.0fx the lightest load" % (p99 / base_p99))
+        if best and step['MB/s'] < 0.8 * best:
+            reasons.append("throughput collapsed to %.1f MB/s from %.1f" % (step['MB/s'], best))
+        best = max(best, step['MB/s'])
+        if reasons:
+            print("Saturated at %g files/s: %s" % (rate, "; ".join(reasons)))
+            return
+    print("Kept up with every rate tried; try higher --rates")
+
+
+if __name__ == '__main__':
+    main()
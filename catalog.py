@@ -0,0 +1,391 @@
+"""Catalog of every file a host has received, kept in SQLite.
+
+One row per received file: who sent it, its name and where it was saved,
+size, SHA-256, when the transfer started and finished, the transfer
+status and whether it was printed.  Rows are only ever added, apart from
+the print status and the time the file was deleted (by a retention
+policy, or by a newer file overwriting it).
+Queries by time, sender, name or hash use indexes, so they stay fast
+with millions of rows.
+
+Command line, run next to the program (or pass --db):
+
+    python catalog.py query --sender 10.0.0.5 --name "*.pdf" --since 2d
+    python catalog.py prune --days 30 --max-gb 50 [--forget]
+    python catalog.py serve --port 8765
+
+serve answers GET /files with the same filters as query-string
+parameters (and /stats), as JSON, on 127.0.0.1 unless --bind says
+otherwise.
+
+Must stay Python 2.7 compatible.
+"""
+import errno
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+import protocol
+
+CATALOG_FILE = '.received_catalog.db'
+QUERY_LIMIT = 100
+PRUNE_BATCH = 500
+RETENTION_INTERVAL = 3600  # Seconds between retention passes on a running host
+HTTP_PORT = 8765
+
+# Print status values
+PRINTED = 'printed'
+PRINT_FAILED = 'failed'
+
+COLUMNS = ('id', 'sender', 'name', 'path', 'size', 'sha256', 'started', 'finished',
+           'duration', 'status', 'printed', 'deleted')
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS received (
+    id INTEGER PRIMARY KEY,
+    sender TEXT,
+    name TEXT NOT NULL,
+    path TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    sha256 TEXT,
+    started REAL NOT NULL,
+    finished REAL NOT NULL,
+    duration REAL NOT NULL,
+    status TEXT NOT NULL,
+    printed TEXT,
+    deleted REAL
+);
+CREATE INDEX IF NOT EXISTS received_finished ON received (finished);
+CREATE INDEX IF NOT EXISTS received_sender ON received (sender, finished);
+CREATE INDEX IF NOT EXISTS received_name ON received (name, finished);
+CREATE INDEX IF NOT EXISTS received_sha256 ON received (sha256);
+CREATE INDEX IF NOT EXISTS received_path ON received (path, finished);
+"""
+
+
+def hash_file(path, chunk_size=1024 * 1024):
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def parse_age(text):
+    """Seconds in "90", "90s", "15m", "12h", "2d" or "3w" """
+    text = text.strip().lower()
+    units = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400, 'w': 604800}
+    if text and text[-1] in units:
+        return float(text[:-1]) * units[text[-1]]
+    return float(text)
+
+
+def parse_time(text):
+    """A timestamp from an age ("2d" = two days ago) or a YYYY-MM-DD[ HH:MM] date"""
+    for layout in ('%Y-%m-%d %H:%M', '%Y-%m-%d'):
+        try:
+            return time.mktime(time.strptime(text.strip(), layout))
+        except ValueError:
+            pass
+    return time.time() - parse_age(text)
+
+
+class Catalog(object):
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.row_factory = sqlite3.Row
+        with self.lock:
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute("PRAGMA synchronous=NORMAL")
+            self.db.executescript(_SCHEMA)
+            self.db.commit()
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+    def record(self, sender, path, size, status, started, finished=None, sha256=None):
+        """Add a received file; returns its id.
+
+        The file is hashed from disk if sha256 isn't given and it arrived whole.
+        """
+        finished = finished or time.time()
+        path = os.path.abspath(path)
+        if sha256 is None and status == protocol.OK and os.path.isfile(path):
+            try:
+                sha256 = hash_file(path)
+            except (IOError, OSError):
+                pass
+        with self.lock:
+            # An earlier file saved under the same path has been overwritten
+            self.db.execute("UPDATE received SET deleted = ? WHERE path = ? AND deleted IS NULL",
+                            (finished, path))
+            cursor = self.db.execute(
+                "INSERT INTO received (sender, name, path, size, sha256, started, finished, "
+                "duration, status) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (sender, os.path.basename(path), path, size, sha256,
+                 started, finished, max(0.0, finished - started), status))
+            self.db.commit()
+            return cursor.lastrowid
+
+    def set_printed(self, path, printed):
+        """Record the print status of the latest file saved at path"""
+        with self.lock:
+            self.db.execute(
+                "UPDATE received SET printed = ? WHERE id = (SELECT id FROM received "
+                "WHERE path = ? ORDER BY finished DESC LIMIT 1)",
+                (printed, os.path.abspath(path)))
+            self.db.commit()
+
+    def query(self, sender=None, name=None, since=None, until=None, sha256=None,
+              status=None, limit=QUERY_LIMIT):
+        """Newest first.  name may be a glob (case-sensitive, like the index)"""
+        where, args = [], []
+        if sender:
+            where.append("sender = ?")
+            args.append(sender)
+        if name:
+            if any(c in name for c in '*?['):
+                where.append("name GLOB ?")
+            else:
+                where.append("name = ?")
+            args.append(name)
+        if since is not None:
+            where.append("finished >= ?")
+            args.append(since)
+        if until is not None:
+            where.append("finished < ?")
+            args.append(until)
+        if sha256:
+            where.append("sha256 = ?")
+            args.append(sha256.lower())
+        if status:
+            where.append("status = ?")
+            args.append(status)
+        sql = "SELECT * FROM received"
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        sql += " ORDER BY finished DESC LIMIT ?"
+        args.append(int(limit))
+        with self.lock:
+            return [dict(zip(COLUMNS, row)) for row in self.db.execute(sql, args)]
+
+    def stats(self):
+        with self.lock:
+            row = self.db.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0), MIN(finished), MAX(finished), "
+                "COALESCE(SUM(deleted IS NULL), 0) FROM received").fetchone()
+        return {'files': row[0], 'bytes': row[1], 'oldest': row[2], 'newest': row[3],
+                'on_disk': row[4]}
+
+    def prune(self, max_age=None, max_bytes=None, forget=False, log=None):
+        """Delete received files older than max_age seconds, then the oldest
+        ones until those left take up at most max_bytes.
+
+        Their rows are kept and marked deleted, or dropped with forget=True.
+        Files that can't be removed keep their rows as they are and are
+        tried again on the next prune.  Returns the number of files deleted.
+        """
+        deleted = 0
+        if max_age:
+            cutoff = time.time() - max_age
+            skipped = 0  # Rows at the front we couldn't delete this time
+            while True:
+                rows = self._oldest_on_disk(PRUNE_BATCH, cutoff, skipped)
+                if not rows:
+                    break
+                count, failed = self._delete(rows, forget, log)
+                deleted += count
+                skipped += len(failed)
+        if max_bytes:
+            with self.lock:
+                total = self.db.execute("SELECT COALESCE(SUM(size), 0) FROM received "
+                                        "WHERE deleted IS NULL").fetchone()[0]
+            skipped = 0
+            while total > max_bytes:
+                rows = self._oldest_on_disk(PRUNE_BATCH, skip=skipped)
+                if not rows:
+                    break
+                batch = []
+                for row in rows:
+                    if total <= max_bytes:
+                        break
+                    batch.append(row)
+                    total -= row[2]
+                count, failed = self._delete(batch, forget, log)
+                deleted += count
+                skipped += len(failed)
+                total += sum(row[2] for row in failed)  # Still taking up room
+        return deleted
+
+    def _oldest_on_disk(self, limit, before=None, skip=0):
+        sql = "SELECT id, path, size FROM received WHERE deleted IS NULL"
+        args = []
+        if before is not None:
+            sql += " AND finished < ?"
+            args.append(before)
+        sql += " ORDER BY finished, id LIMIT ? OFFSET ?"
+        args.extend([limit, skip])
+        with self.lock:
+            return self.db.execute(sql, args).fetchall()
+
+    def _delete(self, rows, forget, log):
+        """Remove the rows' files; returns how many were deleted and the rows
+        whose files couldn't be, which are left untouched"""
+        deleted = 0
+        ids = []
+        failed = []
+        for row in rows:
+            try:
+                os.remove(row[1])
+                deleted += 1
+                if log:
+                    log("Retention: deleted %s" % row[1])
+            except OSError as e:
+                if e.errno != errno.ENOENT:  # Gone already, or moved away by hand, is fine
+                    if log:
+                        log("Retention: couldn't delete %s: %s" % (row[1], e))
+                    failed.append(row)
+                    continue
+            ids.append((row[0],))
+        with self.lock:
+            if forget:
+                self.db.executemany("DELETE FROM received WHERE id = ?", ids)
+            else:
+                now = time.time()
+                self.db.executemany("UPDATE received SET deleted = ? WHERE id = ?",
+                                    [(now, row_id) for row_id, in ids])
+            self.db.commit()
+        return deleted, failed
+
+
+def query_from_params(catalog, params):
+    """Run a query from string parameters, as given on the command line or in a URL"""
+    get = lambda key: params.get(key) or None
+    since, until = get('since'), get('until')
+    return catalog.query(sender=get('sender'), name=get('name'),
+                         since=parse_time(since) if since else None,
+                         until=parse_time(until) if until else None,
+                         sha256=get('sha256'), status=get('status'),
+                         limit=int(get('limit') or QUERY_LIMIT))
+
+
+def serve_http(catalog, port=HTTP_PORT, bind='127.0.0.1'):
+    """Answer catalog queries over HTTP in a background thread; returns the server"""
+    # Only hosts that serve queries pay for importing the HTTP server
+    try:
+        from http.server import BaseHTTPRequestHandler, HTTPServer
+        from socketserver import ThreadingMixIn
+        from urllib.parse import parse_qs, urlparse
+    except ImportError:  # Python 2
+        from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+        from SocketServer import ThreadingMixIn
+        from urlparse import parse_qs, urlparse
+
+    class Server(ThreadingMixIn, HTTPServer):
+        daemon_threads = True
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            url = urlparse(self.path)
+            params = dict((key, values[-1]) for key, values in parse_qs(url.query).items())
+            try:
+                if url.path == '/files':
+                    body, code = query_from_params(catalog, params), 200
+                elif url.path == '/stats':
+                    body, code = catalog.stats(), 200
+                else:
+                    body, code = {'error': 'try /files or /stats'}, 404
+            except ValueError as e:
+                body, code = {'error': str(e)}, 400
+            data = json.dumps(body, indent=1).encode('utf-8')
+            self.send_response(code)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, *args):
+            pass
+
+    server = Server((bind, port), Handler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+def _format_row(row):
+    when = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(row['finished']))
+    flags = row['status'] + (', ' + row['printed'] if row['printed'] else '') + \
+        (', deleted' if row['deleted'] else '')
+    return "%s  %-15s %12d  %6.1fs  %s  (%s)" % (when, row['sender'] or '-', row['size'],
+                                                row['duration'], row['name'], flags)
+
+
+def _print(message):
+    print(message)
+
+
+def main(argv=None):
+    import argparse
+    parser = argparse.ArgumentParser(description="Query and prune the received-file catalog")
+    parser.add_argument('--db', default=os.path.join(
+        os.path.dirname(os.path.abspath(__file__)), CATALOG_FILE))
+    commands = parser.add_subparsers(dest='command')
+
+    query = commands.add_parser('query', help="List received files, newest first")
+    for option in ('sender', 'name', 'since', 'until', 'sha256', 'status'):
+        query.add_argument('--' + option)
+    query.add_argument('--limit', type=int, default=QUERY_LIMIT)
+    query.add_argument('--json', action='store_true')
+
+    prune = commands.add_parser('prune', help="Delete old received files")
+    prune.add_argument('--days', type=float)
+    prune.add_argument('--max-gb', type=float)
+    prune.add_argument('--forget', action='store_true', help="Drop their rows as well")
+
+    serve = commands.add_parser('serve', help="Answer queries over HTTP")
+    serve.add_argument('--port', type=int, default=HTTP_PORT)
+    serve.add_argument('--bind', default='127.0.0.1')
+
+    commands.add_parser('stats', help="Totals")
+    args = parser.parse_args(argv)
+
+    if not os.path.exists(args.db):
+        parser.error("No catalog at %s" % args.db)
+    catalog = Catalog(args.db)
+    if args.command == 'query':
+        rows = query_from_params(catalog, vars(args))
+        if args.json:
+            print(json.dumps(rows, indent=1))
+        else:
+            for row in rows:
+                print(_format_row(row))
+    elif args.command == 'prune':
+        count = catalog.prune(args.days * 86400 if args.days else None,
+                              int(args.max_gb * 1024 ** 3) if args.max_gb else None,
+                              args.forget, log=_print)
+        print("Deleted %d files" % count)
+    elif args.command == 'serve':
+        server = serve_http(catalog, args.port, args.bind)
+        print("Serving %s on http://%s:%d/files" % (args.db, args.bind, args.port))
+        try:
+            while True:
+                time.sleep(3600)
+        except KeyboardInterrupt:
+            server.shutdown()
+    else:
+        print(json.dumps(catalog.stats(), indent=1))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,460 @@
+"""rsync-style delta transfers for files the receiver already has a copy of.
+
+The receiver splits its existing copy into fixed size blocks and sends a
+signature for each one: a rolling weak checksum (Adler-32) and an MD5.
+The sender slides a window over its version of the file looking for
+blocks the receiver already has, and sends back a list of operations:
+"copy blocks i..j from your copy" or "here are some literal bytes".  The
+receiver rebuilds the file under a temporary name from its old copy plus
+the literals, checks the SHA-1 of the result and only then replaces the
+old copy, so a failed delta never damages it.
+
+Wire exchange, after the 8 byte DELTA_MAGIC:
+
+    client -> host   name length, name, size (as in a normal header)
+    host -> client   DELTA_MAGIC, 16 digit length, zlib'd signatures
+    client -> host   operations, ending with OP_END and the file's SHA-1
+    host -> client   one 32 byte acknowledgement (see protocol.encode_ack)
+
+A host that refuses the file outright (quota, disk space) sends a block
+size of 0 and no signatures, followed at once by its acknowledgement.
+
+Receivers without delta support hang up on the magic; they are
+remembered and get whole files from then on.  Must stay Python 2.7
+compatible.
+"""
+import errno
+import hashlib
+import mmap
+import os
+import socket
+import struct
+import sys
+import threading
+import uuid
+import zlib
+
+import diskspace
+import fileutil
+import protocol
+import throttle
+
+DELTA_MAGIC = b'FTDELT01'
+DELTA_THRESHOLD = 1024 * 1024  # Smaller files are cheaper to just send
+PARTIAL_SUFFIX = '.ftdelta_part'
+MIN_BLOCK = 2048
+MAX_BLOCK = 64 * 1024
+LITERAL_CHUNK = 64 * 1024  # Largest literal sent in one operation
+COPY_CHUNK = 1024 * 1024
+
+OP_COPY = b'C'     # then >II: first block, number of blocks
+OP_LITERAL = b'L'  # then >I: length, then the bytes
+OP_END = b'E'      # then the 20 byte SHA-1 of the whole new file
+
+_SIGNATURE = struct.Struct('>I16s')
+_HEADER = struct.Struct('>II')
+_COPY = struct.Struct('>II')
+_LENGTH = struct.Struct('>I')
+
+ADLER_MOD = 65521
+
+PY3 = sys.version_info[0] >= 3
+
+# Receivers that hung up on the delta magic
+_unsupported = set()
+_unsupported_lock = threading.Lock()
+
+
+class DeltaUnsupported(Exception):
+    """The receiver doesn't understand delta transfers"""
+
+
+def block_size_for(size):
+    """About sqrt(size), like rsync, so signatures stay small for big files"""
+    block = int(size ** 0.5) // 1024 * 1024
+    return max(MIN_BLOCK, min(MAX_BLOCK, block))
+
+
+def weak_checksum(data):
+    return zlib.adler32(data) & 0xffffffff
+
+
+def _roll(weak, out_byte, in_byte, length):
+    """Slide an Adler-32 window one byte along"""
+    a = ((weak & 0xffff) - out_byte + in_byte) % ADLER_MOD
+    b = ((weak >> 16) - length * out_byte + a - 1) % ADLER_MOD
+    return (b << 16) | a
+
+
+def signatures(path, block_size=None):
+    """Read a file and return (block size, [(weak, md5 digest), ...])"""
+    if block_size is None:
+        block_size = block_size_for(os.path.getsize(path))
+    sigs = []
+    with open(path, 'rb') as f:
+        while True:
+            block = f.read(block_size)
+            if not block:
+                break
+            sigs.append((weak_checksum(block), hashlib.md5(block).digest()))
+    return block_size, sigs
+
+
+def encode_signatures(block_size, sigs):
+    parts = [_HEADER.pack(block_size, len(sigs))]
+    parts.extend(_SIGNATURE.pack(weak, strong) for weak, strong in sigs)
+    return zlib.compress(b''.join(parts))
+
+
+def decode_signatures(data):
+    data = zlib.decompress(data)
+    block_size, count = _HEADER.unpack_from(data, 0)
+    offset = _HEADER.size
+    sigs = []
+    for _ in range(count):
+        sigs.append(_SIGNATURE.unpack_from(data, offset))
+        offset += _SIGNATURE.size
+    return block_size, sigs
+
+
+def compute_delta(data, block_size, sigs):
+    """Yield ('copy', first, count) and ('literal', bytes) operations that rebuild data.
+
+    data is anything that slices to bytes (bytes or an mmap).  Matching
+    costs a C-speed checksum per block while the files agree; only after
+    a change does the window roll one byte at a time, in Python, until it
+    finds its place again.  If most of the file turns out to be new the
+    rest is sent as literals without searching.
+    """
+    size = len(data)
+    table = {}
+    for index, (weak, strong) in enumerate(sigs):
+        table.setdefault(weak, []).append((strong, index))
+
+    byte_at = (lambda i: data[i]) if PY3 else (lambda i: ord(data[i]))
+    copy_first = copy_count = 0
+    literal_start = 0
+    literal_total = 0
+    pos = 0
+    weak = None
+
+    def flush_literal(end):
+        start = literal_start
+        while start < end:
+            stop = min(end, start + LITERAL_CHUNK)
+            yield ('literal', data[start:stop])
+            start = stop
+
+    while table and pos + block_size <= size:
+        if weak is None:
+            weak = weak_checksum(data[pos:pos + block_size])
+        match = None
+        candidates = table.get(weak)
+        if candidates:
+            strong = hashlib.md5(data[pos:pos + block_size]).digest()
+            for digest, index in candidates:
+                if digest == strong:
+                    match = index
+                    break
+        if match is not None:
+            if literal_start < pos:
+                if copy_count:
+                    yield ('copy', copy_first, copy_count)
+                    copy_count = 0
+                for op in flush_literal(pos):
+                    yield op
+            if copy_count and match == copy_first + copy_count:
+                copy_count += 1
+            else:
+                if copy_count:
+                    yield ('copy', copy_first, copy_count)
+                copy_first, copy_count = match, 1
+            pos += block_size
+            literal_start = pos
+            weak = None
+            continue
+
+        if pos + block_size < size:
+            weak = _roll(weak, byte_at(pos), byte_at(pos + block_size), block_size)
+        pos += 1
+        literal_total += 1
+        if literal_total > 8 * block_size and literal_total * 2 > pos:
+            break  # Mostly new data; searching further isn't worth it
+        if pos - literal_start >= LITERAL_CHUNK:
+            if copy_count:
+                yield ('copy', copy_first, copy_count)
+                copy_count = 0
+            for op in flush_literal(pos):
+                yield op
+            literal_start = pos
+
+    # A short final block can still match the receiver's short final block
+    tail = size - literal_start
+    if sigs and literal_start == pos and 0 < tail < block_size:
+        strong = hashlib.md5(data[literal_start:size]).digest()
+        weak_tail = weak_checksum(data[literal_start:size])
+        for digest, index in table.get(weak_tail, []):
+            if digest == strong and index == len(sigs) - 1:
+                if copy_count and index == copy_first + copy_count:
+                    copy_count += 1
+                else:
+                    if copy_count:
+                        yield ('copy', copy_first, copy_count)
+                    copy_first, copy_count = index, 1
+                literal_start = size
+                break
+    if copy_count:
+        yield ('copy', copy_first, copy_count)
+    for op in flush_literal(size):
+        yield op
+
+
+def is_unsupported(host, port):
+    with _unsupported_lock:
+        return (host, port) in _unsupported
+
+
+def worth_trying(host, port, size):
+    return size >= DELTA_THRESHOLD and not is_unsupported(host, port)
+
+
+def _send_blob(sock, data):
+    sock.sendall(str(len(data)).zfill(protocol.FILE_SIZE_SIZE).encode('ascii') + data)
+
+
+def _recv_blob(sock):
+    size = int(protocol.recv_exact(sock, protocol.FILE_SIZE_SIZE).decode('ascii'))
+    return protocol.recv_exact(sock, size)
+
+
+def _map_file(f, size):
+    if size == 0:
+        return b'', None
+    try:
+        m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (mmap.error, ValueError, OSError):
+        return f.read(), None
+    return m, m
+
+
+def send_delta(host, port, filepath, filename=None, flow=None, log=None,
+               timeout=protocol.CONNECT_TIMEOUT):
+    """Send filepath as a delta against the receiver's copy.
+
+    Returns (status, literal bytes sent, bytes copied on the receiver).
+    Raises DeltaUnsupported for receivers that only take whole files.
+    """
+    if is_unsupported(host, port):
+        raise DeltaUnsupported("%s:%d doesn't support delta transfers" % (host, port))
+    flow = flow or throttle.NULL_FLOW
+    filename = filename or os.path.basename(filepath)
+    size = os.path.getsize(filepath)
+
+    sock = protocol.connect(host, port, timeout)
+    try:
+        sock.sendall(DELTA_MAGIC + protocol.encode_header(filename, size))
+        try:
+            reply = protocol.recv_exact(sock, len(DELTA_MAGIC))
+        except (protocol.ProtocolError, socket.error):
+            # Old receivers hang up (or reset, with the header unread)
+            with _unsupported_lock:
+                _unsupported.add((host, port))
+            raise DeltaUnsupported("%s:%d doesn't support delta transfers" % (host, port))
+        if reply != DELTA_MAGIC:
+            raise protocol.ProtocolError("Unexpected delta reply: %r" % reply)
+        block_size, sigs = decode_signatures(_recv_blob(sock))
+        if block_size == 0:
+            # Refused before we sent anything; the ack is already on its way
+            status = protocol.decode_ack(protocol.recv_exact(sock, protocol.ACK_SIZE))[1]
+            if log:
+                log("Delta %s to %s:%d: receiver reported %s" % (filename, host, port, status))
+            return status, 0, 0
+
+        literal = copied = 0
+        sha1 = hashlib.sha1()
+        with open(filepath, 'rb') as f:
+            data, mapping = _map_file(f, size)
+            try:
+                for op in compute_delta(data, block_size, sigs):
+                    if op[0] == 'copy':
+                        sock.sendall(OP_COPY + _COPY.pack(op[1], op[2]))
+                        copied += op[2] * block_size
+                    else:
+                        chunk = op[1]
+                        sock.sendall(OP_LITERAL + _LENGTH.pack(len(chunk)))
+                        sock.sendall(chunk)
+                        literal += len(chunk)
+                        flow.throttle(len(chunk))
+                for start in range(0, size, COPY_CHUNK):
+                    sha1.update(data[start:start + COPY_CHUNK])
+            finally:
+                if mapping is not None:
+                    mapping.close()
+        sock.sendall(OP_END + sha1.digest())
+
+        _, status, received = protocol.decode_ack(protocol.recv_exact(sock, protocol.ACK_SIZE))
+    finally:
+        sock.close()
+
+    copied = min(copied, size - literal)
+    if log:
+        saved = 100.0 * copied / size if size else 0.0
+        log("Delta %s to %s:%d: %d literal bytes, %d reused (%.1f%% saved), receiver reported %s" %
+            (filename, host, port, literal, copied, saved, status))
+    return status, literal, copied
+
+
+def serve_delta(sock, received_dir, log=None, flow_factory=None, choose_target=None,
+                quota=None, space=None, locate=None):
+    """Host side of a delta transfer; called after DELTA_MAGIC has been read.
+
+    The old copy is at locate(name), by default received_dir/<name>.  Once
+    the rebuilt file checks out it goes to choose_target(name), which
+    defaults to replacing the old copy.  quota is an optional
+    quota.ClientQuota the new file is checked against, and space an
+    optional diskspace.DiskSpace to reserve room for it in.
+    Returns (name, target path, status).
+    """
+    log = log or (lambda message: None)
+    name_length = protocol.decode_name_length(
+        protocol.recv_exact(sock, protocol.NAME_LENGTH_SIZE))
+    name = protocol.recv_exact(sock, name_length).decode('utf-8')
+    size = int(protocol.recv_exact(sock, protocol.FILE_SIZE_SIZE).decode('ascii'))
+
+    block_size, sigs = block_size_for(size), []
+    refused = None
+    refusal = quota.admit(size) if quota else None
+    if refusal:
+        refused = protocol.QUOTA
+    else:
+        reservation = space.reserve(size) if space else None
+        if space and reservation is None:
+            refused, refusal = protocol.NO_SPACE, "no room (%s)" % space.describe()
+            if quota:
+                quota.finish(size, 0)
+    if refused:
+        # Answer straight away instead of reading the operations
+        log("Refused delta for %s: %s" % (name, refusal))
+        sock.sendall(DELTA_MAGIC)
+        _send_blob(sock, encode_signatures(0, []))
+        sock.sendall(protocol.encode_ack(1, refused, 0))
+        return name, None, refused
+
+    basis_path = partial = out = None
+    if protocol.safe_filename(name) is None:
+        log("Rejected delta for unsafe name %r" % name)
+    else:
+        basis_path = locate(name) if locate else os.path.join(received_dir, name)
+        if os.path.isfile(basis_path):
+            block_size, sigs = signatures(basis_path, block_size)
+        log("Delta for %s: %d blocks of our copy to match against" % (name, len(sigs)))
+    sock.sendall(DELTA_MAGIC)
+    _send_blob(sock, encode_signatures(block_size, sigs))
+
+    # With nothing to write to the operations are still read, and dropped
+    if basis_path:
+        # Named per transfer, as two deltas for one name may run at once
+        partial = "%s.%s%s" % (basis_path, uuid.uuid4().hex[:8], PARTIAL_SUFFIX)
+        out = open(partial, 'wb')
+    if reservation and out is not None:
+        def flush():
+            if out is not None:  # Not after a full disk closed it
+                diskspace.flush_to_disk(out)
+        reservation.flush = flush
+    basis = open(basis_path, 'rb') if sigs else None
+    basis_size = os.fstat(basis.fileno()).st_size if basis is not None else 0
+    flow = flow_factory() if flow_factory else throttle.NULL_FLOW
+    sha1 = hashlib.sha1()
+    written = 0
+    try:
+        while True:
+            op = protocol.recv_exact(sock, 1)
+            if op == OP_END:
+                expected = protocol.recv_exact(sock, 20)
+                break
+            if op == OP_COPY:
+                first, count = _COPY.unpack(protocol.recv_exact(sock, _COPY.size))
+                if first + count > len(sigs):
+                    raise protocol.ProtocolError("Copy of blocks %d-%d is out of range" %
+                                                 (first, first + count))
+                # The basis's last block may be short, so measure what's really copied
+                remaining = max(min((first + count) * block_size, basis_size) -
+                                first * block_size, 0)
+                if written + remaining > size:
+                    raise protocol.ProtocolError("Delta writes more than the %d bytes declared" % size)
+                basis.seek(first * block_size)
+                while remaining > 0:
+                    chunk = basis.read(min(COPY_CHUNK, remaining))
+                    if not chunk:
+                        break
+                    remaining -= len(chunk)
+                    sha1.update(chunk)
+                    written += len(chunk)
+                    out = _write(out, chunk, reservation)
+            elif op == OP_LITERAL:
+                length = _LENGTH.unpack(protocol.recv_exact(sock, _LENGTH.size))[0]
+                if written + length > size:
+                    raise protocol.ProtocolError("Delta writes more than the %d bytes declared" % size)
+                while length > 0:
+                    chunk = protocol.recv_exact(sock, min(LITERAL_CHUNK, length))
+                    length -= len(chunk)
+                    flow.throttle(len(chunk))
+                    sha1.update(chunk)
+                    written += len(chunk)
+                    out = _write(out, chunk, reservation)
+            else:
+                raise protocol.ProtocolError("Unknown delta operation %r" % op)
+    except Exception:
+        if out is not None:
+            out.close()
+        if partial and os.path.exists(partial):
+            os.remove(partial)
+        if quota:
+            quota.finish(size, 0)
+        raise
+    finally:
+        if basis is not None:
+            basis.close()
+        flow.close()
+        if reservation:
+            reservation.release()
+
+    target = None
+    if basis_path is None:
+        status = protocol.REJECTED
+    elif out is None:
+        status = protocol.DISK_FULL
+    elif written != size or sha1.digest() != expected:
+        status = protocol.MISMATCH
+    else:
+        status = protocol.OK
+    if out is not None:
+        out.close()
+    if status == protocol.OK:
+        target = choose_target(name) if choose_target else basis_path
+        fileutil.replace_file(partial, target)
+        log("Rebuilt %s from delta (%d bytes)" % (os.path.basename(target), written))
+    else:
+        if partial and os.path.exists(partial):
+            os.remove(partial)
+        log("Delta for %s failed: %s" % (name, status))
+    if quota:
+        quota.finish(size, written if status == protocol.OK else 0)
+    sock.sendall(protocol.encode_ack(1, status, written if status == protocol.OK else 0))
+    return name, target, status
+
+
+def _write(out, chunk, reservation=None):
+    """Write to the partial file; on a full disk stop writing but keep reading"""
+    if out is None:
+        return None
+    try:
+        out.write(chunk)
+        if reservation:
+            reservation.wrote(len(chunk))
+        return out
+    except (IOError, OSError) as e:
+        if e.errno != errno.ENOSPC:
+            raise
+        out.close()
+        return None
@@ -0,0 +1,176 @@
+"""Disk space reservations and write-back throttling for receivers.
+
+A receiver reserves a file's declared size as soon as it has read the
+header.  The reservation only succeeds if the free space, less a safety
+margin and less what other transfers have reserved but not yet written,
+can hold it.  A file that would fit once the other transfers finish (or
+give up) waits for up to QUEUE_TIMEOUT seconds; one that can't fit at all
+is refused straight away, before anything is written.
+
+Writers also report each chunk they write.  Once all transfers together
+have more than DIRTY_LIMIT bytes written but not yet flushed, whoever
+writes next flushes its own file and waits for the disk, so receiving
+can't run far ahead of what the disk keeps up with.
+
+Must stay Python 2.7 compatible.
+"""
+import os
+import shutil
+import threading
+import time
+
+RESERVE_MARGIN = 64 * 1024 * 1024  # Always leave this much free
+QUEUE_TIMEOUT = 20                 # Seconds a file may wait for space (senders time out at 30)
+RECHECK_INTERVAL = 1.0             # Space freed by other programs is noticed this often
+DIRTY_LIMIT = 64 * 1024 * 1024     # Unflushed bytes allowed across all transfers
+
+
+def free_space(path):
+    """Bytes available to us on the volume holding path"""
+    if hasattr(shutil, 'disk_usage'):
+        return shutil.disk_usage(path).free
+    if hasattr(os, 'statvfs'):
+        st = os.statvfs(path)
+        return st.f_bavail * st.f_frsize
+    import ctypes
+    free = ctypes.c_ulonglong(0)
+    ctypes.windll.kernel32.GetDiskFreeSpaceExW(ctypes.c_wchar_p(path), ctypes.byref(free),
+                                               None, None)
+    return free.value
+
+
+def flush_to_disk(f):
+    """Flush a file's data (not necessarily its metadata) to disk"""
+    f.flush()
+    if hasattr(os, 'fdatasync'):
+        os.fdatasync(f.fileno())
+    else:
+        os.fsync(f.fileno())
+
+
+class DiskSpace(object):
+    def __init__(self, path, margin=RESERVE_MARGIN, queue_timeout=QUEUE_TIMEOUT,
+                 dirty_limit=DIRTY_LIMIT):
+        self.path = path
+        self.margin = margin
+        self.queue_timeout = queue_timeout
+        self.dirty_limit = dirty_limit
+        self.cond = threading.Condition()
+        self.reserved = 0  # Reserved but not yet on disk
+        self.dirty = 0     # Written but not yet flushed
+        self.active = 0
+        self.waiting = 0
+        self.refused = 0
+        self.flushes = 0
+
+    def reserve(self, size, wait=None):
+        """Reserve room for a size byte file.
+
+        Returns a Reservation, or None if the file doesn't fit (after waiting
+        up to wait seconds, by default queue_timeout, if it would fit once
+        other transfers are done).
+        """
+        deadline = time.time() + (self.queue_timeout if wait is None else wait)
+        with self.cond:
+            queued = False
+            try:
+                while True:
+                    free = free_space(self.path) - self.margin
+                    if size <= free - self.reserved:
+                        self.reserved += size
+                        self.active += 1
+                        return Reservation(self, size)
+                    remaining = deadline - time.time()
+                    if size > free or remaining <= 0:
+                        self.refused += 1
+                        return None
+                    if not queued:
+                        queued = True
+                        self.waiting += 1
+                    self.cond.wait(min(remaining, RECHECK_INTERVAL))
+            finally:
+                if queued:
+                    self.waiting -= 1
+
+    def stats(self):
+        """Snapshot of the reservation state, for logs and the Host tab"""
+        with self.cond:
+            stats = {'reserved': self.reserved, 'dirty': self.dirty, 'active': self.active,
+                     'waiting': self.waiting, 'refused': self.refused, 'flushes': self.flushes}
+        try:
+            stats['free'] = free_space(self.path)
+        except OSError:
+            stats['free'] = None
+        return stats
+
+    def describe(self):
+        stats = self.stats()
+        mb = 1024.0 * 1024
+        free = "?" if stats['free'] is None else "%.0f MB" % (stats['free'] / mb)
+        return ("%s free, %.0f MB reserved by %d transfers, %d waiting, %d refused, "
+                "%.0f MB unflushed, %d write-back stalls" % (
+                    free, stats['reserved'] / mb, stats['active'], stats['waiting'],
+                    stats['refused'], stats['dirty'] / mb, stats['flushes']))
+
+
+class Reservation(object):
+    """Room reserved for one file; call release() when the transfer ends"""
+
+    def __init__(self, space, size):
+        self.space = space
+        self.size = size
+        self.used = 0      # Bytes of the reservation now taken up on disk
+        self.dirty = 0
+        self.flush = None  # Set by the writer; flushes what it has written
+        self.released = False
+
+    def _use(self, used):
+        used = min(used, self.size)
+        if used > self.used:
+            self.space.reserved -= used - self.used
+            self.used = used
+
+    def grow(self, n):
+        """Reserve n more bytes, for files whose size isn't known up front.
+
+        Doesn't wait: False if they don't fit now.
+        """
+        space = self.space
+        with space.cond:
+            if n > free_space(space.path) - space.margin - space.reserved:
+                space.refused += 1
+                return False
+            space.reserved += n
+            self.size += n
+            return True
+
+    def preallocated(self):
+        """The whole file has been allocated up front"""
+        with self.space.cond:
+            self._use(self.size)
+
+    def wrote(self, n):
+        """Record n written bytes; flushes if write-back has got too far behind"""
+        space = self.space
+        with space.cond:
+            self._use(self.used + n)
+            self.dirty += n
+            space.dirty += n
+            behind = space.dirty > space.dirty_limit and self.flush is not None
+        if behind:
+            self.flush()
+            with space.cond:
+                space.dirty -= self.dirty
+                self.dirty = 0
+                space.flushes += 1
+
+    def release(self):
+        with self.space.cond:
+            if self.released:
+                return
+            self.released = True
+            self.space.reserved -= self.size - self.used
+            self.space.dirty -= self.dirty
+            self.dirty = 0
+            self.space.active -= 1
+            self.space.cond.notify_all()
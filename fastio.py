@@ -0,0 +1,229 @@
+"""Fast paths for moving file bodies between disk and sockets.
+
+Three ways to move a body, picked by size:
+
+- buffered: read/recv_into a reused buffer.  Best for small files, and
+  the only option on Python 2.  The receiving buffer doubles (up to
+  MAX_RECEIVE_CHUNK_SIZE) while the sender keeps it full.
+- sendfile: the kernel copies straight from the page cache to the socket
+  (sending only, and only where os.sendfile exists, so not on Windows).
+- mmap: the sender passes memoryview slices of a mapping to sendall, and
+  the receiver preallocates the destination, maps it and recv_into()s
+  straight into the mapping.  There is no per-chunk allocation and no
+  separate write call.
+
+Pass method= to force one, e.g. from the benchmark.  Receivers can pass a
+diskspace.Reservation, which is told about every write and may stall the
+writer to let the disk catch up.
+"""
+import errno
+import mmap
+import os
+import socket
+
+import diskspace
+import protocol
+import throttle
+
+BUFFERED = 'buffered'
+SENDFILE = 'sendfile'
+MMAP = 'mmap'
+
+CHUNK_SIZE = 32768
+MAX_RECEIVE_CHUNK_SIZE = 256 * 1024  # Buffered receives grow up to this while data keeps coming
+GROW_AFTER = 4                       # ... after this many reads in a row fill the buffer
+MMAP_CHUNK_SIZE = 1024 * 1024    # Slices are free, so hand the kernel more per call
+SENDFILE_THRESHOLD = 256 * 1024  # Files at least this big go through sendfile
+MMAP_THRESHOLD = 8 * 1024 * 1024  # ... or through mmap if sendfile isn't available
+
+HAS_SENDFILE = hasattr(os, 'sendfile') and hasattr(socket.socket, 'sendfile')
+
+
+def _mmap_usable():
+    """Python 2 mmaps can't be wrapped in a memoryview, so can't use this path"""
+    try:
+        m = mmap.mmap(-1, mmap.PAGESIZE)
+    except (mmap.error, OSError, ValueError):
+        return False
+    try:
+        memoryview(m).release()
+        return True
+    except (TypeError, AttributeError):
+        return False
+    finally:
+        m.close()
+
+
+HAS_MMAP = _mmap_usable()
+
+
+def choose_send_method(size):
+    if HAS_SENDFILE and size >= SENDFILE_THRESHOLD:
+        return SENDFILE
+    if HAS_MMAP and size >= MMAP_THRESHOLD:
+        return MMAP
+    return BUFFERED
+
+
+def choose_receive_method(size):
+    if HAS_MMAP and size >= MMAP_THRESHOLD and _can_preallocate():
+        return MMAP
+    return BUFFERED
+
+
+def _can_preallocate():
+    # Windows really allocates when a file is extended; elsewhere we need
+    # posix_fallocate, or a full disk would show up as SIGBUS mid-write
+    return os.name == 'nt' or hasattr(os, 'posix_fallocate')
+
+
+def _preallocate(f, size):
+    if hasattr(os, 'posix_fallocate'):
+        os.posix_fallocate(f.fileno(), 0, size)
+    else:
+        f.truncate(size)
+
+
+def send_body(sock, filepath, size, flow=None, chunk_size=CHUNK_SIZE,
+              method=None, progress=None, offset=0):
+    """Send size bytes of filepath from offset on; returns the number of bytes sent"""
+    flow = flow or throttle.NULL_FLOW
+    method = method or choose_send_method(size)
+    sent = 0
+    with open(filepath, 'rb') as f:
+        if method == SENDFILE:
+            # Unthrottled this is a handful of syscalls for the whole file
+            block = flow.chunk_size(chunk_size) if flow is not throttle.NULL_FLOW else size
+            while sent < size:
+                count = sock.sendfile(f, offset + sent, min(block, size - sent))
+                if not count:
+                    break
+                sent += count
+                flow.throttle(count)
+                if progress:
+                    progress(sent)
+        elif method == MMAP and size > 0:
+            m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            view = memoryview(m)
+            block = flow.chunk_size(MMAP_CHUNK_SIZE)
+            try:
+                while sent < size:
+                    n = min(block, size - sent, len(view) - offset - sent)
+                    if n <= 0:  # The file is shorter than it was
+                        break
+                    sock.sendall(view[offset + sent:offset + sent + n])
+                    sent += n
+                    flow.throttle(n)
+                    if progress:
+                        progress(sent)
+            finally:
+                view.release()
+                m.close()
+        else:
+            buf = bytearray(flow.chunk_size(chunk_size))
+            view = memoryview(buf)
+            f.seek(offset)
+            while sent < size:
+                n = f.readinto(buf)
+                if not n:
+                    break
+                n = min(n, size - sent)
+                sock.sendall(view[:n])
+                sent += n
+                flow.throttle(n)
+                if progress:
+                    progress(sent)
+    return sent
+
+
+def receive_file(sock, filepath, size, flow=None, chunk_size=CHUNK_SIZE,
+                 method=None, progress=None, reservation=None, digest=None):
+    """Receive a size byte body from sock into filepath.
+
+    Returns (status, received) using the session status codes.  On a full
+    disk the rest of the body is drained so a session can carry on.  digest
+    is an optional hashlib object fed everything written.
+    """
+    flow = flow or throttle.NULL_FLOW
+    method = method or choose_receive_method(size)
+    with open(filepath, 'w+b' if method == MMAP else 'wb') as f:
+        try:
+            if method == MMAP and size > 0:
+                status, received = _receive_mmap(sock, f, size, flow, progress, reservation,
+                                                 digest)
+            else:
+                status, received = _receive_buffered(sock, f, size, flow, chunk_size, progress,
+                                                     reservation, digest)
+        except (IOError, OSError) as e:
+            if e.errno != errno.ENOSPC:
+                raise
+            # Preallocation failed before any of the body was read
+            protocol.drain(sock, size, chunk_size)
+            return protocol.DISK_FULL, 0
+        if status != protocol.OK and method == MMAP:
+            f.truncate(received)  # Don't leave the preallocated tail behind
+    return status, received
+
+
+def _receive_buffered(sock, f, size, flow, chunk_size, progress, reservation, digest):
+    if reservation:
+        reservation.flush = lambda: diskspace.flush_to_disk(f)
+    buf = bytearray(flow.chunk_size(chunk_size))
+    view = memoryview(buf)
+    limit = flow.chunk_size(max(chunk_size, MAX_RECEIVE_CHUNK_SIZE))
+    full = 0
+    received = 0
+    while received < size:
+        n = sock.recv_into(view, min(len(buf), size - received))
+        if not n:
+            return protocol.INCOMPLETE, received
+        try:
+            f.write(view[:n])
+        except (IOError, OSError) as e:
+            if e.errno == errno.ENOSPC:
+                protocol.drain(sock, size - received - n, chunk_size)
+                return protocol.DISK_FULL, received
+            raise
+        received += n
+        if digest:
+            digest.update(view[:n])
+        if reservation:
+            reservation.wrote(n)
+        flow.throttle(n)
+        if progress:
+            progress(received)
+        # A fast link keeps the buffer full; bigger reads then mean fewer calls
+        full = full + 1 if n == len(buf) else 0
+        if full >= GROW_AFTER and len(buf) < limit:
+            buf = bytearray(min(len(buf) * 2, limit))
+            view = memoryview(buf)
+            full = 0
+    return protocol.OK, received
+
+
+def _receive_mmap(sock, f, size, flow, progress, reservation, digest):
+    _preallocate(f, size)  # Raises ENOSPC up front if it can't fit
+    m = mmap.mmap(f.fileno(), size)
+    if reservation:
+        reservation.preallocated()
+        reservation.flush = m.flush
+    view = memoryview(m)
+    block = flow.chunk_size(MMAP_CHUNK_SIZE)
+    received = 0
+    try:
+        while received < size:
+            n = sock.recv_into(view[received:min(received + block, size)])
+            if not n:
+                return protocol.INCOMPLETE, received
+            if digest:
+                digest.update(view[received:received + n])
+            received += n
+            if reservation:
+                reservation.wrote(n)
+            flow.throttle(n)
+            if progress:
+                progress(received)
+    finally:
+        view.release()
+        m.close()
+    return protocol.OK, received
@@ -0,0 +1,78 @@
+"""Bounded record of files the watcher has already dealt with.
+
+Entries are keyed by file name and remember the size and mtime the file
+had, so a file that is replaced or still being written no longer counts
+as seen.  When the index is full the least recently seen entry is
+dropped.  Files still sitting in the folder are touched on every scan,
+so only entries for files that have gone away are ever evicted.
+
+The index can optionally be saved to a JSON file so it survives restarts.
+Entries added with a ttl are only remembered for that many seconds and
+never saved, for files worth another try later.
+Must stay Python 2.7 compatible.
+"""
+import json
+import time
+from collections import OrderedDict
+
+import fileutil
+
+CAPACITY = 10000
+
+
+class FileIndex(object):
+    def __init__(self, capacity=CAPACITY, path=None):
+        self.capacity = capacity
+        self.path = path
+        self.entries = OrderedDict()  # name -> (size, mtime, expires or None), oldest first
+        self.dirty = False
+        if path:
+            self._load()
+
+    def _load(self):
+        try:
+            with open(self.path, 'rb') as f:
+                items = json.loads(f.read().decode('utf-8'))
+        except (IOError, OSError, ValueError):
+            return
+        for name, size, mtime in items[-self.capacity:]:
+            self.entries[name] = (size, mtime, None)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, name):
+        return name in self.entries
+
+    def seen(self, name, size, mtime):
+        """True if name was recorded with this size and mtime; marks it recently used"""
+        entry = self.entries.pop(name, None)
+        if entry is None:
+            return False
+        if entry[:2] != (size, mtime):
+            self.dirty = True  # The file changed, so the old entry is useless
+            return False
+        if entry[2] is not None and entry[2] <= time.time():
+            return False  # Time to try it again
+        self.entries[name] = entry
+        return True
+
+    def add(self, name, size, mtime, ttl=None):
+        self.entries.pop(name, None)
+        self.entries[name] = (size, mtime, time.time() + ttl if ttl is not None else None)
+        while len(self.entries) > self.capacity:
+            self.entries.popitem(last=False)
+        self.dirty = True
+
+    def discard(self, name):
+        if self.entries.pop(name, None) is not None:
+            self.dirty = True
+
+    def save(self):
+        """Write the index out if it has a path and has changed"""
+        if not self.path or not self.dirty:
+            return
+        items = [[name, size, mtime] for name, (size, mtime, expires) in self.entries.items()
+                 if expires is None]
+        fileutil.atomic_write(self.path, json.dumps(items).encode('utf-8'))
+        self.dirty = False
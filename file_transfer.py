@@ -3,10 +3,27 @@ from tkinter import ttk, scrolledtext, messagebox
 import socket
 import threading
 import os
-import shutil
 from datetime import datetime
 import sys
 import time
+import hashlib
+import json
+import multiprocessing
+
+import auth
+import catalog
+import diskspace
+import fileutil
+import filters
+import layout
+import printing
+import protocol
+import quota
+import scheduler
+import secure
+import send_queue
+import throttle
+import tuning
 
 # Try to import Windows-specific modules
 try:
@@ -18,8 +35,25 @@ try:
 except ImportError:
     HAS_SYSTEM_TRAY = False
 
+# Only needed once something connects or is sent; imported where they are
+# used, and ahead of time in the background once the window is up
+FEATURE_MODULES = ('delta', 'fastio', 'pull', 'relay', 'replicate', 'session', 'stream',
+                   'tree_sync')
+
+# Printers and interfaces found last run, shown until the fresh lists arrive
+STARTUP_CACHE_FILE = '.startup_cache.json'
+
+# Set by benchmarks/bench_startup.py to a file to report startup times
+# to (the windowed exe has no stdout); the app exits once it is loaded
+STARTUP_BENCH = os.environ.get('FT_STARTUP_BENCH')
+# Set by benchmarks/loadgen.py to a port to start hosting on 127.0.0.1 as
+# soon as the window is up
+HOST_BENCH = os.environ.get('FT_HOST_BENCH')
+
 class FileTransferGUI(tk.Tk):
     def __init__(self):
+        if STARTUP_BENCH:
+            self.report_startup("imported")
         tk.Tk.__init__(self)
         self.title("File Transfer Application")
         self.geometry("800x600")
@@ -62,33 +96,143 @@ class FileTransferGUI(tk.Tk):
         self.base_dir = self.get_application_path()
         self.sent_dir = os.path.join(self.base_dir, "sent")
         self.received_dir = os.path.join(self.base_dir, "received")
+        secure.configure(self.base_dir)  # Certificates and pinned hosts live in tls/
+        tuning.configure(self.base_dir)  # What each link likes is remembered here
+        self.startup_cache = self.read_startup_cache()
         
-        # Initialize print_filetypes with default values
-        self.print_filetypes = {'.pdf', '.png'}
+        # Which received files get printed, and which dropped files get sent
+        self.print_filter = filters.FileFilter.parse("pdf, png", extensions=True)
+        self.send_filter = filters.FileFilter.parse(filters.DEFAULT_SEND_RULES)
         
         # Create directories
         for directory in [self.sent_dir, self.received_dir]:
             if not os.path.exists(directory):
                 os.makedirs(directory)
         
+        # Room on disk reserved for files being received
+        self.disk_space = diskspace.DiskSpace(self.received_dir)
+        
+        # What arrived from whom, and how old received files may get
+        self.received_catalog = catalog.Catalog(os.path.join(self.base_dir, catalog.CATALOG_FILE))
+        self.keep_days = 0
+        self.keep_gb = 0
+        self.layout = layout.Layout(self.received_dir, layout.FLAT, layout.OVERWRITE)
+        
+        # Renders received files for the printer, reusing earlier renderings
+        self.print_pipeline = printing.PrintPipeline(self.base_dir)
+        
         # Network variables
         self.server_socket = None
         self.is_listening = False
         self.is_client_running = False
         self.watcher_thread = None
+        self.last_sync = 0
+        self.send_queue = None
+
+        # Bandwidth shaping for uploads (client tab) and downloads (host tab)
+        self.upload_limiter = throttle.BandwidthManager()
+        self.download_limiter = throttle.BandwidthManager()
+
+        # Per-client limits on what the host accepts
+        self.quotas = quota.Quotas()
+        
+        # Set when the host forwards what it receives instead of saving it
+        self.relay = None
+        
+        # Set when clients may fetch the files in a folder (see pull.py)
+        self.publisher = None
         
         # GUI setup
         self.create_gui()
+
+        # Durable outbox - replays anything left over from the last run
+        self.send_queue = send_queue.SendQueue(self.base_dir, self.deliver_job, log=self.log,
+                                              batch_func=self.deliver_batch)
+        # Holds bulk files back until their window while small ones go at once
+        self.scheduler = scheduler.Scheduler(self.send_queue, hosts=self.destination_hosts,
+                                             log=self.log)
         
-        # Set up system tray if available
+        # Set up system tray if available, once the window is up
         if self.has_tray:
-            try:
-                self.setup_tray()
-            except:
-                self.has_tray = False
+            self.after_idle(self.setup_tray_safely)
         
         # Bind only window close event, not minimize
         self.protocol('WM_DELETE_WINDOW', self.on_closing)
+        
+        # Enumerating printers and resolving our own addresses can take
+        # seconds on a slow machine, so the window doesn't wait for them
+        self.pending_loads = 2
+        self.load_in_background(self.get_local_ips, self.on_local_ips)
+        self.load_in_background(self.get_system_printers, self.on_printers)
+        self.load_in_background(self.import_features, lambda modules: None)
+        if STARTUP_BENCH:
+            self.after_idle(lambda: self.report_startup("window"))
+        if HOST_BENCH:
+            self.after_idle(self.start_bench_host)
+
+    def setup_tray_safely(self):
+        try:
+            self.setup_tray()
+        except:
+            self.has_tray = False
+
+    def load_in_background(self, func, done):
+        """Run func on a worker thread and pass its result to done() on the Tk thread"""
+        result = []
+        worker = threading.Thread(target=lambda: result.append(func()))
+        worker.daemon = True
+        worker.start()
+
+        def poll():
+            if worker.is_alive():
+                self.after(50, poll)
+            elif result:
+                done(result[0])
+        self.after(50, poll)
+
+    def import_features(self):
+        return [__import__(name) for name in FEATURE_MODULES]
+
+    def read_startup_cache(self):
+        try:
+            with open(os.path.join(self.base_dir, STARTUP_CACHE_FILE), 'rb') as f:
+                return json.loads(f.read().decode('utf-8'))
+        except (IOError, OSError, ValueError):
+            return {}
+
+    def update_startup_cache(self, key, value):
+        if self.startup_cache.get(key) == value:
+            return
+        self.startup_cache[key] = value
+        try:
+            fileutil.atomic_write(os.path.join(self.base_dir, STARTUP_CACHE_FILE),
+                                  json.dumps(self.startup_cache).encode('utf-8'))
+        except (IOError, OSError):
+            pass
+
+    def on_local_ips(self, ips):
+        self.listen_ip['values'] = ips
+        if not self.listen_ip.get() and ips:
+            self.listen_ip.set(ips[0])
+        self.update_startup_cache('local_ips', ips)
+        self.background_load_done()
+
+    def on_printers(self, printers):
+        self.set_printer_list(printers)
+        self.update_startup_cache('printers', printers)
+        self.background_load_done()
+
+    def background_load_done(self):
+        self.pending_loads -= 1
+        if STARTUP_BENCH and not self.pending_loads:
+            self.report_startup("loaded")
+
+    def report_startup(self, stage):
+        """Note when a startup stage finished, for benchmarks/bench_startup.py"""
+        with open(STARTUP_BENCH, 'a') as f:
+            f.write("%s %.6f\n" % (stage, time.time()))
+        if stage == "loaded":
+            self.after_idle(self.destroy)
 
     def setup_tray(self):
         """Set up system tray icon and functionality"""
@@ -215,6 +359,9 @@ class FileTransferGUI(tk.Tk):
                 self.stop_server()
             if self.is_client_running:
                 self.is_client_running = False
+            if self.send_queue:
+                self.send_queue.close()
+            self.print_pipeline.close()
             self.destroy()
         except:
             self.destroy()
@@ -351,6 +498,57 @@ class FileTransferGUI(tk.Tk):
         self.client_start_btn = ttk.Button(net_frame, text="Start Client", command=self.toggle_client)
         self.client_start_btn.grid(row=0, column=4, padx=5, pady=5)
         
+        # Optional folder tree to mirror to the host
+        ttk.Label(net_frame, text="Sync Folder:").grid(row=1, column=0, padx=5, pady=5)
+        self.sync_folder_var = tk.StringVar()
+        ttk.Entry(net_frame, textvariable=self.sync_folder_var, width=40).grid(
+            row=1, column=1, columnspan=3, sticky="we", padx=5, pady=5)
+        self.sync_delete_var = tk.BooleanVar(value=False)
+        ttk.Checkbutton(net_frame, text="Mirror deletions", variable=self.sync_delete_var).grid(
+            row=1, column=4, padx=5, pady=5)
+        
+        # Which dropped files get sent (see filters.py for the rule syntax)
+        ttk.Label(net_frame, text="Send Filter:").grid(row=2, column=0, padx=5, pady=5)
+        self.send_filter_var = tk.StringVar(value=str(self.send_filter))
+        send_filter_entry = ttk.Entry(net_frame, textvariable=self.send_filter_var, width=40)
+        send_filter_entry.grid(row=2, column=1, columnspan=3, sticky="we", padx=5, pady=5)
+        send_filter_entry.bind('<FocusOut>', self.update_send_filter)
+        send_filter_entry.bind('<Return>', self.update_send_filter)
+        
+        # Bulk files wait for these windows (see scheduler.py for the rule syntax)
+        ttk.Label(net_frame, text="Bulk Schedule:").grid(row=4, column=0, padx=5, pady=5)
+        self.bulk_schedule_var = tk.StringVar()
+        bulk_entry = ttk.Entry(net_frame, textvariable=self.bulk_schedule_var, width=40)
+        bulk_entry.grid(row=4, column=1, columnspan=3, sticky="we", padx=5, pady=5)
+        ttk.Label(net_frame, text="Idle below %:").grid(row=4, column=4, sticky="e", padx=5, pady=5)
+        self.bulk_idle_var = tk.StringVar(value=str(scheduler.IDLE_BELOW))
+        idle_entry = ttk.Entry(net_frame, textvariable=self.bulk_idle_var, width=5)
+        idle_entry.grid(row=4, column=5, sticky="w", padx=5, pady=5)
+        for entry in (bulk_entry, idle_entry):
+            entry.bind('<FocusOut>', self.update_bulk_schedule)
+            entry.bind('<Return>', self.update_bulk_schedule)
+        
+        # Optional TLS; the cipher can be chosen per host ("auto, 10.0.0.5=chacha20")
+        self.use_tls_var = tk.BooleanVar(value=False)
+        ttk.Checkbutton(net_frame, text="Encrypt (TLS)", variable=self.use_tls_var,
+                        command=self.update_tls).grid(row=3, column=0, padx=5, pady=5)
+        ttk.Label(net_frame, text="Ciphers:").grid(row=3, column=1, sticky="e", padx=5, pady=5)
+        self.tls_cipher_var = tk.StringVar(value=secure.AUTO)
+        cipher_entry = ttk.Entry(net_frame, textvariable=self.tls_cipher_var, width=25)
+        cipher_entry.grid(row=3, column=2, columnspan=2, sticky="we", padx=5, pady=5)
+        cipher_entry.bind('<FocusOut>', self.update_tls)
+        cipher_entry.bind('<Return>', self.update_tls)
+        
+        # Pre-shared key, shared with the Host tab; blank = no authentication
+        self.auth_key_var = tk.StringVar()
+        ttk.Label(net_frame, text="Key:").grid(row=3, column=4, sticky="e", padx=5, pady=5)
+        key_entry = ttk.Entry(net_frame, textvariable=self.auth_key_var, show="*", width=15)
+        key_entry.grid(row=3, column=5, padx=5, pady=5)
+        key_entry.bind('<FocusOut>', self.update_auth_key)
+        key_entry.bind('<Return>', self.update_auth_key)
+        
+        self.create_limit_frame(self.client_frame, self.upload_limiter, "Per host:")
+        
         # Status
         status_frame = ttk.LabelFrame(self.client_frame, text="Status")
         status_frame.pack(fill="x", padx=5, pady=5)
@@ -369,7 +567,7 @@ class FileTransferGUI(tk.Tk):
         net_frame.pack(fill="x", padx=5, pady=5)
         
         ttk.Label(net_frame, text="Listen IP:").grid(row=0, column=0, padx=5, pady=5)
-        self.listen_ip = ttk.Combobox(net_frame, values=self.get_local_ips())
+        self.listen_ip = ttk.Combobox(net_frame, values=self.startup_cache.get('local_ips', []))
         self.listen_ip.grid(row=0, column=1, padx=5, pady=5)
         if self.listen_ip["values"]:
             self.listen_ip.set(self.listen_ip["values"][0])
@@ -382,6 +580,31 @@ class FileTransferGUI(tk.Tk):
         self.start_btn = ttk.Button(net_frame, text="Start Server", command=self.toggle_server)
         self.start_btn.grid(row=0, column=4, padx=5, pady=5)
         
+        # TLS clients are always accepted; this turns plain ones away
+        self.require_tls_var = tk.BooleanVar(value=False)
+        ttk.Checkbutton(net_frame, text="Require TLS", variable=self.require_tls_var,
+                        command=lambda: secure.configure(require=self.require_tls_var.get())).grid(
+            row=1, column=0, columnspan=2, sticky="w", padx=5, pady=5)
+        
+        # Forward received files to another host instead of saving them
+        ttk.Label(net_frame, text="Relay to:").grid(row=1, column=2, padx=5, pady=5)
+        self.relay_var = tk.StringVar()
+        relay_entry = ttk.Entry(net_frame, textvariable=self.relay_var, width=20)
+        relay_entry.grid(row=1, column=3, padx=5, pady=5)
+        relay_entry.bind('<FocusOut>', self.update_relay)
+        relay_entry.bind('<Return>', self.update_relay)
+        self.relay_spill_var = tk.BooleanVar(value=True)
+        ttk.Checkbutton(net_frame, text="Spill to disk", variable=self.relay_spill_var,
+                        command=self.update_relay).grid(row=1, column=4, sticky="w", padx=5, pady=5)
+        
+        # Clients can fetch what's in this folder instead of being sent it
+        ttk.Label(net_frame, text="Publish folder:").grid(row=2, column=0, padx=5, pady=5)
+        self.publish_var = tk.StringVar()
+        publish_entry = ttk.Entry(net_frame, textvariable=self.publish_var, width=40)
+        publish_entry.grid(row=2, column=1, columnspan=3, sticky="ew", padx=5, pady=5)
+        publish_entry.bind('<FocusOut>', self.update_publish)
+        publish_entry.bind('<Return>', self.update_publish)
+        
         # Auto Print Frame
         print_frame = ttk.LabelFrame(self.host_frame, text="Optional Auto Print")
         print_frame.pack(fill="x", padx=5, pady=5)
@@ -390,7 +613,8 @@ class FileTransferGUI(tk.Tk):
         ttk.Label(print_frame, text="Printer:").grid(row=0, column=0, padx=5, pady=5)
         self.printer_var = tk.StringVar(value="No Printer")
         self.printer_combo = ttk.Combobox(print_frame, textvariable=self.printer_var)
-        self.printer_combo['values'] = self.get_system_printers()
+        self.printer_combo['values'] = (self.startup_cache.get('printers') or
+                                        ['No Printer', 'Default Printer'])
         self.printer_combo.grid(row=0, column=1, padx=5, pady=5)
         self.printer_combo.current(0)
         
@@ -404,11 +628,33 @@ class FileTransferGUI(tk.Tk):
         self.filetype_entry.grid(row=0, column=4, padx=5, pady=5)
         self.filetype_entry.bind('<FocusOut>', self.update_filetypes)
         
+        # Printer language to render to (viewer = let the file's program print it)
+        ttk.Label(print_frame, text="Render as:").grid(row=1, column=0, padx=5, pady=5)
+        self.render_format_var = tk.StringVar(value=printing.VIEWER)
+        render_combo = ttk.Combobox(print_frame, textvariable=self.render_format_var,
+                                    values=printing.FORMAT_NAMES, state="readonly")
+        render_combo.grid(row=1, column=1, padx=5, pady=5)
+        render_combo.bind('<<ComboboxSelected>>', self.update_print_rendering)
+        ttk.Label(print_frame, text="Cache MB:").grid(row=1, column=3, padx=5, pady=5)
+        self.print_cache_var = tk.StringVar(value=str(printing.CACHE_BYTES // (1024 * 1024)))
+        cache_entry = ttk.Entry(print_frame, textvariable=self.print_cache_var, width=7)
+        cache_entry.grid(row=1, column=4, sticky="w", padx=5, pady=5)
+        cache_entry.bind('<FocusOut>', self.update_print_rendering)
+        cache_entry.bind('<Return>', self.update_print_rendering)
+        
+        self.create_limit_frame(self.host_frame, self.download_limiter, "Per client:")
+        self.create_quota_frame(self.host_frame)
+        self.create_retention_frame(self.host_frame)
+        
         # Status Frame
         status_frame = ttk.LabelFrame(self.host_frame, text="Server Status")
         status_frame.pack(fill="x", padx=5, pady=5)
         self.host_status_label = ttk.Label(status_frame, text="Server: Stopped")
         self.host_status_label.pack(padx=5, pady=5)
+        self.disk_status_label = ttk.Label(status_frame, text="Disk: -")
+        self.disk_status_label.pack(padx=5, pady=(0, 5))
+        self.relay_status_label = ttk.Label(status_frame, text="")
+        self.relay_status_label.pack(padx=5, pady=(0, 5))
         
         # Log Frame
         log_frame = ttk.LabelFrame(self.host_frame, text="Server Log")
@@ -416,29 +662,248 @@ class FileTransferGUI(tk.Tk):
         self.host_log_text = scrolledtext.ScrolledText(log_frame, height=15)
         self.host_log_text.pack(fill="both", expand=True)
     
+    def create_limit_frame(self, parent, manager, per_client_label):
+        """Add total / per-IP / per-file bandwidth limit fields bound to manager"""
+        limit_frame = ttk.LabelFrame(parent, text="Bandwidth Limits (KB/s, blank = unlimited)")
+        limit_frame.pack(fill="x", padx=5, pady=5)
+        
+        total_var = tk.StringVar()
+        client_var = tk.StringVar()
+        transfer_var = tk.StringVar()
+        fields = [("Total:", total_var, 10), (per_client_label, client_var, 25), ("Per file:", transfer_var, 10)]
+        for column, (label, var, width) in enumerate(fields):
+            ttk.Label(limit_frame, text=label).grid(row=0, column=column * 2, padx=5, pady=5)
+            entry = ttk.Entry(limit_frame, textvariable=var, width=width)
+            entry.grid(row=0, column=column * 2 + 1, padx=5, pady=5)
+        
+        def apply_limits(event=None):
+            try:
+                per_client, overrides = throttle.parse_client_rates(client_var.get())
+                manager.configure(throttle.parse_rate(total_var.get()), per_client,
+                                  throttle.parse_rate(transfer_var.get()), overrides)
+            except ValueError:
+                messagebox.showerror("Error", "Bandwidth limits must be numbers in KB/s, "
+                                     "e.g. 500 or 200, 192.168.1.5=1000")
+        
+        for child in limit_frame.winfo_children():
+            if isinstance(child, ttk.Entry):
+                child.bind('<FocusOut>', apply_limits)
+                child.bind('<Return>', apply_limits)
+        return limit_frame
+    
+    def create_quota_frame(self, parent):
+        """Add the authentication key and per-client quota fields for the host"""
+        quota_frame = ttk.LabelFrame(parent, text="Client Limits (blank = unlimited)")
+        quota_frame.pack(fill="x", padx=5, pady=5)
+        
+        ttk.Label(quota_frame, text="Key:").grid(row=0, column=0, padx=5, pady=5)
+        key_entry = ttk.Entry(quota_frame, textvariable=self.auth_key_var, show="*", width=15)
+        key_entry.grid(row=0, column=1, padx=5, pady=5)
+        key_entry.bind('<FocusOut>', self.update_auth_key)
+        key_entry.bind('<Return>', self.update_auth_key)
+        
+        file_var = tk.StringVar()
+        bytes_var = tk.StringVar()
+        files_var = tk.StringVar()
+        connections_var = tk.StringVar()
+        fields = [("Max file MB:", file_var), ("MB/day:", bytes_var),
+                  ("Files/day:", files_var), ("Connections:", connections_var)]
+        for column, (label, var) in enumerate(fields, 1):
+            ttk.Label(quota_frame, text=label).grid(row=0, column=column * 2, padx=5, pady=5)
+            entry = ttk.Entry(quota_frame, textvariable=var, width=7)
+            entry.grid(row=0, column=column * 2 + 1, padx=5, pady=5)
+        
+        def number(var, scale=1):
+            text = var.get().strip()
+            value = float(text) if text else 0
+            if value < 0:
+                raise ValueError("Limits can't be negative")
+            return int(value * scale)
+        
+        def apply_quotas(event=None):
+            try:
+                self.quotas.configure(number(file_var, 1024 * 1024), number(bytes_var, 1024 * 1024),
+                                      number(files_var), number(connections_var))
+            except ValueError:
+                messagebox.showerror("Error", "Client limits must be numbers")
+        
+        for child in quota_frame.winfo_children():
+            if isinstance(child, ttk.Entry) and child is not key_entry:
+                child.bind('<FocusOut>', apply_quotas)
+                child.bind('<Return>', apply_quotas)
+        return quota_frame
+    
+    def create_retention_frame(self, parent):
+        """Add the fields for how long received files are kept"""
+        retention_frame = ttk.LabelFrame(parent, text="Received Files (blank = keep forever)")
+        retention_frame.pack(fill="x", padx=5, pady=5)
+        
+        days_var = tk.StringVar()
+        gb_var = tk.StringVar()
+        for column, (label, var) in enumerate([("Keep days:", days_var), ("Max GB:", gb_var)]):
+            ttk.Label(retention_frame, text=label).grid(row=0, column=column * 2, padx=5, pady=5)
+            entry = ttk.Entry(retention_frame, textvariable=var, width=7)
+            entry.grid(row=0, column=column * 2 + 1, padx=5, pady=5)
+            entry.bind('<FocusOut>', lambda event: apply_retention())
+            entry.bind('<Return>', lambda event: apply_retention())
+        ttk.Label(retention_frame, text="Search with: python catalog.py query --help").grid(
+            row=0, column=4, columnspan=2, padx=5, pady=5)
+        
+        # Which folders files are saved in, and what happens to name clashes
+        ttk.Label(retention_frame, text="Layout:").grid(row=1, column=0, padx=5, pady=5)
+        scheme_var = tk.StringVar(value=layout.FLAT)
+        scheme_combo = ttk.Combobox(retention_frame, textvariable=scheme_var,
+                                    values=layout.SCHEMES, width=12)
+        scheme_combo.grid(row=1, column=1, columnspan=2, sticky="w", padx=5, pady=5)
+        keep_var = tk.BooleanVar(value=False)
+        ttk.Checkbutton(retention_frame, text="Keep both copies of same-named files",
+                        variable=keep_var, command=lambda: apply_layout()).grid(
+            row=1, column=3, columnspan=3, sticky="w", padx=5, pady=5)
+        
+        def apply_retention():
+            try:
+                self.keep_days = float(days_var.get().strip() or 0)
+                self.keep_gb = float(gb_var.get().strip() or 0)
+            except ValueError:
+                messagebox.showerror("Error", "Retention limits must be numbers")
+        
+        def apply_layout(event=None):
+            try:
+                self.layout.configure(scheme_var.get(),
+                                      layout.KEEP if keep_var.get() else layout.OVERWRITE)
+            except layout.LayoutError as e:
+                messagebox.showerror("Error", str(e))
+        
+        for event in ('<<ComboboxSelected>>', '<FocusOut>', '<Return>'):
+            scheme_combo.bind(event, apply_layout)
+        return retention_frame
+    
+    def enforce_retention(self):
+        """Delete received files past the retention limits, every so often while serving"""
+        while self.is_listening:
+            if self.keep_days or self.keep_gb:
+                try:
+                    count = self.received_catalog.prune(
+                        self.keep_days * 86400, int(self.keep_gb * 1024 ** 3), log=self.log_host)
+                    if count:
+                        self.log_host(f"Retention: deleted {count} old received files")
+                except Exception as e:
+                    self.log_host(f"Retention error: {str(e)}")
+            for _ in range(catalog.RETENTION_INTERVAL):
+                if not self.is_listening:
+                    break
+                time.sleep(1)
+    
+    def update_auth_key(self, event=None):
+        auth.configure(self.auth_key_var.get())
+    
+    def update_relay(self, event=None):
+        """Start or stop relaying to the host in the Relay to box"""
+        import relay
+        text = self.relay_var.get().strip()
+        if not text:
+            self.relay = None
+            return
+        try:
+            destinations = protocol.parse_destinations(text)
+        except ValueError as e:
+            messagebox.showerror("Error", str(e))
+            return
+        if len(destinations) != 1:
+            messagebox.showerror("Error", "Relay to takes a single ip[:port]")
+            return
+        host, port = destinations[0]
+        current = self.relay
+        if current and (current.host, current.port) == (host, port):
+            current.spill = self.relay_spill_var.get()
+            return
+        self.relay = relay.Relay(host, port, self.relay_spill_var.get(), log=self.log_host)
+        self.log_host(f"Relaying received files to {host}:{port} instead of saving them")
+
+    def update_publish(self, event=None):
+        """Publish the folder in the Publish folder box for clients to pull"""
+        import pull
+        folder = self.publish_var.get().strip()
+        if not folder:
+            if self.publisher:
+                self.log_host("Stopped publishing")
+            self.publisher = None
+            return
+        folder = os.path.abspath(folder)
+        if self.publisher and self.publisher.directory == folder:
+            return
+        if not os.path.isdir(folder):
+            messagebox.showerror("Error", f"{folder} is not a folder")
+            return
+        self.publisher = pull.Publisher(folder, log=self.log_host)
+        self.log_host(f"Publishing {folder} for clients to pull")
+
     def refresh_printers(self):
+        def done(printers):
+            self.set_printer_list(printers)
+            self.update_startup_cache('printers', printers)
+            self.log_host("Printer list refreshed")
+        self.load_in_background(self.get_system_printers, done)
+
+    def set_printer_list(self, new_values):
         current = self.printer_var.get()
-        new_values = self.get_system_printers()
         self.printer_combo['values'] = new_values
         if current in new_values:
             self.printer_var.set(current)
         else:
             self.printer_var.set('No Printer')
-        self.log_host("Printer list refreshed")
 
     def update_filetypes(self, event=None):
-        filetypes = self.filetype_var.get().lower()
-        # Convert string to set of extensions
-        new_types = set()
-        for ft in filetypes.split(','):
-            ft = ft.strip()
-            if ft:
-                if not ft.startswith('.'):
-                    ft = '.' + ft
-                new_types.add(ft)
-        self.print_filetypes = new_types
+        # Plain extensions ("pdf, png") or any filter rules ("scan_*.pdf, size<20MB")
+        try:
+            self.print_filter = filters.FileFilter.parse(self.filetype_var.get(), extensions=True)
+        except filters.FilterError as e:
+            messagebox.showerror("Error", "Invalid print file types: %s" % str(e))
         # Update display with normalized format
-        self.filetype_var.set(', '.join(sorted(t[1:] for t in self.print_filetypes)))
+        self.filetype_var.set(str(self.print_filter))
+
+    def update_print_rendering(self, event=None):
+        try:
+            cache_mb = float(self.print_cache_var.get().strip() or 0)
+        except ValueError:
+            messagebox.showerror("Error", "Cache MB must be a number")
+            return
+        output_format = self.render_format_var.get()
+        self.print_pipeline.configure(output_format, int(cache_mb * 1024 * 1024))
+        if output_format != printing.VIEWER and not printing.find_ghostscript():
+            self.log_host("Ghostscript not found: only text files will be rendered, "
+                          "everything else goes to the viewer")
+    
+    def update_bulk_schedule(self, event=None):
+        try:
+            self.scheduler.configure(self.bulk_schedule_var.get(),
+                                     float(self.bulk_idle_var.get().strip() or 0))
+        except ValueError as e:
+            messagebox.showerror("Error", "Invalid bulk schedule: %s" % str(e))
+            return
+        self.bulk_schedule_var.set(str(self.scheduler.schedule))
+    
+    def update_send_filter(self, event=None):
+        try:
+            self.send_filter = filters.FileFilter.parse(self.send_filter_var.get())
+        except filters.FilterError as e:
+            messagebox.showerror("Error", "Invalid send filter: %s" % str(e))
+        self.send_filter_var.set(str(self.send_filter))
+
+    def update_tls(self, event=None):
+        try:
+            cipher, host_ciphers = secure.parse_ciphers(self.tls_cipher_var.get())
+        except ValueError as e:
+            messagebox.showerror("Error", str(e))
+            return
+        secure.configure(enabled=self.use_tls_var.get(), cipher=cipher, host_ciphers=host_ciphers)
+
+    def start_bench_host(self):
+        """Start the server for benchmarks/loadgen.py without anyone clicking"""
+        self.listen_ip.set('127.0.0.1')
+        self.listen_port.delete(0, tk.END)
+        self.listen_port.insert(0, HOST_BENCH)
+        self.toggle_server()
 
     def toggle_server(self):
         if not self.is_listening:
@@ -453,17 +918,26 @@ class FileTransferGUI(tk.Tk):
                     # Log binding attempt
                     self.log_host(f"Attempting to bind to {ip}:{port}")
                     self.server_socket.bind((ip, port))
+                    tuning.tune_listener(self.server_socket)
                     self.server_socket.listen(5)
                     
                     self.is_listening = True
                     self.start_btn.config(text="Stop Server")
                     self.host_status_label.config(text="Server: Running on %s:%d" % (ip, port))
                     self.log_host("Server started on %s:%d" % (ip, port))
+                    try:
+                        self.log_host("TLS certificate fingerprint: %s" % secure.fingerprint())
+                    except secure.TLSError as e:
+                        self.log_host("TLS unavailable: %s" % str(e))
                     
                     # Start server thread
                     server_thread = threading.Thread(target=self.accept_connections)
                     server_thread.setDaemon(True)
                     server_thread.start()
+                    retention_thread = threading.Thread(target=self.enforce_retention)
+                    retention_thread.daemon = True
+                    retention_thread.start()
+                    self.update_disk_status()
                     
                 except socket.error as e:
                     error_msg = f"Failed to bind to address {ip}:{port}: {str(e)}"
@@ -491,10 +965,21 @@ class FileTransferGUI(tk.Tk):
         self.host_status_label.config(text="Server: Stopped")
         self.log_host("Server stopped")
     
+    def update_disk_status(self):
+        """Show free space and reservations on the Host tab while the server runs"""
+        self.disk_status_label.config(text="Disk: " + self.disk_space.describe())
+        self.relay_status_label.config(text="Relay: " + self.relay.describe() if self.relay else "")
+        if self.is_listening:
+            self.after(2000, self.update_disk_status)
+    
     def accept_connections(self):
         while self.is_listening:
             try:
                 client, addr = self.server_socket.accept()
+                if not self.quotas.connect(addr[0]):
+                    self.log_host(f"Refused connection from {addr[0]} - too many open connections")
+                    protocol.abort(client)
+                    continue
                 handler = threading.Thread(target=self.handle_client, args=(client, addr))
                 handler.setDaemon(True)
                 handler.start()
@@ -504,24 +989,118 @@ class FileTransferGUI(tk.Tk):
                 break
     
     def handle_client(self, client, addr):
+        import delta  # See FEATURE_MODULES
+        import pull
+        import session
+        import stream
+        import tree_sync
+        forwarder = self.relay.open() if self.relay else None
         try:
             self.log_host(f"New connection from {addr[0]}:{addr[1]}")
             
             # Set socket timeout
             client.settimeout(30)
-            self.log_host(f"Waiting for filename length from {addr[0]}")
             
-            name_length_data = client.recv(8)
-            self.log_host(f"Received raw filename length data: {name_length_data!r}")
+            # Start TLS if the client asked for it
+            tls_client = secure.accept(client)
+            if tls_client is None:
+                self.log_host(f"Rejected plain connection from {addr[0]} - TLS is required")
+                return
+            client = tls_client
+            self.log_host(f"Waiting for filename length from {addr[0]}")
             
-            if not name_length_data:
+            try:
+                name_length_data = protocol.recv_exact(client, 8)
+            except protocol.ProtocolError:
                 self.log_host(f"Client {addr[0]} disconnected - no filename length received (received empty data)")
                 return
+            
+            # Check the pre-shared key before reading anything else
+            try:
+                if auth.server_handshake(client, name_length_data):
+                    self.log_host(f"Client {addr[0]} authenticated")
+                    name_length_data = protocol.recv_exact(client, 8)
+            except auth.AuthError as e:
+                self.log_host(f"Rejected {addr[0]}: {str(e)}")
+                protocol.abort(client)
+                return
+            self.log_host(f"Received raw filename length data: {name_length_data!r}")
+
+            if name_length_data == session.SESSION_MAGIC:
+                # Acknowledged session: many files, one ack per file
+                self.log_host(f"Client {addr[0]} opened an acknowledged session")
+                if forwarder:
+                    receive = lambda name, size: self.relay_file(client, addr, forwarder, name, size)
+                else:
+                    receive = lambda name, size: self.receive_file(client, addr, name, size)
+                session.serve_session(client, receive, log=self.log_host)
+                return
+
+            if name_length_data == pull.PULL_MAGIC:
+                # A client fetching published files; hanging up tells it there are none
+                publisher = self.publisher
+                if publisher is None:
+                    self.log_host(f"Turned away a pull from {addr[0]} - no folder is published")
+                    return
+                self.log_host(f"Client {addr[0]} is pulling published files")
+                sent = pull.serve_pull(client, publisher, self.log_host,
+                                       lambda: self.download_limiter.open_flow(addr[0]))
+                self.log_host(f"Pull by {addr[0]} finished, {sent} bytes sent")
+                return
+
+            if forwarder and name_length_data in (delta.DELTA_MAGIC, tree_sync.SYNC_MAGIC,
+                                                  stream.STREAM_MAGIC):
+                # Hanging up makes delta senders send the whole file instead
+                self.log_host(f"Turned away a delta, folder sync or stream from {addr[0]} - "
+                              f"relays only forward files")
+                return
+
+            if name_length_data == delta.DELTA_MAGIC:
+                # Only the changed parts of a file we already have
+                self.log_host(f"Client {addr[0]} is sending a delta")
+                started = time.time()
+                filename, filepath, status = delta.serve_delta(
+                    client, self.received_dir, self.log_host,
+                    lambda: self.download_limiter.open_flow(addr[0]),
+                    choose_target=lambda name: self.layout.claim(name, addr[0]),
+                    quota=self.quotas.for_client(addr[0]), space=self.disk_space,
+                    locate=lambda name: self.layout.path_for(name, addr[0]))
+                if status == protocol.OK:
+                    self.received_catalog.record(addr[0], filepath, os.path.getsize(filepath),
+                                                 status, started)
+                    self.after_receive(filepath)
+                return
+
+            if name_length_data == tree_sync.SYNC_MAGIC:
+                self.log_host(f"Client {addr[0]} is syncing a folder")
+                tree_sync.serve_sync(client, self.received_dir, addr[0], self.log_host,
+                                     lambda: self.download_limiter.open_flow(addr[0]),
+                                     self.quotas.for_client(addr[0]), self.disk_space,
+                                     lambda path, size, status, started, sha256:
+                                     self.received_catalog.record(addr[0], path, size, status,
+                                                                  started, sha256=sha256))
+                return
+
+            if name_length_data == stream.STREAM_MAGIC:
+                # Piped in by stream.py, length unknown until it ends
+                self.log_host(f"Client {addr[0]} is streaming a file")
+                filename, filepath, status = stream.serve_stream(
+                    client, self.received_dir, self.log_host,
+                    lambda: self.download_limiter.open_flow(addr[0]),
+                    choose_target=lambda name: self.layout.claim(name, addr[0]),
+                    quota=self.quotas.for_client(addr[0]), space=self.disk_space,
+                    locate=lambda name: self.layout.path_for(name, addr[0]),
+                    record=lambda path, size, status, started, sha256:
+                    self.received_catalog.record(addr[0], path, size, status, started,
+                                                 sha256=sha256))
+                if status == protocol.OK:
+                    self.after_receive(filepath)
+                return
                 
             try:
-                name_length = int(name_length_data.decode('ascii'))
+                name_length = protocol.decode_name_length(name_length_data)
                 self.log_host(f"Decoded filename length: {name_length}")
-            except ValueError as e:
+            except (ValueError, protocol.ProtocolError) as e:
                 self.log_host(f"Error decoding filename length from {addr[0]}: {str(e)}, raw data: {name_length_data!r}")
                 return
                 
@@ -553,92 +1132,257 @@ class FileTransferGUI(tk.Tk):
                 self.log_host(f"Error decoding file size from {addr[0]}: {str(e)}, raw data: {size_data!r}")
                 return
             
-            self.log_host(f"Receiving file {filename} ({file_size} bytes) from {addr[0]}")
-            
-            filepath = os.path.join(self.received_dir, filename)
-            if os.path.exists(filepath):
-                self.log_host("File %s already exists - will overwrite" % filename)
-            
-            received = 0
-            with open(filepath, 'wb') as f:
-                while received < file_size:
-                    chunk = client.recv(min(32768, file_size - received))
-                    if not chunk:
-                        self.log_host(f"Connection lost while receiving file - got {received}/{file_size} bytes")
-                        break
-                    f.write(chunk)
-                    received += len(chunk)
-                    if received % 327680 == 0:  # Log every 320KB
-                        self.log_host(f"Received {received}/{file_size} bytes")
-            
-            if received == file_size:
-                self.log_host(f"Successfully received file {filename} from {addr[0]}")
+            if forwarder:
+                status, received = self.relay_file(client, addr, forwarder, filename, file_size)
             else:
-                self.log_host(f"WARNING: Incomplete file received from {addr[0]} - got {received}/{file_size} bytes")
-            
-            if self.printer_var.get() != "No Printer":
-                file_ext = os.path.splitext(filename)[1].lower()
-                if file_ext in self.print_filetypes:
-                    self.print_file(filepath)
+                status, received = self.receive_file(client, addr, filename, file_size)
+            if status != protocol.OK:
+                # A clean close is the legacy sender's ack; a file that wasn't
+                # kept (or passed on) must look like a failed send
+                protocol.abort(client)
             
         except Exception as e:
             self.log_host(f"Error handling client {addr[0]}: {str(e)}")
+            protocol.abort(client)  # Whatever it was sending didn't arrive
         finally:
             try:
+                if forwarder:
+                    forwarder.close()
                 client.close()
             except:
                 pass
+            self.quotas.disconnect(addr[0])
+
+    def receive_file(self, client, addr, filename, file_size):
+        """Receive one file body into received/; returns (status, bytes written)"""
+        import fastio
+        if protocol.safe_filename(filename) is None:
+            self.log_host(f"Rejected file with unsafe name {filename!r} from {addr[0]}")
+            protocol.drain(client, file_size)
+            return protocol.REJECTED, 0
+
+        # Refuse oversize or over-quota files before anything touches the disk
+        refusal = self.quotas.admit(addr[0], file_size)
+        if refusal:
+            self.log_host(f"Refused {filename} from {addr[0]}: {refusal}")
+            return protocol.QUOTA, 0
+
+        # ... or that won't fit on disk, waiting a little for other transfers first
+        reservation = self.disk_space.reserve(file_size)
+        if reservation is None:
+            self.log_host(f"Refused {filename} from {addr[0]}: not enough disk space "
+                          f"({self.disk_space.describe()})")
+            self.quotas.finish(addr[0], file_size, 0)
+            return protocol.NO_SPACE, 0
+
+        self.log_host(f"Receiving file {filename} ({file_size} bytes) from {addr[0]}")
+        logged = 0
+
+        def progress(received):
+            nonlocal logged
+            if received - logged >= 327680:  # Log every 320KB
+                logged = received
+                self.log_host(f"Received {received}/{file_size} bytes")
 
-    def print_file(self, filepath):
+        flow = self.download_limiter.open_flow(addr[0])
+        status, received = protocol.INCOMPLETE, 0
+        started = time.time()
+        sha256 = hashlib.sha256()
         try:
-            printer_name = self.printer_var.get()
-            if printer_name and printer_name != "No Printer":
-                os.startfile(filepath, "print")
-                self.log_host("Sent %s to default printer" % os.path.basename(filepath))
-        except Exception as e:
-            self.log_host("Error printing file: %s" % str(e))
+            # Inside the try, so a name the disk won't take still frees the reservation
+            if self.layout.collisions == layout.OVERWRITE:
+                filepath = self.layout.path_for(filename, addr[0])
+                if os.path.exists(filepath):
+                    self.log_host("File %s already exists - will overwrite" % filename)
+            else:
+                filepath = self.layout.claim(filename, addr[0])
+                if os.path.basename(filepath) != filename:
+                    self.log_host("File %s already exists - saving as %s" %
+                                  (filename, os.path.basename(filepath)))
+            status, received = fastio.receive_file(client, filepath, file_size, flow,
+                                                   progress=progress, reservation=reservation,
+                                                   digest=sha256)
+        finally:
+            flow.close()
+            reservation.release()
+            self.quotas.finish(addr[0], file_size, received if status != protocol.DISK_FULL else 0)
+        self.received_catalog.record(addr[0], filepath, received, status, started,
+                                     sha256=sha256.hexdigest())
+        
+        if status == protocol.OK:
+            self.log_host(f"Successfully received file {filename} from {addr[0]}")
+        elif status == protocol.DISK_FULL:
+            self.log_host(f"ERROR: Disk full while receiving {filename} from {addr[0]} - got {received}/{file_size} bytes")
+            os.remove(filepath)
+            return status, received
+        else:
+            self.log_host(f"Connection lost while receiving file - got {received}/{file_size} bytes")
+            self.log_host(f"WARNING: Incomplete file received from {addr[0]} - got {received}/{file_size} bytes")
+        
+        self.after_receive(filepath, sha256.hexdigest())
+        return status, received
+
+    def relay_file(self, client, addr, forwarder, filename, file_size):
+        """Pass one file on to the relay's next hop while it arrives; returns (status, bytes received)"""
+        if protocol.safe_filename(filename) is None:
+            self.log_host(f"Rejected file with unsafe name {filename!r} from {addr[0]}")
+            protocol.drain(client, file_size)
+            return protocol.REJECTED, 0
+
+        refusal = self.quotas.admit(addr[0], file_size)
+        if refusal:
+            self.log_host(f"Refused {filename} from {addr[0]}: {refusal}")
+            return protocol.QUOTA, 0
+
+        self.log_host(f"Relaying {filename} ({file_size} bytes) from {addr[0]} to "
+                      f"{forwarder.relay.host}:{forwarder.relay.port}")
+        flow = self.download_limiter.open_flow(addr[0])
+        status, received = protocol.INCOMPLETE, 0
+        try:
+            status, received = forwarder.forward(client, filename, file_size, flow)
+        finally:
+            flow.close()
+            self.quotas.finish(addr[0], file_size, received)
+
+        if status == protocol.OK:
+            self.log_host(f"Relayed {filename} from {addr[0]}")
+        else:
+            self.log_host(f"Relaying {filename} from {addr[0]} failed: {status} "
+                          f"({received}/{file_size} bytes received)")
+        return status, received
+
+    def after_receive(self, filepath, sha256=None):
+        """Print a received file if it is one of the printable types"""
+        if self.printer_var.get() != "No Printer" and self.print_filter.matches(filepath):
+            self.print_file(filepath, sha256)
+
+    def print_file(self, filepath, sha256=None):
+        """Queue a file for printing; the result is logged and cataloged once it prints"""
+        printer_name = self.printer_var.get()
+        if not printer_name or printer_name == "No Printer":
+            return
+        
+        def done(printed, message):
+            self.log_host(message)
+            self.received_catalog.set_printed(
+                filepath, catalog.PRINTED if printed else catalog.PRINT_FAILED)
+        
+        self.print_pipeline.submit(
+            filepath, None if printer_name == "Default Printer" else printer_name, done,
+            sha256=sha256)
 
     def watch_directory(self):
-        """Monitor directory for new files"""
+        """Monitor directory for new files and feed them to the send queue"""
+        import tree_sync
         while self.is_client_running:
             try:
+                # Skip the executable itself, our own modules (including the
+                # feature modules, which may not be imported yet) and anything
+                # the send filter rules out
+                send_filter = self.send_filter
+                send_filter.set_excluded_names(
+                    protocol.own_files(self.base_dir) |
+                    {name + '.py' for name in FEATURE_MODULES} |
+                    {os.path.basename(sys.executable), os.path.basename(__file__)})
+                
                 # Only watch the base directory where the exe/script is located
-                files = [f for f in os.listdir(self.base_dir) 
-                        if os.path.isfile(os.path.join(self.base_dir, f))]
+                with os.scandir(self.base_dir) as entries:
+                    files = [entry for entry in entries
+                             if entry.is_file() and send_filter.matches(entry.path, entry.stat)]
                 
-                for filename in files:
-                    filepath = os.path.join(self.base_dir, filename)
-                    
-                    # Skip the executable itself and system files
-                    if (not filename.startswith('.') and
-                        not filename.endswith('.exe') and
-                        not filename.endswith('.pyc') and
-                        not filename.endswith('.pyd') and
-                        not filename.endswith('.dll') and
-                        filename != os.path.basename(sys.executable) and
-                        filename != os.path.basename(__file__)):
-                        
-                        try:
-                            # Move to sent folder (will overwrite if exists)
-                            new_path = os.path.join(self.sent_dir, filename)
-                            if os.path.exists(new_path):
-                                self.log(f"File {filename} already exists in sent folder - will overwrite")
-                            shutil.move(filepath, new_path)
-                            self.send_file(new_path)
-                        except Exception as e:
-                            self.log(f"Error processing file {filename}: {str(e)}")
+                for entry in files:
+                    try:
+                        # Claim the file; it only reaches sent/ once delivered
+                        self.scheduler.enqueue(entry.path, entry.stat)
+                        self.log(f"Queued {entry.name} for sending")
+                    except Exception as e:
+                        self.log(f"Error processing file {entry.name}: {str(e)}")
+
+                self.scheduler.process_due(lambda: self.is_client_running)
+
+                if (self.sync_folder_var.get().strip() and
+                        time.time() - self.last_sync >= tree_sync.SYNC_INTERVAL):
+                    self.last_sync = time.time()
+                    self.sync_folder()
             except Exception as e:
                 self.log(f"Directory watch error: {str(e)}")
             time.sleep(1)
 
-    def send_file(self, filepath):
+    def sync_folder(self):
+        """Mirror the sync folder tree to every receiver, sending only changes"""
+        import tree_sync
+        folder = self.sync_folder_var.get().strip()
+        if not os.path.isdir(folder):
+            self.log(f"Sync folder {folder} does not exist")
+            return
+        for server_ip, server_port in self.get_destinations():
+            try:
+                sent, failed, deleted = tree_sync.sync_tree(
+                    folder, server_ip, server_port, delete=self.sync_delete_var.get(),
+                    log=self.log, limiter=self.upload_limiter)
+                if sent or failed or deleted:
+                    self.log(f"Synced {folder} to {server_ip}:{server_port}: "
+                             f"{sent} sent, {len(failed)} failed, {deleted} deleted")
+            except Exception as e:
+                self.log(f"ERROR: Sync to {server_ip}:{server_port} failed: {str(e)}")
+
+    def get_destinations(self):
+        """Parse the Server IP field, which may list several receivers"""
+        return protocol.parse_destinations(self.server_ip.get(), int(self.server_port.get()))
+
+    def destination_hosts(self):
         try:
-            filename = os.path.basename(filepath)
+            return [host for host, _ in self.get_destinations()]
+        except ValueError:
+            return []
+
+    def deliver_job(self, job):
+        """Send a queued file to every configured receiver"""
+        destinations = self.get_destinations()
+        if len(destinations) > 1:
+            return self.replicate_file(job, destinations)
+        server_ip, server_port = destinations[0]
+        return self.send_file(job.path, server_ip, server_port, job.name)
+
+    def deliver_batch(self, jobs, complete):
+        """Send every due file, pipelined over one acknowledged session when possible"""
+        import session
+        destinations = self.get_destinations()
+        if len(destinations) > 1:
+            for job in jobs:
+                complete(job, self.replicate_file(job, destinations))
+            return
+        server_ip, server_port = destinations[0]
+        session.send_batch(server_ip, server_port, jobs, complete,
+                           lambda job: self.send_file(job.path, server_ip, server_port, job.name),
+                           log=self.log, limiter=self.upload_limiter)
+
+    def replicate_file(self, job, destinations):
+        """Send one file to every receiver that doesn't have it yet"""
+        import replicate
+        delivered = set(job.data.get('delivered', []))
+        remaining = [d for d in destinations if "%s:%d" % d not in delivered]
+
+        def progress(dest):
+            self.log(f"{job.name} -> {dest.label}: {dest.sent}/{dest.total} bytes")
+
+        results = replicate.replicate_file(job.path, remaining, log=self.log,
+                                           progress=progress, filename=job.name,
+                                           limiter=self.upload_limiter)
+        delivered.update(dest.label for dest in results if dest.done)
+        job.data['delivered'] = sorted(delivered)
+        if all(dest.done for dest in results):
+            self.log("File %s replicated to %d receivers" % (job.name, len(destinations)))
+            return True
+        return False
+
+    def send_file(self, filepath, server_ip, server_port, filename=None):
+        """Send one file and wait for the receiver to confirm it; returns True on success"""
+        import fastio
+        try:
+            filename = filename or os.path.basename(filepath)
             filesize = os.path.getsize(filepath)
             
-            server_ip = self.server_ip.get()
-            server_port = int(self.server_port.get())
-            
             # Log connection attempt
             self.log(f"Attempting to connect to {server_ip}:{server_port}")
             
@@ -647,47 +1391,52 @@ class FileTransferGUI(tk.Tk):
             sock.settimeout(30)
             
             try:
-                # Connect to server
-                sock.connect((server_ip, server_port))
+                # Connect to server, with the socket settings that suit this link
+                tuning.connect(sock, server_ip, server_port)
+                sock = protocol.start_client(sock, server_ip, server_port)
                 self.log(f"Successfully connected to {server_ip}:{server_port}")
                 
                 # Send filename length (8 bytes, padded ASCII number)
                 name_bytes = filename.encode('utf-8')
                 name_length = str(len(name_bytes)).zfill(8).encode('ascii')
                 self.log(f"Sending filename length: {name_length!r}")
-                sock.send(name_length)
+                sock.sendall(name_length)
                 
                 # Send filename
                 self.log(f"Sending filename: {name_bytes!r}")
-                sock.send(name_bytes)
+                sock.sendall(name_bytes)
                 
                 # Send file size (16 bytes, padded ASCII number)
                 size_bytes = str(filesize).zfill(16).encode('ascii')
                 self.log(f"Sending file size: {size_bytes!r}")
-                sock.send(size_bytes)
+                sock.sendall(size_bytes)
                 
-                # Send file data
-                with open(filepath, 'rb') as f:
-                    total_sent = 0
-                    while True:
-                        chunk = f.read(32768)  # 32KB chunks
-                        if not chunk:
-                            break
-                        bytes_sent = sock.send(chunk)
-                        total_sent += bytes_sent
-                        self.log(f"Sent {total_sent}/{filesize} bytes")
+                # Send file data (buffered, sendfile or mmap depending on size)
+                flow = self.upload_limiter.open_flow(server_ip)
+                start_time = time.time()
+                try:
+                    fastio.send_body(sock, filepath, filesize, flow,
+                                     tuning.chunk_size(server_ip, fastio.CHUNK_SIZE),
+                                     progress=lambda sent: self.log(f"Sent {sent}/{filesize} bytes"))
+                finally:
+                    flow.close()
                 
+                # The receiver hangs up once it has the whole file
+                protocol.wait_for_close(sock)
                 self.log("File %s sent successfully" % filename)
+                if flow is throttle.NULL_FLOW:  # A limited transfer says nothing about the link
+                    tuning.record(server_ip, filesize, time.time() - start_time)
+                return True
                 
             except socket.error as e:
-                error_msg = f"Connection to {server_ip}:{server_port} failed: {str(e)}"
-                self.log("ERROR: " + error_msg)
-                messagebox.showerror("Connection Error", error_msg)
+                self.log(f"ERROR: Connection to {server_ip}:{server_port} failed: {str(e)}")
+                return False
             finally:
                 sock.close()
                 
         except Exception as e:
             self.log("ERROR: Failed to send file: %s" % str(e))
+            return False
     
     def toggle_client(self):
         if not self.is_client_running:
@@ -704,9 +1453,18 @@ class FileTransferGUI(tk.Tk):
                 except ValueError:
                     messagebox.showerror("Error", "Please enter a valid port number (1-65535)")
                     return
+
+                try:
+                    destinations = self.get_destinations()
+                except ValueError as e:
+                    messagebox.showerror("Error", str(e))
+                    return
+                if len(destinations) > 1:
+                    self.log("Replicate mode: sending each file to %d receivers" % len(destinations))
                 
                 # Start the watcher thread
                 self.is_client_running = True
+                self.last_sync = 0  # Sync the folder tree straight away
                 self.watcher_thread = threading.Thread(target=self.watch_directory)
                 self.watcher_thread.setDaemon(True)
                 self.watcher_thread.start()
@@ -739,6 +1497,7 @@ class FileTransferGUI(tk.Tk):
         self.host_log_text.see(tk.END)
 
 if __name__ == "__main__":
+    multiprocessing.freeze_support()  # The print renderers run in copies of the exe
     try:
         app = FileTransferGUI()
         app.mainloop()
@@ -0,0 +1,46 @@
+"""Small filesystem helpers that behave the same on Python 2 and 3"""
+import errno
+import os
+
+
+def ensure_dir(path):
+    """Create a directory (and parents) if it doesn't exist yet"""
+    if not os.path.isdir(path):
+        try:
+            os.makedirs(path)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+    return path
+
+
+def replace_file(src, dst):
+    """Rename src over dst, replacing dst if it exists (os.replace for Python 2)"""
+    if hasattr(os, 'replace'):
+        os.replace(src, dst)
+        return
+    try:
+        os.rename(src, dst)
+    except OSError:
+        # Windows won't rename over an existing file on Python 2
+        if os.path.exists(dst):
+            os.remove(dst)
+        os.rename(src, dst)
+
+
+def fsync_file(f):
+    """Flush a file object all the way to disk"""
+    f.flush()
+    try:
+        os.fsync(f.fileno())
+    except (OSError, AttributeError):
+        pass
+
+
+def atomic_write(path, data):
+    """Write bytes to path so readers never see a half-written file"""
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+        fsync_file(f)
+    replace_file(tmp_path, path)
@@ -0,0 +1,172 @@
+"""Include/exclude rules that decide which files get sent or printed.
+
+Rules are a comma separated list:
+
+    *.pdf, scan_*        send only names matching one of these globs
+    !*.log               never send names matching this glob
+    re:^IMG_\\d+\\.jpg$    regular expression include (!re: to exclude)
+    size<50MB, size>0    size limits (B, KB, MB or GB)
+    age>5s, age<7d       time since last modified (s, m, h or d)
+
+A file passes if no exclude rule matches, at least one include rule
+matches (when there are any) and it is within every limit.  Names are
+compared case-insensitively, as on Windows.
+
+All globs and regexes of one kind are compiled into a single regular
+expression, so checking a name costs two regex searches however many
+rules there are.  Decisions are remembered per name and per path; a path
+is only looked at again once its size or mtime changes, or once an age
+limit could change the answer.  Must stay Python 2.7 compatible.
+"""
+import fnmatch
+import os
+import re
+import time
+
+INFINITY = float('inf')
+MAX_CACHED = 10000  # Forget everything past this many names or paths rather than grow forever
+
+# Files the watchers never send: hidden files and the program's own pieces
+DEFAULT_SEND_RULES = "!.*, !*.exe, !*.pyc, !*.pyd, !*.dll, !*.bat, !*.log"
+
+SIZE_UNITS = {'': 1, 'b': 1, 'k': 1024, 'kb': 1024, 'm': 1024 ** 2, 'mb': 1024 ** 2,
+              'g': 1024 ** 3, 'gb': 1024 ** 3}
+AGE_UNITS = {'': 1, 's': 1, 'm': 60, 'h': 3600, 'd': 86400}
+
+_LIMIT = re.compile(r'^(size|age)\s*([<>])\s*([0-9.]+)\s*([a-z]*)$', re.IGNORECASE)
+_GLOB_CHARS = re.compile(r'[*?\[]')
+
+
+class FilterError(ValueError):
+    """A rule couldn't be understood"""
+
+
+def split_rules(text):
+    return [rule.strip() for rule in re.split(r'[,\n]', text or '') if rule.strip()]
+
+
+def _combine(patterns):
+    if not patterns:
+        return None
+    return re.compile('|'.join('(?:%s)' % p for p in patterns), re.IGNORECASE)
+
+
+class FileFilter(object):
+    """Compiled set of rules; see the module docstring for the syntax.
+
+    With extensions=True a bare word such as "pdf" means "*.pdf", which
+    is how the print file types have always been written.
+    """
+
+    def __init__(self, rules=(), excluded_names=(), extensions=False):
+        self.rules = list(rules)
+        include, exclude = [], []
+        self.min_size = self.max_size = None
+        self.min_age = self.max_age = None
+        for rule in self.rules:
+            negate = rule.startswith('!')
+            body = rule[1:].strip() if negate else rule
+            limit = _LIMIT.match(body)
+            if limit:
+                if negate:
+                    raise FilterError("Size and age limits can't be negated: %s" % rule)
+                self._add_limit(rule, *limit.groups())
+                continue
+            if body.lower().startswith('re:'):
+                pattern = body[3:]
+                try:
+                    re.compile(pattern)
+                except re.error as e:
+                    raise FilterError("Bad regular expression %s: %s" % (rule, e))
+            else:
+                if extensions and not _GLOB_CHARS.search(body):
+                    body = '*.' + body.lstrip('.')
+                pattern = '^' + fnmatch.translate(body)
+            (exclude if negate else include).append(pattern)
+        self._include = _combine(include)
+        self._exclude = _combine(exclude)
+        self.excluded_names = set()
+        self.names = {}   # name -> decision from the name rules alone
+        self.paths = {}   # path -> (mtime, size, decision, valid until)
+        self.set_excluded_names(excluded_names)
+
+    @classmethod
+    def parse(cls, text, excluded_names=(), extensions=False):
+        return cls(split_rules(text), excluded_names, extensions)
+
+    def _add_limit(self, rule, kind, op, number, unit):
+        units = SIZE_UNITS if kind.lower() == 'size' else AGE_UNITS
+        try:
+            value = float(number) * units[unit.lower()]
+        except (KeyError, ValueError):
+            raise FilterError("Can't understand %s" % rule)
+        attr = ('max_' if op == '<' else 'min_') + kind.lower()
+        setattr(self, attr, value)
+
+    @property
+    def has_limits(self):
+        return not (self.min_size is None and self.max_size is None and
+                    self.min_age is None and self.max_age is None)
+
+    def set_excluded_names(self, names):
+        """Exact file names to always reject, e.g. the program's own files"""
+        names = set(name.lower() for name in names)
+        if names != self.excluded_names:
+            self.excluded_names = names
+            self.names.clear()
+
+    def match_name(self, name):
+        decision = self.names.get(name)
+        if decision is None:
+            decision = not (name.lower() in self.excluded_names or
+                            (self._exclude is not None and self._exclude.search(name)) or
+                            (self._include is not None and not self._include.search(name)))
+            if len(self.names) >= MAX_CACHED:
+                self.names.clear()
+            self.names[name] = decision
+        return decision
+
+    def matches(self, path, stat=None, now=None):
+        """Should path be accepted?
+
+        stat is an optional function returning the file's os.stat() (e.g.
+        a scandir entry's stat method); it is only called if a size or age
+        limit needs it.
+        """
+        if not self.match_name(os.path.basename(path)):
+            return False
+        if not self.has_limits:
+            return True
+        try:
+            st = stat() if stat is not None else os.stat(path)
+        except OSError:
+            return False
+        now = time.time() if now is None else now
+        cached = self.paths.get(path)
+        if (cached is not None and cached[0] == st.st_mtime and cached[1] == st.st_size
+                and now < cached[3]):
+            return cached[2]
+        decision, valid_until = self._check_limits(st, now)
+        if len(self.paths) >= MAX_CACHED:
+            self.paths.clear()
+        self.paths[path] = (st.st_mtime, st.st_size, decision, valid_until)
+        return decision
+
+    def _check_limits(self, st, now):
+        """Return the decision and how long it holds if the file doesn't change"""
+        size = st.st_size
+        if self.min_size is not None and size <= self.min_size:
+            return False, INFINITY
+        if self.max_size is not None and size >= self.max_size:
+            return False, INFINITY
+        age = now - st.st_mtime
+        if self.min_age is not None and age <= self.min_age:
+            return False, st.st_mtime + self.min_age  # Old enough after that
+        if self.max_age is not None:
+            if age >= self.max_age:
+                return False, INFINITY
+            return True, st.st_mtime + self.max_age
+        return True, INFINITY
+
+    def __str__(self):
+        return ', '.join(self.rules)
@@ -0,0 +1,146 @@
+"""Where received files are saved under the received folder.
+
+A layout is one or more of these levels, outermost first, joined with
+"/" (e.g. "sender/date"):
+
+- flat:   everything straight in the received folder
+- sender: a folder per sender IP
+- date:   a folder per day (YYYY-MM-DD)
+- hash:   two levels of 256 folders picked from a hash of the name, which
+          keeps any one folder small at hundreds of thousands of files
+
+When a file with the same name is already there it is either replaced
+(OVERWRITE) or the new file gets the first free name_N (KEEP).  Free
+names are claimed by creating the file exclusively, so two transfers
+can't pick the same one, and a per-name counter remembers where the
+last search ended.  Each collision costs a couple of existence checks
+instead of one per earlier copy; after a restart the counter is rebuilt
+with a galloping search, in O(log n) checks.
+
+Must stay Python 2.7 compatible.
+"""
+import errno
+import hashlib
+import os
+import threading
+import time
+
+import fileutil
+
+FLAT = 'flat'
+SENDER = 'sender'
+DATE = 'date'
+HASH = 'hash'
+LEVELS = (FLAT, SENDER, DATE, HASH)
+SCHEMES = ['flat', 'sender', 'date', 'hash', 'sender/date', 'date/sender', 'sender/hash']
+
+OVERWRITE = 'overwrite'
+KEEP = 'keep'
+
+COUNTER_CACHE_SIZE = 10000
+
+
+class LayoutError(ValueError):
+    """A layout scheme names a level we don't know"""
+
+
+def parse_scheme(scheme):
+    levels = [level.strip().lower() for level in (scheme or FLAT).split('/') if level.strip()]
+    for level in levels:
+        if level not in LEVELS:
+            raise LayoutError("Unknown layout level %r (use %s)" % (level, ", ".join(LEVELS)))
+    return [level for level in levels if level != FLAT]
+
+
+class Layout(object):
+    def __init__(self, root, scheme=FLAT, collisions=KEEP):
+        self.root = root
+        self.lock = threading.Lock()
+        self.made = set()    # Folders known to exist
+        self.counters = {}   # (folder, name) -> next suffix worth trying
+        self.configure(scheme, collisions)
+
+    def configure(self, scheme=None, collisions=None):
+        with self.lock:
+            if scheme is not None:
+                self.levels = parse_scheme(scheme)
+                self.scheme = scheme
+            if collisions is not None:
+                self.collisions = collisions
+
+    def directory(self, filename, sender=None, when=None):
+        """The folder filename belongs in, created if need be"""
+        parts = [self.root]
+        for level in self.levels:
+            if level == SENDER:
+                parts.append((sender or 'unknown').replace(':', '_'))  # IPv6
+            elif level == DATE:
+                parts.append(time.strftime('%Y-%m-%d', time.localtime(when)))
+            else:
+                digest = hashlib.md5(filename.encode('utf-8')).hexdigest()
+                parts.extend([digest[:2], digest[2:4]])
+        folder = os.path.join(*parts)
+        if folder not in self.made:
+            fileutil.ensure_dir(folder)
+            with self.lock:
+                self.made.add(folder)
+        return folder
+
+    def path_for(self, filename, sender=None):
+        """Where filename from sender goes now, ignoring collisions"""
+        return os.path.join(self.directory(filename, sender), filename)
+
+    def claim(self, filename, sender=None):
+        """Path to save filename at.
+
+        With KEEP an empty file is created there so nobody else takes the
+        name; the caller writes over it.
+        """
+        folder = self.directory(filename, sender)
+        path = os.path.join(folder, filename)
+        if self.collisions == OVERWRITE or _create(path):
+            return path
+        base, ext = os.path.splitext(filename)
+        key = (folder, filename)
+        with self.lock:
+            n = self.counters.get(key)
+        if n is None:
+            n = _first_gap(lambda i: os.path.exists(os.path.join(folder, "%s_%d%s" % (base, i, ext))))
+        while True:
+            path = os.path.join(folder, "%s_%d%s" % (base, n, ext))
+            if _create(path):
+                break
+            n += 1  # Taken since we looked, or a gap was filled by hand
+        with self.lock:
+            if len(self.counters) >= COUNTER_CACHE_SIZE:
+                self.counters.clear()
+            self.counters[key] = n + 1
+        return path
+
+
+def _create(path):
+    """Create path if it doesn't exist; False if it already did"""
+    try:
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, 'O_BINARY', 0))
+    except OSError as e:
+        if e.errno == errno.EEXIST:
+            return False
+        raise
+    os.close(fd)
+    return True
+
+
+def _first_gap(taken):
+    """Smallest n >= 1 with taken(n) false, assuming taken is true for 1..n-1"""
+    if not taken(1):
+        return 1
+    low, high = 1, 2
+    while taken(high):
+        low, high = high, high * 2
+    while high - low > 1:  # taken(low), not taken(high)
+        middle = (low + high) // 2
+        if taken(middle):
+            low = middle
+        else:
+            high = middle
+    return high
@@ -0,0 +1,531 @@
+"""Receive on many connections from one thread.
+
+The threaded receiver spends a thread, and its stack, on every
+connection.  On the old XP machine that limits how many senders it can
+serve at once and makes it fragile under load.  Receiver instead keeps a
+small state machine per connection and drives them all from one select()
+loop (or epoll/kqueue, where Python 3's selectors module has them):
+
+    first 8 bytes -> [key handshake] -> header -> body -> [ack -> header ...]
+
+Bodies are read with recv_into() into one shared buffer and written
+straight to their files, so a connection costs a few header bytes of
+memory however big its files are.  Connections over a bandwidth limit
+are parked until their turn comes instead of sleeping.  Disk writes
+still block the loop, as they would block a thread.
+
+Single files, sessions and the pre-shared key handshake are handled in
+the loop.  TLS, deltas, folder sync, streams and pulls need blocking code, so
+their connections are handed to a thread (see Receiver's handoff).  A
+file that won't fit on disk right away is refused rather than queued,
+since waiting for space would hold up every other connection.
+
+Must stay Python 2.7 compatible.
+"""
+import errno
+import hashlib
+import os
+import select
+import socket
+import time
+
+import auth
+import diskspace
+import protocol
+import secure
+import session
+import throttle
+
+try:
+    import selectors
+except ImportError:  # Python 2
+    selectors = None
+
+BUFFER_SIZE = 256 * 1024
+MAX_CONNECTIONS = 500   # select() on Windows can't watch more than 512 sockets
+IDLE_TIMEOUT = 30       # Seconds without a byte before a connection is dropped, as with threads
+TICK = 1.0              # How often idle and parked connections are looked at
+READS_PER_TURN = 16     # Body reads per connection before the others get a look in
+
+READ = 1
+WRITE = 2
+
+# What a connection is waiting for
+FIRST = 'first'            # 8 bytes: a filename length, a magic or the key handshake
+AUTH_NONCE = 'auth nonce'
+AUTH_MAC = 'auth mac'
+AUTHENTICATED = 'authenticated'  # The real first 8 bytes, after the handshake
+NAME_LENGTH = 'name length'
+NAME = 'name'
+SIZE = 'size'
+BODY = 'body'
+DRAIN = 'drain'            # A body we are reading but not keeping
+CLOSING = 'closing'        # Sending what is left, then closing
+
+_WOULD_BLOCK = (errno.EAGAIN, errno.EWOULDBLOCK, getattr(errno, 'WSAEWOULDBLOCK', errno.EAGAIN))
+
+
+class _Poller(object):
+    """Which sockets to watch for what: selectors where there is one, else select()"""
+
+    def __init__(self):
+        self.selector = selectors.DefaultSelector() if selectors else None
+        self.watched = {}  # fileno -> (socket, READ|WRITE, data)
+
+    def watch(self, sock, data, mask=READ):
+        fd = sock.fileno()
+        old = self.watched.get(fd)
+        if old is not None and old[1] == mask:
+            return
+        if self.selector:
+            if old is not None and old[1] and mask:
+                self.selector.modify(fd, mask, data)
+            elif old is not None and old[1]:
+                self.selector.unregister(fd)
+            elif mask:
+                self.selector.register(fd, mask, data)
+        self.watched[fd] = (sock, mask, data)
+
+    def forget(self, sock):
+        self.watch(sock, None, 0)
+        del self.watched[sock.fileno()]
+
+    def poll(self, timeout):
+        """[(data, READ|WRITE), ...] for the sockets that are ready"""
+        if not any(mask for _, mask, _ in self.watched.values()):
+            time.sleep(timeout)  # Windows' select() won't wait on nothing
+            return []
+        if self.selector:
+            return [(key.data, events) for key, events in self.selector.select(timeout)]
+        readers = [sock for sock, mask, _ in self.watched.values() if mask & READ]
+        writers = [sock for sock, mask, _ in self.watched.values() if mask & WRITE]
+        readable, writable, _ = select.select(readers, writers, [], timeout)
+        ready = {}
+        for sock in readable:
+            ready[sock.fileno()] = READ
+        for sock in writable:
+            ready[sock.fileno()] = ready.get(sock.fileno(), 0) | WRITE
+        return [(self.watched[fd][2], events) for fd, events in ready.items()]
+
+
+class Connection(object):
+    """One client's connection and the file it is part way through"""
+
+    def __init__(self, sock, addr):
+        self.sock = sock
+        self.addr = addr
+        self.client = addr[0]
+        self.state = FIRST
+        self.need = protocol.NAME_LENGTH_SIZE
+        self.inbuf = b''
+        self.outbuf = b''
+        self.session = False
+        self.seq = 0
+        self.nonces = None
+        self.last_active = time.time()
+        self.resume_at = None  # Parked by the bandwidth limit until then
+        # The file being received
+        self.filename = None
+        self.size = 0
+        self.remaining = 0
+        self.received = 0
+        self.status = None
+        self.path = None
+        self.file = None
+        self.flow = throttle.NULL_FLOW
+        self.reservation = None
+        self.digest = None
+        self.started = None
+
+
+class Receiver(object):
+    """Serve every connection to a listening socket from the calling thread.
+
+    claim(filename, client) picks the path to save a file at, and
+    record(client, path, size, status, started, sha256) is told about
+    every file received.  quotas is a quota.Quotas, space a
+    diskspace.DiskSpace and limiter a throttle.BandwidthManager, all
+    optional.  handoff(sock, addr, first) takes over a connection the
+    loop can't serve, as a blocking socket: first is None for TLS (nothing
+    has been read yet) or the 8 bytes read after any key handshake.
+    """
+
+    def __init__(self, server, claim, log=None, quotas=None, space=None, record=None,
+                 limiter=None, handoff=None, max_connections=MAX_CONNECTIONS):
+        self.server = server
+        self.claim = claim
+        self.log = log or (lambda message: None)
+        self.quotas = quotas
+        self.space = space
+        self.record = record
+        self.limiter = limiter
+        self.handoff = handoff
+        self.max_connections = max_connections
+        self.poller = _Poller()
+        self.connections = set()
+        self.parked = set()
+        self.buffer = bytearray(BUFFER_SIZE)
+        self.view = memoryview(self.buffer)
+        self.files = 0
+        self.bytes = 0
+        self.peak = 0
+        server.setblocking(False)
+        self.poller.watch(server, None)
+
+    def serve(self, running=lambda: True):
+        """Run until running() returns false, checking it every TICK seconds"""
+        last_tick = time.time()
+        while running():
+            timeout = TICK
+            if self.parked:
+                # Wake for the first parked connection, not a whole tick later
+                soonest = min(conn.resume_at for conn in self.parked)
+                timeout = max(0, min(TICK, soonest - time.time()))
+            for conn, events in self.poller.poll(timeout):
+                if conn is None:
+                    self._accept()
+                    continue
+                try:
+                    if events & WRITE:
+                        self._flush(conn)
+                    if events & READ and conn in self.connections:
+                        self._read(conn)
+                except Exception as e:
+                    self._fail(conn, e)
+            now = time.time()
+            if self.parked:
+                self._resume(now)
+            if now - last_tick >= TICK:
+                last_tick = now
+                self._expire(now)
+
+    def describe(self):
+        return "%d connections (peak %d), %d files, %.1f MB received" % (
+            len(self.connections), self.peak, self.files, self.bytes / 1048576.0)
+
+    # Connections coming and going
+
+    def _accept(self):
+        while True:
+            try:
+                sock, addr = self.server.accept()
+            except socket.error as e:
+                if e.args and e.args[0] in _WOULD_BLOCK:
+                    return
+                self.log("Error accepting connection: %s" % str(e))
+                return
+            if len(self.connections) >= self.max_connections:
+                self.log("Refused connection from %s - %d connections open" %
+                         (addr[0], len(self.connections)))
+                protocol.abort(sock)
+                continue
+            if self.quotas and not self.quotas.connect(addr[0]):
+                self.log("Refused connection from %s - too many open connections" % addr[0])
+                protocol.abort(sock)
+                continue
+            sock.setblocking(False)
+            conn = Connection(sock, addr)
+            self.connections.add(conn)
+            self.peak = max(self.peak, len(self.connections))
+            self.poller.watch(sock, conn)
+
+    def _close(self, conn, abort=False):
+        if conn not in self.connections:
+            return
+        if conn.file is not None:
+            self._end_file(conn, protocol.INCOMPLETE)
+        self.connections.discard(conn)
+        self.parked.discard(conn)
+        self.poller.forget(conn.sock)
+        if abort:
+            protocol.abort(conn.sock)
+        else:
+            conn.sock.close()
+        if self.quotas:
+            self.quotas.disconnect(conn.client)
+
+    def _fail(self, conn, error):
+        self.log("Error handling client %s: %s" % (conn.client, str(error)))
+        self._close(conn, abort=isinstance(error, auth.AuthError))
+
+    def _hand_off(self, conn, first):
+        """Give the connection to handoff, which now owns it (and its quota slot)"""
+        self.connections.discard(conn)
+        self.poller.forget(conn.sock)
+        if self.handoff is None:
+            self.log("Turned away %s - this receiver only takes plain files" % conn.client)
+            protocol.abort(conn.sock)
+            if self.quotas:
+                self.quotas.disconnect(conn.client)
+            return
+        conn.sock.setblocking(True)
+        conn.sock.settimeout(IDLE_TIMEOUT)
+        self.handoff(conn.sock, conn.addr, first)
+
+    def _expire(self, now):
+        for conn in list(self.connections):
+            if conn.resume_at is None and now - conn.last_active > IDLE_TIMEOUT:
+                self.log("Dropped %s - nothing received for %d seconds" % (conn.client, IDLE_TIMEOUT))
+                self._close(conn)
+            elif conn.state in (AUTH_NONCE, AUTH_MAC) and now - conn.last_active > auth.AUTH_TIMEOUT:
+                self._fail(conn, auth.AuthError("client took too long to authenticate"))
+
+    def _park(self, conn, delay):
+        conn.resume_at = time.time() + delay
+        self.parked.add(conn)
+        self.poller.watch(conn.sock, conn, WRITE if conn.outbuf else 0)
+
+    def _resume(self, now):
+        for conn in list(self.parked):
+            if conn.resume_at <= now:
+                self.parked.discard(conn)
+                conn.resume_at = None
+                conn.last_active = now
+                self.poller.watch(conn.sock, conn, READ | (WRITE if conn.outbuf else 0))
+
+    # Sending
+
+    def _send(self, conn, data, then_close=False):
+        conn.outbuf += data
+        if then_close:
+            conn.state = CLOSING
+        self._flush(conn)
+
+    def _flush(self, conn):
+        try:
+            while conn.outbuf:
+                sent = conn.sock.send(conn.outbuf)
+                conn.outbuf = conn.outbuf[sent:]
+        except socket.error as e:
+            if not (e.args and e.args[0] in _WOULD_BLOCK):
+                raise
+        if conn.outbuf:
+            self.poller.watch(conn.sock, conn, WRITE | (0 if conn.resume_at else READ))
+        elif conn.state == CLOSING:
+            self._close(conn)
+        elif conn.resume_at is None:
+            self.poller.watch(conn.sock, conn, READ)
+
+    # Receiving
+
+    def _read(self, conn):
+        if conn.state == FIRST and not conn.inbuf:
+            first = conn.sock.recv(1, socket.MSG_PEEK)
+            if first == secure.TLS_HANDSHAKE:
+                self._hand_off(conn, None)
+                return
+            if first and secure.settings.require:
+                self.log("Rejected plain connection from %s - TLS is required" % conn.client)
+                self._close(conn)
+                return
+        for _ in range(READS_PER_TURN):
+            if conn.state in (BODY, DRAIN):
+                if not self._read_body(conn):
+                    return
+                continue
+            if conn.state == CLOSING:
+                return
+            try:
+                data = conn.sock.recv(conn.need - len(conn.inbuf))
+            except socket.error as e:
+                if e.args and e.args[0] in _WOULD_BLOCK:
+                    return
+                raise
+            if not data:
+                self._close(conn)
+                return
+            conn.last_active = time.time()
+            conn.inbuf += data
+            if len(conn.inbuf) < conn.need:
+                return
+            field, conn.inbuf = conn.inbuf, b''
+            self._field(conn, field)
+            if conn not in self.connections:
+                return
+
+    def _expect(self, conn, state, need):
+        conn.state = state
+        conn.need = need
+
+    def _field(self, conn, field):
+        """A complete header field has arrived for conn's current state"""
+        state = conn.state
+        if state == FIRST:
+            if auth.enabled() or field == auth.AUTH_MAGIC:
+                if not auth.enabled():
+                    raise auth.AuthError("client tried to authenticate, but no key is set here")
+                if field != auth.AUTH_MAGIC:
+                    raise auth.AuthError("client didn't authenticate")
+                self._expect(conn, AUTH_NONCE, auth.NONCE_SIZE)
+            else:
+                self._start(conn, field)
+        elif state == AUTH_NONCE:
+            conn.nonces = (field, os.urandom(auth.NONCE_SIZE))
+            self._send(conn, auth.AUTH_MAGIC + conn.nonces[1])
+            self._expect(conn, AUTH_MAC, auth.MAC_SIZE)
+        elif state == AUTH_MAC:
+            self._send(conn, auth.server_proof(conn.nonces[0], conn.nonces[1], field))
+            self.log("Client %s authenticated" % conn.client)
+            self._expect(conn, AUTHENTICATED, protocol.NAME_LENGTH_SIZE)
+        elif state == AUTHENTICATED:
+            self._start(conn, field)
+        elif state == NAME_LENGTH:
+            name_length = protocol.decode_name_length(field)
+            if name_length == 0:
+                self.log("Session with %s finished after %d files" % (conn.client, conn.seq))
+                self._close(conn)
+            else:
+                self._expect(conn, NAME, name_length)
+        elif state == NAME:
+            conn.filename = field.decode('utf-8')
+            self._expect(conn, SIZE, protocol.FILE_SIZE_SIZE)
+        elif state == SIZE:
+            conn.size = int(field.decode('ascii'))
+            self._begin_file(conn)
+
+    def _start(self, conn, first):
+        """The connection's real first 8 bytes"""
+        if first == session.SESSION_MAGIC:
+            conn.session = True
+            self._send(conn, session.SESSION_MAGIC)
+            self._expect(conn, NAME_LENGTH, protocol.NAME_LENGTH_SIZE)
+        elif first.isdigit():
+            self._expect(conn, NAME, protocol.decode_name_length(first))
+        else:
+            self._hand_off(conn, first)
+
+    def _begin_file(self, conn):
+        client, name, size = conn.client, conn.filename, conn.size
+        conn.seq += 1
+        conn.remaining = size
+        conn.received = 0
+        conn.started = time.time()
+        if protocol.safe_filename(name) is None:
+            self.log("Rejected file with unsafe name from %s: %r" % (client, name))
+            self._reject(conn)
+            return
+
+        refusal = self.quotas.admit(client, size) if self.quotas else None
+        if refusal:
+            self.log("Refused %s from %s: %s" % (name, client, refusal))
+            self._refuse(conn, protocol.QUOTA)
+            return
+        reservation = self.space.reserve(size, wait=0) if self.space else None
+        if self.space and reservation is None:
+            self.log("Refused %s from %s: not enough disk space (%s)" %
+                     (name, client, self.space.describe()))
+            if self.quotas:
+                self.quotas.finish(client, size, 0)
+            self._refuse(conn, protocol.NO_SPACE)
+            return
+
+        try:
+            conn.path = self.claim(name, client)
+            conn.file = open(conn.path, 'wb')
+        except Exception as e:
+            self.log("Can't save %s from %s: %s" % (name, client, e))
+            if reservation:
+                reservation.release()
+            if self.quotas:
+                self.quotas.finish(client, size, 0)
+            self._reject(conn)
+            return
+        conn.flow = self.limiter.open_flow(client) if self.limiter else throttle.NULL_FLOW
+        conn.reservation = reservation
+        if reservation:
+            out = conn.file
+            reservation.flush = lambda: diskspace.flush_to_disk(out)
+        conn.digest = hashlib.sha256()
+        conn.status = protocol.OK
+        self._expect(conn, BODY, 0)
+        self.log("Receiving %s (%d bytes) from %s" % (name, size, client))
+        if not size:
+            self._end_file(conn, protocol.OK)
+
+    def _reject(self, conn):
+        """Read the body and throw it away, reporting REJECTED"""
+        conn.status = protocol.REJECTED
+        self._expect(conn, DRAIN, 0)
+        if not conn.size:
+            self._end_file(conn, protocol.REJECTED)
+
+    def _refuse(self, conn, status):
+        """Turn a file away before reading its body, which ends the connection"""
+        if conn.session:
+            self._send(conn, protocol.encode_ack(conn.seq, status, 0), then_close=True)
+        else:
+            self._close(conn, abort=True)  # Don't let the sender think it got through
+
+    def _read_body(self, conn):
+        """Read some of the body; False once there is nothing more to read for now"""
+        view = self.view[:conn.flow.chunk_size(BUFFER_SIZE)]
+        try:
+            n = conn.sock.recv_into(view, min(len(view), conn.remaining))
+        except socket.error as e:
+            if e.args and e.args[0] in _WOULD_BLOCK:
+                return False
+            raise
+        if not n:
+            self._close(conn)  # Ends the file as incomplete
+            return False
+        conn.last_active = time.time()
+        conn.remaining -= n
+        if conn.state == BODY:
+            try:
+                conn.file.write(view[:n])
+            except (IOError, OSError) as e:
+                if e.errno != errno.ENOSPC:
+                    raise
+                conn.status = protocol.DISK_FULL
+                conn.state = DRAIN
+            else:
+                conn.received += n
+                conn.digest.update(view[:n])
+                if conn.reservation:
+                    conn.reservation.wrote(n)
+        if not conn.remaining:
+            self._end_file(conn, conn.status)
+            return conn in self.connections
+        delay = conn.flow.charge(n)
+        if delay > 0:
+            self._park(conn, delay)
+            return False
+        return True
+
+    def _end_file(self, conn, status):
+        client, size, received = conn.client, conn.size, conn.received
+        if conn.file is not None:
+            conn.file.close()
+            conn.file = None
+            conn.flow.close()
+            conn.flow = throttle.NULL_FLOW
+            if conn.reservation:
+                conn.reservation.release()
+                conn.reservation = None
+            if self.quotas:
+                self.quotas.finish(client, size, received if status != protocol.DISK_FULL else 0)
+            if self.record:
+                self.record(client, conn.path, received, status, conn.started,
+                            conn.digest.hexdigest())
+            if status == protocol.OK:
+                self.files += 1
+                self.bytes += received
+                elapsed = time.time() - conn.started
+                self.log("File received successfully: %s (%.1f KB/s)" % (
+                    os.path.basename(conn.path), size / (elapsed if elapsed > 0 else 1) / 1024))
+            elif status == protocol.DISK_FULL:
+                self.log("Disk full - discarded %s (%d of %d bytes)" % (
+                    os.path.basename(conn.path), received, size))
+                os.remove(conn.path)
+            else:
+                self.log("Incomplete file received from %s: %s (%d of %d bytes)" % (
+                    client, os.path.basename(conn.path), received, size))
+        if status == protocol.INCOMPLETE:
+            return  # Only from _close(); the connection is already going
+        if conn.session:
+            self._send(conn, protocol.encode_ack(conn.seq, status, received))
+            self._expect(conn, NAME_LENGTH, protocol.NAME_LENGTH_SIZE)
+        elif status == protocol.OK:
+            self._send(conn, b'', then_close=True)  # Closing is the acknowledgement
+        else:
+            self._close(conn, abort=True)  # Don't let the sender think it got through
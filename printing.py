@@ -0,0 +1,570 @@
+"""Rendering received files for the printer, with a cache of the results.
+
+Handing a file to os.startfile(path, "print") opens a viewer for every
+job, one at a time.  When a printer language is chosen instead, each
+file is converted to it by a chain of converters and sent straight to
+the printer as a raw job:
+
+- Ghostscript turns PDF and PostScript into PostScript, PCL 5 or PCL 6,
+- text files become PostScript (no other program needed),
+- images become PDF first (needs the Pillow package).
+
+Converters run in a pool of worker processes, so big documents render
+in parallel and don't slow down receiving.  Jobs still reach the
+printer in the order they were submitted.
+
+The output is cached in CACHE_DIR under the SHA-256 of the source and
+the printer language, so printing an identical file again skips
+rendering.  The least recently used entries are deleted once the cache
+is over its size limit.  Files nothing can convert, and files whose
+conversion fails, go to the viewer as before.
+
+Must stay Python 2.7 compatible.
+"""
+import glob
+import hashlib
+import multiprocessing
+import os
+import pickle
+import subprocess
+import sys
+import threading
+import time
+
+try:
+    import queue
+except ImportError:  # Python 2
+    import Queue as queue
+
+import fileutil
+
+CACHE_DIR = '.print_cache'
+CACHE_BYTES = 512 * 1024 * 1024
+RENDER_VERSION = 1       # Bump when converters change what they produce
+SPOOL_CHUNK = 64 * 1024
+CONVERT_TIMEOUT = 300    # Seconds a converter program may run before it is killed
+RENDER_TIMEOUT = 1800    # Seconds from submit() before a rendering is given up on
+
+VIEWER = 'viewer'
+# Printer language -> (Ghostscript device, file extension)
+FORMATS = {
+    'postscript': ('ps2write', '.ps'),
+    'pcl5': ('ljet4', '.pcl'),
+    'pcl6': ('pxlmono', '.pxl'),
+    'pcl6-color': ('pxlcolor', '.pxl'),
+}
+FORMAT_NAMES = (VIEWER, 'postscript', 'pcl5', 'pcl6', 'pcl6-color')
+
+GHOSTSCRIPT_NAMES = ('gswin64c', 'gswin32c', 'gs')
+CREATE_NO_WINDOW = 0x08000000  # Keep console programs from flashing a window on Windows
+
+
+class ConvertError(Exception):
+    pass
+
+
+def find_program(names):
+    """Full path of the first of names found on PATH, or None"""
+    suffixes = [''] + (['.exe'] if sys.platform == 'win32' else [])
+    for directory in os.environ.get('PATH', '').split(os.pathsep):
+        for name in names:
+            for suffix in suffixes:
+                path = os.path.join(directory.strip('"'), name + suffix)
+                if os.path.isfile(path) and os.access(path, os.X_OK):
+                    return path
+    return None
+
+
+_ghostscript = []
+
+
+def find_ghostscript():
+    """The Ghostscript console program, or None; looked up once"""
+    if not _ghostscript:
+        path = find_program(GHOSTSCRIPT_NAMES)
+        if path is None and sys.platform == 'win32':
+            # The installer doesn't add itself to PATH
+            for root in (os.environ.get('ProgramFiles'), os.environ.get('ProgramFiles(x86)')):
+                if root:
+                    found = sorted(glob.glob(os.path.join(root, 'gs', 'gs*', 'bin', 'gswin*c.exe')))
+                    if found:
+                        path = found[-1]
+                        break
+        _ghostscript.append(path)
+    return _ghostscript[0]
+
+
+def run(command, timeout=CONVERT_TIMEOUT):
+    """Run a converter program, raising ConvertError with its complaint if it fails"""
+    flags = CREATE_NO_WINDOW if sys.platform == 'win32' else 0
+    process = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                               stderr=subprocess.STDOUT, creationflags=flags)
+    killed = []
+
+    def kill():
+        killed.append(True)
+        process.kill()
+    timer = threading.Timer(timeout, kill)  # communicate() has no timeout on Python 2
+    timer.daemon = True
+    timer.start()
+    try:
+        output = process.communicate()[0]
+    finally:
+        timer.cancel()
+    if killed:
+        raise ConvertError("%s took longer than %d s" % (os.path.basename(command[0]), timeout))
+    if process.returncode != 0:
+        raise ConvertError("%s exited with %d: %s" % (
+            os.path.basename(command[0]), process.returncode,
+            output.decode('utf-8', 'replace').strip()[-300:]))
+
+
+class Ghostscript(object):
+    """PDF and PostScript to a printer language"""
+    inputs = ('.pdf', '.ps', '.eps')
+
+    def __init__(self, device, output, resolution=300):
+        self.device = device
+        self.output = output
+        self.resolution = resolution
+        self.executable = find_ghostscript()
+
+    def available(self):
+        return self.executable is not None
+
+    def convert(self, source, target):
+        run([self.executable, '-q', '-dSAFER', '-dBATCH', '-dNOPAUSE',
+             '-sDEVICE=' + self.device, '-r%d' % self.resolution,
+             '-sOutputFile=' + target, source])
+
+
+class TextToPostScript(object):
+    """Plain text in Courier, sized to fit both A4 and Letter paper"""
+    inputs = ('.txt',)
+    output = '.ps'
+    PAGE_HEIGHT = 792  # Points; A4 is taller, Letter is wider
+    MARGIN = 36
+    FONT_SIZE = 10
+    LEADING = 12
+    COLUMNS = 87       # Courier is 0.6 em wide: (595 - 2 * 36) / 6
+    TAB_SIZE = 8
+
+    def available(self):
+        return True
+
+    def convert(self, source, target):
+        with open(source, 'rb') as f:
+            text = f.read().decode('utf-8', 'replace')
+        if text.startswith(u'\ufeff'):
+            text = text[1:]
+        lines_per_page = (self.PAGE_HEIGHT - 2 * self.MARGIN) // self.LEADING
+        pages = []
+        for page_text in text.replace(u'\r\n', u'\n').replace(u'\r', u'\n').split(u'\f'):
+            lines = []
+            for line in page_text.split(u'\n'):
+                line = line.expandtabs(self.TAB_SIZE)
+                lines.extend(line[i:i + self.COLUMNS]
+                             for i in range(0, max(len(line), 1), self.COLUMNS))
+            pages.extend(lines[i:i + lines_per_page]
+                         for i in range(0, max(len(lines), 1), lines_per_page))
+        out = [b'%!PS-Adobe-3.0', ('%%%%Pages: %d' % len(pages)).encode('ascii'),
+               b'%%EndComments',
+               b'/Courier findfont dup length dict begin',
+               b'{1 index /FID ne {def} {pop pop} ifelse} forall',
+               b'/Encoding ISOLatin1Encoding def currentdict end',
+               b'/Courier-Latin1 exch definefont pop',
+               ('/L { %d exch moveto show } def' % self.MARGIN).encode('ascii')]
+        for number, lines in enumerate(pages, 1):
+            out.append(('%%%%Page: %d %d' % (number, number)).encode('ascii'))
+            out.append(('/Courier-Latin1 findfont %d scalefont setfont' %
+                        self.FONT_SIZE).encode('ascii'))
+            y = self.PAGE_HEIGHT - self.MARGIN - self.FONT_SIZE
+            for line in lines:
+                if line.strip():
+                    escaped = line.replace(u'\\', u'\\\\').replace(u'(', u'\\(').replace(u')', u'\\)')
+                    out.append(b'(' + escaped.encode('latin-1', 'replace') +
+                               (') %d L' % y).encode('ascii'))
+                y -= self.LEADING
+            out.append(b'showpage')
+        out.append(b'%%EOF\n')
+        with open(target, 'wb') as f:
+            f.write(b'\n'.join(out))
+
+
+class ImageToPdf(object):
+    """Images to a one-page PDF that fits the paper"""
+    inputs = ('.png', '.jpg', '.jpeg', '.gif', '.bmp', '.tif', '.tiff')
+    output = '.pdf'
+
+    def available(self):
+        try:
+            __import__('PIL.Image')
+        except ImportError:
+            return False
+        return True
+
+    def convert(self, source, target):
+        from PIL import Image
+        image = Image.open(source)
+        if image.mode not in ('RGB', 'L'):
+            image = image.convert('RGB')
+        # Pixels per inch that fit it in 7.5 x 10 inches, never blown up
+        width, height = image.size
+        image.save(target, 'PDF', resolution=max(width / 7.5, height / 10.0, 72.0))
+
+
+def hash_file(path):
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def _render(steps, source, target):
+    """Run in a worker process: (SHA-256 of what was rendered, error or None)"""
+    try:
+        sha256 = hash_file(source)  # What is rendered, in case it changed since submit()
+        current = source
+        for number, step in enumerate(steps):
+            output = target if number == len(steps) - 1 else '%s.%d%s' % (target, number, step.output)
+            try:
+                step.convert(current, output)
+            finally:
+                if current != source:
+                    os.remove(current)
+            current = output
+        return sha256, None
+    except Exception as e:
+        return None, "%s: %s" % (type(e).__name__, e)
+
+
+class RenderCache(object):
+    """Rendered files by key, trimmed to max_bytes, least recently used first"""
+
+    def __init__(self, directory, max_bytes=CACHE_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.sizes = None   # Key -> bytes, read from disk on first use
+        self.pinned = {}    # Key -> jobs still waiting to print it
+
+    def _load(self):
+        if self.sizes is not None:
+            return
+        self.sizes = {}
+        fileutil.ensure_dir(self.directory)
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if name.endswith('.tmp') or '.tmp.' in name:
+                try:
+                    os.remove(path)  # Left by a render that never finished
+                except OSError:
+                    pass
+            elif os.path.isfile(path):
+                self.sizes[name] = os.path.getsize(path)
+
+    def path(self, key):
+        return os.path.join(self.directory, key)
+
+    def temp_path(self, key):
+        with self.lock:
+            self._load()
+        return self.path('%s.%d.%d.tmp' % (key, os.getpid(), id(threading.current_thread())))
+
+    def get(self, key, pin=False):
+        """Path of a cached rendering (marked as just used), or None"""
+        with self.lock:
+            self._load()
+            if key not in self.sizes:
+                return None
+            path = self.path(key)
+            try:
+                os.utime(path, None)
+            except OSError:
+                del self.sizes[key]
+                return None
+            if pin:
+                self.pinned[key] = self.pinned.get(key, 0) + 1
+            return path
+
+    def put(self, key, temp_path, pins=0):
+        """Move a finished rendering into the cache; returns its path"""
+        with self.lock:
+            self._load()
+            path = self.path(key)
+            fileutil.replace_file(temp_path, path)
+            self.sizes[key] = os.path.getsize(path)
+            if pins:
+                self.pinned[key] = self.pinned.get(key, 0) + pins
+            self._trim()
+            return path
+
+    def unpin(self, key):
+        with self.lock:
+            count = self.pinned.get(key, 0) - 1
+            if count > 0:
+                self.pinned[key] = count
+            else:
+                self.pinned.pop(key, None)
+            self._trim()
+
+    def resize(self, max_bytes):
+        with self.lock:
+            self.max_bytes = max_bytes
+            if self.sizes is not None:
+                self._trim()
+
+    def _trim(self):
+        total = sum(self.sizes.values())
+        if total <= self.max_bytes:
+            return
+        by_age = []
+        for key in self.sizes:
+            try:
+                by_age.append((os.path.getmtime(self.path(key)), key))
+            except OSError:
+                by_age.append((0, key))
+        for _, key in sorted(by_age):
+            if total <= self.max_bytes:
+                break
+            if key in self.pinned:
+                continue  # About to be printed
+            try:
+                os.remove(self.path(key))
+            except OSError:
+                pass
+            total -= self.sizes.pop(key)
+
+
+def spool(path, printer, title):
+    """Send a printer-ready file to a printer (None for the default) as a raw job"""
+    if sys.platform == 'win32':
+        import win32print
+        handle = win32print.OpenPrinter(printer or win32print.GetDefaultPrinter())
+        try:
+            win32print.StartDocPrinter(handle, 1, (title, None, 'RAW'))
+            try:
+                win32print.StartPagePrinter(handle)
+                with open(path, 'rb') as f:
+                    for chunk in iter(lambda: f.read(SPOOL_CHUNK), b''):
+                        win32print.WritePrinter(handle, chunk)
+                win32print.EndPagePrinter(handle)
+            finally:
+                win32print.EndDocPrinter(handle)
+        finally:
+            win32print.ClosePrinter(handle)
+    else:
+        lp = find_program(('lp',))
+        if lp is None:
+            raise ConvertError("no lp command to print with")
+        run([lp, '-s', '-o', 'raw', '-t', title] + (['-d', printer] if printer else []) + [path])
+
+
+def print_with_viewer(path, printer, title):
+    """Let the program registered for the file type print it (default printer only)"""
+    os.startfile(path, 'print')
+
+
+class Job(object):
+    def __init__(self, ticket, path, printer, done):
+        self.ticket = ticket
+        self.path = path
+        self.printer = printer
+        self.done = done
+        self.key = None
+        self.output = None   # Rendered file; None hands the original to the viewer
+        self.note = None     # How the output came about, for the log
+        self.started = time.time()
+
+
+class PrintPipeline(object):
+    """Turns received files into print jobs, rendering them in worker processes.
+
+    submit() returns straight away; done(ok, message) is called from the
+    pipeline's printing thread once the job has been handed to the
+    printer (or failed).
+    """
+
+    def __init__(self, base_dir, output_format=VIEWER, cache_bytes=CACHE_BYTES, workers=None,
+                 spool=spool, viewer=print_with_viewer):
+        self.cache = RenderCache(os.path.join(base_dir, CACHE_DIR), cache_bytes)
+        self.workers = workers or max(1, min(4, (multiprocessing.cpu_count() or 2) - 1))
+        self.spool = spool
+        self.viewer = viewer
+        self.extra_converters = []
+        self.lock = threading.Lock()
+        self.pool = None
+        self.rendering = {}   # Key -> jobs waiting for that rendering
+        self.ready = {}       # Ticket -> job rendered but waiting for earlier jobs
+        self.next_ticket = 0
+        self.next_to_print = 0
+        self.printing = queue.Queue()
+        self.printer_thread = None
+        self.configure(output_format)
+
+    def configure(self, output_format=None, cache_bytes=None):
+        """Arguments left as None keep their value"""
+        if output_format is not None:
+            if output_format != VIEWER and output_format not in FORMATS:
+                raise ValueError("Unknown printer language %r (choose from %s)" % (
+                    output_format, ", ".join(FORMAT_NAMES)))
+            with self.lock:
+                self.format = output_format
+        if cache_bytes is not None:
+            self.cache.resize(cache_bytes)
+
+    def register(self, converter):
+        """Add a converter (inputs, output, available(), convert(source, target)).
+
+        Registered converters are tried before the built-in ones.  They
+        run in worker processes, so they must be picklable.
+        """
+        with self.lock:
+            self.extra_converters.append(converter)
+
+    def converters(self):
+        device, extension = FORMATS[self.format]
+        return self.extra_converters + [Ghostscript(device, extension), TextToPostScript(),
+                                        ImageToPdf()]
+
+    def route(self, path):
+        """The converters that take path to the printer language, or None"""
+        if self.format == VIEWER:
+            return None
+        extension = os.path.splitext(path)[1].lower()
+        target = FORMATS[self.format][1]
+        converters = [c for c in self.converters() if c.available()]
+        for first in converters:
+            if extension in first.inputs:
+                if first.output == target:
+                    return [first]
+                for second in converters:
+                    if first.output in second.inputs and second.output == target:
+                        return [first, second]
+        return None
+
+    def submit(self, path, printer, done, sha256=None):
+        """Queue path for printing on printer (None for the default printer)"""
+        with self.lock:
+            job = Job(self.next_ticket, path, printer, done)
+            self.next_ticket += 1
+            steps = self.route(path)
+            output_format = self.format
+            if self.printer_thread is None:
+                self.printer_thread = threading.Thread(target=self._print_jobs)
+                self.printer_thread.daemon = True
+                self.printer_thread.start()
+        if steps is None:
+            if output_format != VIEWER:
+                job.note = "no converter for this type"
+            return self._ready(job)
+        try:
+            if sha256 is None:
+                sha256 = hash_file(path)
+        except (IOError, OSError) as e:
+            job.note = "can't read it: %s" % e
+            return self._ready(job)
+        job.key = '%s-%s-%d%s' % (sha256, output_format, RENDER_VERSION, steps[-1].output)
+        job.output = self.cache.get(job.key, pin=True)
+        if job.output is not None:
+            job.note = "cached"
+            return self._ready(job)
+        target = self.cache.temp_path(job.key)
+        try:
+            # A job the pool can't pickle would never be answered
+            pickle.dumps((steps, path, target), pickle.HIGHEST_PROTOCOL)
+        except Exception as e:
+            job.note = "can't render it: %s" % e
+            return self._ready(job)
+        with self.lock:
+            waiting = self.rendering.get(job.key)
+            if waiting is not None:
+                waiting.append(job)  # The same file is already being rendered
+                return
+            waiting = self.rendering[job.key] = [job]
+            if self.pool is None:
+                self.pool = multiprocessing.Pool(self.workers)
+            pool = self.pool
+        key = job.key
+
+        def finished(result):
+            watchdog.cancel()
+            self._rendered(key, target, result, waiting)
+        # A worker that dies (or a converter stuck past its timeout) never
+        # answers; without this every later job would wait behind it
+        watchdog = threading.Timer(RENDER_TIMEOUT, finished, [(
+            None, "no result after %d s" % RENDER_TIMEOUT)])
+        watchdog.daemon = True
+        watchdog.start()
+        options = {'callback': finished}
+        if sys.version_info[0] >= 3:
+            options['error_callback'] = lambda e: finished((None, "%s: %s" % (type(e).__name__, e)))
+        pool.apply_async(_render, (steps, path, target), **options)
+
+    def _rendered(self, key, target, result, waiting):
+        """Called in the pool's result thread (or the watchdog's) once a rendering finished"""
+        sha256, error = result
+        with self.lock:
+            # Nobody is waiting for a result that comes after the watchdog gave up
+            jobs = self.rendering.pop(key) if self.rendering.get(key) is waiting else []
+        output = None
+        if error is None:
+            if sha256 != key.split('-', 1)[0]:
+                # The file changed after it was hashed; keep it under what was rendered
+                key = sha256 + '-' + key.split('-', 1)[1]
+            try:
+                output = self.cache.put(key, target, pins=len(jobs))
+            except (IOError, OSError) as e:
+                error = "caching failed: %s" % e
+        if output is None and os.path.exists(target):
+            os.remove(target)
+        for job in jobs:
+            job.key = key if output else None
+            job.output = output
+            job.note = "rendered in %.1f s" % (time.time() - job.started) if output else (
+                "rendering failed, %s" % error)
+            self._ready(job)
+
+    def _ready(self, job):
+        """Print jobs in the order they were submitted, whenever they are ready"""
+        with self.lock:
+            self.ready[job.ticket] = job
+            while self.next_to_print in self.ready:
+                self.printing.put(self.ready.pop(self.next_to_print))
+                self.next_to_print += 1
+
+    def _print_jobs(self):
+        while True:
+            job = self.printing.get()
+            if job is None:
+                return
+            name = os.path.basename(job.path)
+            where = job.printer or "default printer"
+            try:
+                if job.output is not None:
+                    self.spool(job.output, job.printer, name)
+                    message = "Sent %s to %s (%s)" % (name, where, job.note)
+                else:
+                    self.viewer(job.path, job.printer, name)
+                    message = "Sent %s to default printer%s" % (
+                        name, " (%s)" % job.note if job.note else "")
+                ok = True
+            except Exception as e:
+                ok, message = False, "Error printing %s: %s" % (name, e)
+            finally:
+                if job.output is not None:
+                    self.cache.unpin(job.key)
+            try:
+                job.done(ok, message)
+            except Exception:
+                pass
+
+    def close(self):
+        """Stop the workers; jobs not yet printed are dropped"""
+        with self.lock:
+            pool, self.pool = self.pool, None
+            if self.printer_thread is not None:
+                self.printing.put(None)
+        if pool is not None:
+            pool.terminate()
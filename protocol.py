@@ -0,0 +1,218 @@
+"""Wire protocol helpers shared by the GUI and the simple XP sender.
+
+A transfer is an 8 byte ASCII filename length, the UTF-8 filename, a
+16 byte ASCII file size and then the raw file bytes.  The receiver closes
+the connection once it has read the whole body.
+
+This module must stay Python 2.7 compatible so simpleXP_file_sender.py
+can keep running on the XP machine.
+"""
+import os
+import socket
+import struct
+import sys
+
+import auth
+import secure
+import tuning
+
+PORT = 25565
+NAME_LENGTH_SIZE = 8
+MAX_NAME_LENGTH = 32768  # Longer names are refused before they are read
+FILE_SIZE_SIZE = 16
+CONNECT_TIMEOUT = 30
+
+# Per-file outcomes reported by receivers
+OK = 'ok'
+INCOMPLETE = 'incomplete'
+DISK_FULL = 'diskfull'
+REJECTED = 'rejected'
+MISMATCH = 'mismatch'  # A rebuilt file didn't match the sender's checksum
+QUOTA = 'quota'        # Refused by a size or quota limit; the body was never read
+NO_SPACE = 'nospace'   # Refused because it wouldn't fit on disk; the body was never read
+NEXT_HOP = 'nexthop'   # A relay couldn't pass the file on to the next host
+
+UNREAD = (QUOTA, NO_SPACE)  # Refusals sent before the body, which end a session
+
+ACK_SIZE = 32
+
+
+class ProtocolError(Exception):
+    """Raised when the other side sends something we can't understand"""
+
+
+def encode_name(filename):
+    """Build the name length and name part of a header"""
+    name_bytes = filename.encode('utf-8')
+    return str(len(name_bytes)).zfill(NAME_LENGTH_SIZE).encode('ascii') + name_bytes
+
+
+def decode_name_length(field):
+    """Decode a name length field, refusing lengths no real file name needs"""
+    length = int(field.decode('ascii'))
+    if not 0 <= length <= MAX_NAME_LENGTH:
+        raise ProtocolError("Filename of %d bytes is too long" % length)
+    return length
+
+
+def encode_header(filename, filesize):
+    """Build the name length, name and size header for a transfer"""
+    size_bytes = str(filesize).zfill(FILE_SIZE_SIZE).encode('ascii')
+    return encode_name(filename) + size_bytes
+
+
+def encode_ack(seq, status, received):
+    """Per-file acknowledgement: sequence number, status and bytes written"""
+    return ("%08d%-8s%016d" % (seq, status, received)).encode('ascii')
+
+
+def decode_ack(data):
+    text = data.decode('ascii')
+    return int(text[:8]), text[8:16].strip(), int(text[16:])
+
+
+def recv_exact(sock, size):
+    """Read exactly size bytes, raising ProtocolError if the peer disconnects"""
+    parts = []
+    remaining = size
+    while remaining > 0:
+        chunk = sock.recv(remaining)
+        if not chunk:
+            raise ProtocolError("Connection closed after %d of %d bytes" %
+                                (size - remaining, size))
+        parts.append(chunk)
+        remaining -= len(chunk)
+    return b''.join(parts)
+
+
+def drain(sock, size, chunk_size=32768):
+    """Read and discard size bytes so the stream stays in sync; returns bytes read"""
+    drained = 0
+    while drained < size:
+        chunk = sock.recv(min(chunk_size, size - drained))
+        if not chunk:
+            break
+        drained += len(chunk)
+    return drained
+
+
+def safe_filename(filename):
+    """Return filename if it is a plain file name, or None if it tries to leave the folder"""
+    name = filename.replace('\\', '/')
+    if (not name or '/' in name or name in ('.', '..') or ':' in name
+            or os.path.basename(name) != name):
+        return None
+    return name
+
+
+def parse_destinations(text, default_port=PORT):
+    """Parse "ip[:port], ip[:port], ..." into a list of (ip, port) tuples"""
+    destinations = []
+    for item in text.replace(';', ',').split(','):
+        item = item.strip()
+        if not item:
+            continue
+        host = item
+        port = default_port
+        if ':' in item:
+            host, port_text = item.rsplit(':', 1)
+            try:
+                port = int(port_text)
+            except ValueError:
+                raise ValueError("Invalid port in destination: %s" % item)
+        if port < 1 or port > 65535:
+            raise ValueError("Invalid port in destination: %s" % item)
+        if (host, port) not in destinations:
+            destinations.append((host.strip(), port))
+    return destinations
+
+
+def connect(host, port, timeout=CONNECT_TIMEOUT):
+    """Open a client connection to a receiver, over TLS if secure.py is set to"""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.settimeout(timeout)
+    try:
+        tuning.connect(sock, host, port)
+    except Exception:
+        sock.close()
+        raise
+    return start_client(sock, host, port)
+
+
+def start_client(sock, host, port):
+    """Start TLS and authenticate on a freshly connected socket, as configured"""
+    sock = secure.wrap_client(sock, host, port)
+    try:
+        auth.client_handshake(sock)
+    except Exception:
+        sock.close()
+        raise
+    return sock
+
+
+def abort(sock):
+    """Close with a reset rather than a clean EOF.
+
+    Old senders take a clean close as "the receiver has the whole file",
+    so anything we refuse must be reset instead.
+    """
+    try:
+        linger = struct.pack('HH' if os.name == 'nt' else 'ii', 1, 0)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, linger)
+    except (socket.error, AttributeError):
+        pass
+    sock.close()
+
+
+def wait_for_close(sock):
+    """Half-close our side and wait for the receiver to hang up.
+
+    The receiver only closes once it has read the full body, so a clean
+    EOF here is the closest thing the basic protocol has to an
+    acknowledgement.
+    """
+    if not secure.is_tls(sock):  # TLS can't half-close; the receiver hangs up anyway
+        try:
+            sock.shutdown(socket.SHUT_WR)
+        except socket.error:
+            pass
+    while True:
+        try:
+            data = sock.recv(4096)
+        except socket.error as e:
+            if secure.is_eof(e):
+                return
+            raise
+        if not data:
+            return
+
+
+# Every module the two programs ship with, whether or not this one imports it
+PROGRAM_MODULES = (
+    'auth', 'catalog', 'delta', 'diskspace', 'fastio', 'file_index', 'file_transfer',
+    'fileutil', 'filters', 'layout', 'multiplex', 'printing', 'protocol', 'pull',
+    'quota', 'relay', 'replicate', 'scheduler', 'secure', 'send_queue', 'session',
+    'simpleXP_file_sender', 'stream', 'throttle', 'tree_sync', 'tuning',
+)
+
+
+def own_files(base_dir):
+    """Names of the program's own modules that live in base_dir.
+
+    The watchers send everything dropped next to the program, so they use
+    this to avoid shipping our helper modules to the receiver.
+    """
+    base_dir = os.path.normcase(os.path.abspath(base_dir))
+    names = set(module + suffix for module in PROGRAM_MODULES
+                for suffix in ('.py', '.pyc', '.pyo'))
+    for module in list(sys.modules.values()):
+        path = getattr(module, '__file__', None)
+        if not path:
+            continue
+        path = os.path.abspath(path)
+        if os.path.normcase(os.path.dirname(path)) == base_dir:
+            name = os.path.basename(path)
+            names.add(name)
+            if name.endswith(('.pyc', '.pyo')):
+                names.add(name[:-1])
+    return names
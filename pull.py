@@ -0,0 +1,498 @@
+"""Clients fetching the files a host publishes, instead of being sent them.
+
+A host can publish a folder.  It keeps an index of the folder in memory
+(size, mtime, SHA-256 and the generation each file last changed in),
+saved as INDEX_NAME inside it.  The folder is rescanned at most every
+RESCAN_INTERVAL seconds however many clients ask, and only new or
+changed files are hashed, so listing costs clients nothing on the
+host's disk.  Files modified in the last SETTLE_TIME seconds are left
+for the next scan, as they are probably still being written.
+
+Wire exchange, after the 8 byte PULL_MAGIC (and TLS and the key check,
+as for any connection):
+
+    host -> client   PULL_MAGIC
+    client -> host   request: 16 digit length and JSON
+    host -> client   reply: 16 digit length and zlib'd JSON, then for
+                     reads that many raw bytes
+    ... as many requests as the client likes, then it hangs up
+
+Requests are
+
+    {"op": "list", "epoch": e, "since": g, "wait": s}
+        Files changed since generation g ({"files": {name: [size,
+        sha256]}, "removed": [names]}), or everything ("full": true) if
+        the host can't tell (a different epoch, or g is too old).  With
+        wait the host holds the answer up to s seconds until something
+        changes, so a watching client is told about new files straight
+        away over one idle connection.
+    {"op": "read", "name": n, "sha256": h, "offset": o, "length": l}
+        l bytes of n from offset o ({"status": "ok", "length": l}), or
+        {"status": "changed"} if n is no longer the file with hash h.
+
+Clients keep what they were told in STATE_NAME in the folder they pull
+into.  They download only files they don't already have with the same
+size and hash, into a PARTIAL_SUFFIX file that a later pull resumes with
+a ranged read.  Every file is checked against its hash before it is
+given its name.  Files removed from the publish folder are left alone on
+the clients.
+
+Command line:
+
+    python pull.py 192.168.1.5 [--into folder] [--watch] [--tls] [--key KEY]
+
+Must stay Python 2.7 compatible.
+"""
+import hashlib
+import json
+import os
+import socket
+import stat
+import sys
+import threading
+import time
+import uuid
+import zlib
+
+import auth
+import fastio
+import fileutil
+import protocol
+import secure
+import throttle
+
+PULL_MAGIC = b'FTPULL01'
+INDEX_NAME = '.publish_index.json'
+STATE_NAME = '.pull_state.json'
+PARTIAL_SUFFIX = '.ftpull_part'
+LENGTH_SIZE = 16
+RESCAN_INTERVAL = 2.0        # Requests within this long share one scan of the folder
+SETTLE_TIME = 2.0            # Files modified more recently than this aren't published yet
+WAIT = 60                    # Seconds a watching client waits for changes per request
+MAX_WAIT = 300
+MAX_REQUEST = 64 * 1024      # Hosts hang up on longer requests
+MAX_REMOVED = 10000          # Removals remembered for incremental listings
+CHUNK_SIZE = 65536
+HASH_BLOCK = 1024 * 1024
+RETRY_DELAY = 10             # Seconds before a watching client reconnects
+
+CHANGED = 'changed'
+
+
+class PullUnsupported(Exception):
+    """The host doesn't publish anything"""
+
+
+def file_hash(path, digest=None):
+    digest = digest or hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(HASH_BLOCK), b''):
+            digest.update(block)
+    return digest
+
+
+def _send_blob(sock, value, compress=False):
+    data = json.dumps(value).encode('utf-8')
+    if compress:
+        data = zlib.compress(data)
+    sock.sendall(str(len(data)).zfill(LENGTH_SIZE).encode('ascii') + data)
+
+
+def _recv_blob(sock, limit=None, compressed=False):
+    length = int(protocol.recv_exact(sock, LENGTH_SIZE).decode('ascii'))
+    if limit is not None and length > limit:
+        raise protocol.ProtocolError("Request of %d bytes is too long" % length)
+    data = protocol.recv_exact(sock, length)
+    return json.loads((zlib.decompress(data) if compressed else data).decode('utf-8'))
+
+
+# Host side ----------------------------------------------------------------
+
+class Publisher(object):
+    """The files in one folder, as clients see them"""
+
+    def __init__(self, directory, log=None):
+        self.directory = fileutil.ensure_dir(directory)
+        self.index_path = os.path.join(directory, INDEX_NAME)
+        self.log = log or (lambda message: None)
+        self.lock = threading.Lock()
+        self.changed = threading.Condition(self.lock)
+        self.scan_lock = threading.Lock()
+        self.files = {}          # Name -> [size, mtime, sha256, generation]
+        self.removed = {}        # Name -> generation it was removed in
+        self.horizon = 0         # Removals up to this generation are forgotten
+        self.epoch = uuid.uuid4().hex
+        self.generation = 0
+        self.scanned = 0
+        self._load()
+
+    def _load(self):
+        try:
+            with open(self.index_path, 'rb') as f:
+                saved = json.loads(f.read().decode('utf-8'))
+            self.files = dict((name, list(entry)) for name, entry in saved['files'].items())
+            self.removed = dict(saved.get('removed', {}))
+            self.horizon = saved.get('horizon', 0)
+            self.epoch, self.generation = saved['epoch'], saved['generation']
+        except (IOError, OSError, ValueError, KeyError, TypeError):
+            pass  # Start a new epoch; clients get a full listing
+
+    def _save(self):
+        data = {'epoch': self.epoch, 'generation': self.generation, 'files': self.files,
+                'removed': self.removed, 'horizon': self.horizon}
+        try:
+            fileutil.atomic_write(self.index_path, json.dumps(data).encode('utf-8'))
+        except (IOError, OSError) as e:
+            self.log("Can't save the publish index: %s" % e)
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+    def refresh(self):
+        """Rescan the folder unless that was done in the last RESCAN_INTERVAL seconds"""
+        with self.scan_lock:
+            now = time.time()
+            if now - self.scanned < RESCAN_INTERVAL:
+                return
+            with self.lock:
+                known = dict(self.files)
+            found, changes = set(), {}
+            for name in os.listdir(self.directory):
+                if name.startswith('.') or name.endswith(PARTIAL_SUFFIX):
+                    continue
+                try:
+                    st = os.stat(self.path(name))
+                except OSError:
+                    continue
+                if not stat.S_ISREG(st.st_mode):
+                    continue
+                found.add(name)
+                entry = known.get(name)
+                if entry is not None and entry[0] == st.st_size and entry[1] == st.st_mtime:
+                    continue
+                if now - st.st_mtime < SETTLE_TIME:
+                    continue  # Still being written; the old entry (if any) stands for now
+                try:
+                    changes[name] = [st.st_size, st.st_mtime,
+                                     file_hash(self.path(name)).hexdigest()]
+                except (IOError, OSError):
+                    continue
+            gone = [name for name in known if name not in found]
+            self.scanned = time.time()
+            if not changes and not gone:
+                return
+            with self.lock:
+                self.generation += 1
+                for name, entry in changes.items():
+                    self.files[name] = entry + [self.generation]
+                    self.removed.pop(name, None)
+                for name in gone:
+                    del self.files[name]
+                    self.removed[name] = self.generation
+                if len(self.removed) > MAX_REMOVED:
+                    oldest = sorted(self.removed, key=self.removed.get)
+                    for name in oldest[:len(self.removed) - MAX_REMOVED]:
+                        self.horizon = max(self.horizon, self.removed.pop(name))
+                self._save()
+                self.changed.notify_all()
+            self.log("Published folder: %d new or changed, %d removed (generation %d)" %
+                     (len(changes), len(gone), self.generation))
+
+    def listing(self, epoch=None, since=0, wait=0):
+        """What changed since generation since, waiting up to wait seconds for a change"""
+        self.refresh()
+        deadline = time.time() + wait
+        with self.lock:
+            current = epoch == self.epoch and self.horizon <= since <= self.generation
+            while current and self.generation <= since and time.time() < deadline:
+                self.lock.release()
+                try:
+                    self.refresh()
+                finally:
+                    self.lock.acquire()
+                if self.generation <= since:
+                    self.changed.wait(min(RESCAN_INTERVAL, max(deadline - time.time(), 0)))
+            full = not current
+            return {
+                'epoch': self.epoch,
+                'generation': self.generation,
+                'full': full,
+                'files': dict((name, entry[:1] + entry[2:3]) for name, entry in self.files.items()
+                              if full or entry[3] > since),
+                'removed': [] if full else [name for name, generation in self.removed.items()
+                                            if generation > since],
+            }
+
+    def lookup(self, name):
+        with self.lock:
+            entry = self.files.get(name)
+            return list(entry) if entry is not None else None
+
+
+def serve_pull(sock, publisher, log=None, flow_factory=None):
+    """Host side; called after PULL_MAGIC has been read.  Returns the bytes sent."""
+    log = log or (lambda message: None)
+    sock.sendall(PULL_MAGIC)
+    sent = 0
+    timeout = sock.gettimeout()
+    while True:
+        try:
+            request = _recv_blob(sock, MAX_REQUEST)
+        except (protocol.ProtocolError, socket.error):
+            return sent  # The client is done
+        op = request.get('op')
+        if op == 'list':
+            wait = min(max(float(request.get('wait') or 0), 0), MAX_WAIT)
+            reply = publisher.listing(request.get('epoch'), int(request.get('since') or 0), wait)
+            _send_blob(sock, reply, compress=True)
+        elif op == 'read':
+            sent += _serve_read(sock, publisher, request, log, flow_factory)
+        else:
+            log("Unknown pull request %r" % op)
+            return sent
+        sock.settimeout(timeout)
+
+
+def _serve_read(sock, publisher, request, log, flow_factory):
+    name = request.get('name')
+    entry = publisher.lookup(name) if protocol.safe_filename(name or '') else None
+    try:
+        st = os.stat(publisher.path(name)) if entry is not None else None
+    except OSError:
+        st = None
+    if (st is None or entry[2] != request.get('sha256') or
+            (st.st_size, st.st_mtime) != (entry[0], entry[1])):
+        _send_blob(sock, {'status': CHANGED}, compress=True)
+        return 0
+    offset = max(int(request.get('offset') or 0), 0)
+    length = max(min(int(request.get('length') or 0), st.st_size - offset), 0)
+    _send_blob(sock, {'status': protocol.OK, 'length': length}, compress=True)
+    flow = flow_factory() if flow_factory else throttle.NULL_FLOW
+    try:
+        sent = fastio.send_body(sock, publisher.path(name), length, flow, offset=offset)
+    finally:
+        flow.close()
+    if sent < length:
+        raise protocol.ProtocolError("%s shrank while being read" % name)
+    return sent
+
+
+# Client side --------------------------------------------------------------
+
+def open_pull(host, port, timeout=protocol.CONNECT_TIMEOUT):
+    """Connect to a host's published folder; raises PullUnsupported if it has none"""
+    sock = protocol.connect(host, port, timeout)
+    try:
+        sock.sendall(PULL_MAGIC)
+        try:
+            reply = protocol.recv_exact(sock, len(PULL_MAGIC))
+        except (protocol.ProtocolError, socket.error):
+            raise PullUnsupported("%s:%d doesn't publish a folder" % (host, port))
+        if reply != PULL_MAGIC:
+            raise protocol.ProtocolError("Unexpected pull reply: %r" % reply)
+    except Exception:
+        sock.close()
+        raise
+    return sock
+
+
+class Puller(object):
+    """Keeps a local folder up to date with the files one host publishes"""
+
+    def __init__(self, host, port, into_dir, log=None, limiter=None):
+        self.host = host
+        self.port = port
+        self.into_dir = fileutil.ensure_dir(into_dir)
+        self.state_path = os.path.join(into_dir, STATE_NAME)
+        self.log = log or (lambda message: None)
+        self.limiter = limiter
+        self.key = "%s:%d" % (host, port)
+        self.state = self._load()
+
+    def _load(self):
+        try:
+            with open(self.state_path, 'rb') as f:
+                state = json.loads(f.read().decode('utf-8'))
+        except (IOError, OSError, ValueError):
+            state = {}
+        state.setdefault('hosts', {})
+        state.setdefault('local', {})    # Name -> [size, mtime, sha256] of our copies
+        state.setdefault('partial', {})  # Name -> sha256 its partial file is a download of
+        state['hosts'].setdefault(self.key, {'epoch': None, 'generation': 0, 'files': {}})
+        return state
+
+    def _save(self):
+        fileutil.atomic_write(self.state_path, json.dumps(self.state).encode('utf-8'))
+
+    @property
+    def remote(self):
+        return self.state['hosts'][self.key]
+
+    def sync(self, sock, wait=0):
+        """Bring the listing up to date and download what's missing; returns (got, failed)"""
+        remote = self.remote
+        sock.settimeout(wait + protocol.CONNECT_TIMEOUT)
+        _send_blob(sock, {'op': 'list', 'epoch': remote['epoch'],
+                          'since': remote['generation'], 'wait': wait})
+        reply = _recv_blob(sock, compressed=True)
+        sock.settimeout(protocol.CONNECT_TIMEOUT)
+        if reply['full']:
+            remote['files'] = {}
+        for name in reply['removed']:
+            remote['files'].pop(name, None)
+        remote['files'].update(reply['files'])
+        remote['epoch'], remote['generation'] = reply['epoch'], reply['generation']
+        self._save()
+        got = failed = 0
+        for name in sorted(remote['files']):
+            size, sha256 = remote['files'][name]
+            if (protocol.safe_filename(name) is None or name.startswith('.') or
+                    self._have(name, size, sha256)):
+                continue
+            if self._download(sock, name, size, sha256):
+                got += 1
+            else:
+                failed += 1
+        return got, failed
+
+    def _have(self, name, size, sha256):
+        path = os.path.join(self.into_dir, name)
+        try:
+            st = os.stat(path)
+        except OSError:
+            return False
+        if st.st_size != size:
+            return False
+        known = self.state['local'].get(name)
+        if known is None or known[:2] != [st.st_size, st.st_mtime]:
+            known = [st.st_size, st.st_mtime, file_hash(path).hexdigest()]
+            self.state['local'][name] = known
+            self._save()
+        return known[2] == sha256
+
+    def _download(self, sock, name, size, sha256):
+        path = os.path.join(self.into_dir, name)
+        partial = path + PARTIAL_SUFFIX
+        digest = hashlib.sha256()
+        offset = 0
+        if self.state['partial'].get(name) == sha256 and os.path.exists(partial):
+            offset = min(os.path.getsize(partial), size)
+            file_hash(partial, digest)
+        else:
+            self.state['partial'][name] = sha256
+            self._save()
+            with open(partial, 'wb'):
+                pass
+        if offset:
+            self.log("Resuming %s at %d of %d bytes" % (name, offset, size))
+        _send_blob(sock, {'op': 'read', 'name': name, 'sha256': sha256,
+                          'offset': offset, 'length': size - offset})
+        reply = _recv_blob(sock, compressed=True)
+        if reply['status'] != protocol.OK:
+            self.log("%s changed on the host; it will be fetched again" % name)
+            return False
+        flow = self.limiter.open_flow(self.host) if self.limiter else throttle.NULL_FLOW
+        started = time.time()
+        try:
+            with open(partial, 'r+b') as f:
+                f.seek(offset)
+                f.truncate()
+                remaining = reply['length']
+                block = flow.chunk_size(CHUNK_SIZE)
+                while remaining > 0:
+                    data = sock.recv(min(block, remaining))
+                    if not data:
+                        raise protocol.ProtocolError("Connection closed with %d bytes of %s to go"
+                                                     % (remaining, name))
+                    f.write(data)
+                    digest.update(data)
+                    remaining -= len(data)
+                    flow.throttle(len(data))
+        finally:
+            flow.close()
+        del self.state['partial'][name]
+        if digest.hexdigest() != sha256:
+            os.remove(partial)
+            self._save()
+            self.log("%s didn't match its hash; it will be fetched again" % name)
+            return False
+        fileutil.replace_file(partial, path)
+        st = os.stat(path)
+        self.state['local'][name] = [st.st_size, st.st_mtime, sha256]
+        self._save()
+        elapsed = time.time() - started
+        self.log("Pulled %s (%d bytes, %.1f KB/s)" % (
+            name, size, (size - offset) / 1024.0 / (elapsed if elapsed > 0 else 1)))
+        return True
+
+    def pull(self):
+        """Fetch everything new once; returns (got, failed)"""
+        sock = open_pull(self.host, self.port)
+        try:
+            return self.sync(sock)
+        finally:
+            sock.close()
+
+    def watch(self, should_continue=None):
+        """Stay connected and fetch new files as soon as the host publishes them"""
+        while should_continue is None or should_continue():
+            try:
+                sock = open_pull(self.host, self.port)
+            except PullUnsupported:
+                raise
+            except (socket.error, protocol.ProtocolError) as e:
+                self.log("Can't reach %s: %s" % (self.key, e))
+                time.sleep(RETRY_DELAY)
+                continue
+            try:
+                wait = 0  # Catch up first, then wait for changes
+                while should_continue is None or should_continue():
+                    self.sync(sock, wait)
+                    wait = WAIT
+            except (socket.error, protocol.ProtocolError, ValueError, KeyError) as e:
+                self.log("Lost %s: %s" % (self.key, e))
+                time.sleep(RETRY_DELAY)
+            finally:
+                sock.close()
+
+
+def main(argv=None):
+    import argparse
+    parser = argparse.ArgumentParser(description="Fetch the files a host publishes")
+    parser.add_argument('source', help="ip[:port] of the host")
+    parser.add_argument('--into', default=os.path.join(
+        os.path.dirname(os.path.abspath(__file__)), 'received'),
+        help="Folder to keep them in (default: received/ next to this program)")
+    parser.add_argument('--watch', action='store_true',
+                        help="Keep fetching new files as they are published")
+    parser.add_argument('--tls', action='store_true', help="Encrypt the transfers")
+    parser.add_argument('--key', default=os.environ.get('FT_AUTH_KEY', ''),
+                        help="Pre-shared key (default: $FT_AUTH_KEY)")
+    parser.add_argument('--limit', type=float, default=0, help="Bandwidth limit in KB/s")
+    args = parser.parse_args(argv)
+
+    host, port = protocol.parse_destinations(args.source)[0]
+    secure.configure(os.path.dirname(os.path.abspath(__file__)), enabled=args.tls)
+    auth.configure(args.key)
+
+    def log(message):
+        sys.stderr.write("%s\n" % message)
+    puller = Puller(host, port, args.into, log,
+                    throttle.BandwidthManager(int(args.limit * 1024)))
+    try:
+        if args.watch:
+            puller.watch()
+            return 0
+        got, failed = puller.pull()
+    except PullUnsupported as e:
+        log(str(e))
+        return 2
+    except KeyboardInterrupt:
+        return 0
+    log("Pulled %d files from %s:%d%s" % (got, host, port,
+                                          ", %d failed" % failed if failed else ""))
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
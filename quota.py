@@ -0,0 +1,115 @@
+"""Per-client limits checked before a host reads or stores a file body.
+
+A host can cap, per client IP:
+
+- the size a single file may declare (or, for streams, grow to),
+- the bytes and the number of files it may send per period (a day by
+  default),
+- how many connections it may hold open at once.
+
+Declared sizes are checked and reserved against the byte quota as soon
+as a header is read, before anything is allocated on disk; the
+reservation is trimmed to what actually arrived once the transfer ends.
+Zero means unlimited.  Must stay Python 2.7 compatible.
+"""
+import threading
+import time
+
+PERIOD = 24 * 60 * 60
+
+
+class Quotas(object):
+    def __init__(self, max_file_size=0, max_bytes=0, max_files=0, max_connections=0,
+                 period=PERIOD):
+        self.lock = threading.Lock()
+        self.usage = {}        # client -> [period start, bytes, files]
+        self.connections = {}  # client -> open connections
+        self.period = period
+        self.configure(max_file_size, max_bytes, max_files, max_connections)
+
+    def configure(self, max_file_size=0, max_bytes=0, max_files=0, max_connections=0):
+        with self.lock:
+            self.max_file_size = max_file_size or 0
+            self.max_bytes = max_bytes or 0
+            self.max_files = max_files or 0
+            self.max_connections = max_connections or 0
+
+    def connect(self, client):
+        """Count a new connection; False if the client already has too many"""
+        with self.lock:
+            count = self.connections.get(client, 0)
+            if self.max_connections and count >= self.max_connections:
+                return False
+            self.connections[client] = count + 1
+            return True
+
+    def disconnect(self, client):
+        with self.lock:
+            count = self.connections.get(client, 0) - 1
+            if count > 0:
+                self.connections[client] = count
+            else:
+                self.connections.pop(client, None)
+
+    def _usage(self, client, now):
+        usage = self.usage.get(client)
+        if usage is None or now - usage[0] >= self.period:
+            usage = self.usage[client] = [now, 0, 0]
+        return usage
+
+    def admit(self, client, size):
+        """Reserve room for a size byte file; returns None, or why it was refused"""
+        with self.lock:
+            if self.max_file_size and size > self.max_file_size:
+                return "file of %d bytes is over the %d byte limit" % (size, self.max_file_size)
+            usage = self._usage(client, time.time())
+            if self.max_files and usage[2] >= self.max_files:
+                return "client has already sent %d files this period" % self.max_files
+            if self.max_bytes and usage[1] + size > self.max_bytes:
+                return "client has %d of its %d bytes for this period left" % (
+                    max(0, self.max_bytes - usage[1]), self.max_bytes)
+            usage[1] += size
+            usage[2] += 1
+            return None
+
+    def extend(self, client, size, more):
+        """Reserve more bytes for an admitted file that is already size bytes long.
+
+        For streams, whose size isn't known up front; returns None, or why
+        it was refused.
+        """
+        with self.lock:
+            if self.max_file_size and size + more > self.max_file_size:
+                return "file is over the %d byte limit" % self.max_file_size
+            usage = self._usage(client, time.time())
+            if self.max_bytes and usage[1] + more > self.max_bytes:
+                return "client has used its %d bytes for this period" % self.max_bytes
+            usage[1] += more
+            return None
+
+    def finish(self, client, size, received):
+        """Give back the part of an admitted file's reservation that never arrived"""
+        with self.lock:
+            usage = self.usage.get(client)
+            if usage is not None:
+                usage[1] = max(0, usage[1] - max(0, size - received))
+
+    def for_client(self, client):
+        return ClientQuota(self, client)
+
+
+class ClientQuota(object):
+    """Quotas bound to one client, for code that doesn't know who it serves"""
+
+    def __init__(self, quotas, client):
+        self.quotas = quotas
+        self.client = client
+
+    def admit(self, size):
+        return self.quotas.admit(self.client, size)
+
+    def extend(self, size, more):
+        return self.quotas.extend(self.client, size, more)
+
+    def finish(self, size, received):
+        self.quotas.finish(self.client, size, received)
@@ -0,0 +1,297 @@
+"""Cut-through forwarding for hosts that pass files on to another host.
+
+A relay takes files on its listener like any other host, but instead of
+saving them it opens a session to the next hop and sends each file on
+while it is still arriving, so a file crosses a chain of relays in
+little more than the time it takes to cross one link.  A relay can
+itself point at another relay.
+
+The upstream sender only gets its acknowledgement once the next hop has
+acknowledged, so "ok" still means the file reached the end of the chain.
+A file that can't be passed on is reported as NEXT_HOP and the sender
+retries it later as usual.
+
+Between the two connections sits a SpillBuffer.  It holds up to
+MEMORY_LIMIT bytes; when the next hop is slower than the sender and the
+buffer fills, the rest goes to a spill file on disk so the sender isn't
+held back.  With spilling turned off the sender is slowed to the next
+hop's pace instead.
+
+Relays forward single files and sessions.  They don't rebuild deltas or
+mirror folders: those senders are turned away and fall back to sending
+whole files, or report the host doesn't support folder sync.
+
+Must stay Python 2.7 compatible.
+"""
+import socket
+import tempfile
+import threading
+from collections import deque
+
+import protocol
+import session
+import throttle
+
+MEMORY_LIMIT = 8 * 1024 * 1024  # Bytes held in memory per file before spilling
+CHUNK_SIZE = 65536
+
+
+class SpillBuffer(object):
+    """First-in first-out bytes between a receiving and a sending thread.
+
+    With spill set write() never blocks; chunks that don't fit in memory
+    are appended to a temporary file in spill_dir (the system's temporary
+    folder by default) and read back in order once the memory part has
+    been sent.  Without it write() waits for room.
+    """
+
+    def __init__(self, memory_limit=MEMORY_LIMIT, spill=True, spill_dir=None):
+        self.memory_limit = memory_limit
+        self.can_spill = spill
+        self.spill_dir = spill_dir
+        self.cond = threading.Condition()
+        self.chunks = deque()
+        self.in_memory = 0
+        self.spill = None
+        self.spill_written = 0
+        self.spill_read = 0
+        self.spilled = 0      # Bytes that went through the spill file
+        self.closed = False   # No more writes are coming
+        self.failed = False   # The reader gave up; writes are dropped
+
+    def write(self, data):
+        with self.cond:
+            if self.failed:
+                return
+            if self.spill_read < self.spill_written or (
+                    self.in_memory >= self.memory_limit and self.can_spill):
+                # Once anything is on disk the newer data follows it there
+                if self.spill is None:
+                    self.spill = tempfile.TemporaryFile(prefix='relay_', dir=self.spill_dir)
+                self.spill.seek(self.spill_written)
+                self.spill.write(data)
+                self.spill.flush()
+                self.spill_written += len(data)
+                self.spilled += len(data)
+            else:
+                while self.in_memory >= self.memory_limit and not self.failed:
+                    self.cond.wait()
+                if self.failed:
+                    return
+                self.chunks.append(data)
+                self.in_memory += len(data)
+            self.cond.notify_all()
+
+    def read(self, size=CHUNK_SIZE):
+        """Next chunk of at most size bytes, or b'' once closed and empty"""
+        with self.cond:
+            while True:
+                if self.chunks:
+                    data = self.chunks.popleft()
+                    self.in_memory -= len(data)
+                    self.cond.notify_all()
+                    return data
+                if self.spill_read < self.spill_written:
+                    self.spill.seek(self.spill_read)
+                    data = self.spill.read(min(size, self.spill_written - self.spill_read))
+                    self.spill_read += len(data)
+                    if self.spill_read == self.spill_written:
+                        # Drained: start the file over rather than let it grow
+                        self.spill.seek(0)
+                        self.spill.truncate()
+                        self.spill_read = self.spill_written = 0
+                    return data
+                if self.closed:
+                    return b''
+                self.cond.wait()
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+    def fail(self):
+        """Stop accepting data, waking a writer waiting for room"""
+        with self.cond:
+            self.failed = True
+            self.chunks.clear()
+            self.in_memory = 0
+            self.cond.notify_all()
+
+    def discard(self):
+        if self.spill is not None:
+            self.spill.close()
+            self.spill = None
+
+
+class Relay(object):
+    """Where a host forwards what it receives, and totals for the status line"""
+
+    def __init__(self, host, port, spill=True, spill_dir=None, memory_limit=MEMORY_LIMIT,
+                 log=None, timeout=protocol.CONNECT_TIMEOUT):
+        self.host = host
+        self.port = port
+        self.spill = spill
+        self.spill_dir = spill_dir
+        self.memory_limit = memory_limit
+        self.log = log
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.files = 0
+        self.bytes = 0
+        self.spilled = 0
+        self.failed = 0
+
+    def open(self):
+        """A forwarder for one upstream connection; close() it when that ends"""
+        return Forwarder(self)
+
+    def count(self, status, size, spilled):
+        with self.lock:
+            if status == protocol.OK:
+                self.files += 1
+                self.bytes += size
+            else:
+                self.failed += 1
+            self.spilled += spilled
+
+    def describe(self):
+        with self.lock:
+            return "to %s:%d, %d files (%.1f MB, %.1f MB spilled to disk), %d failed" % (
+                self.host, self.port, self.files, self.bytes / 1048576.0,
+                self.spilled / 1048576.0, self.failed)
+
+
+class Forwarder(object):
+    """Forwards the files of one upstream connection over one downstream session"""
+
+    def __init__(self, relay):
+        self.relay = relay
+        self.sock = None  # Downstream session, opened with the first file
+        self.seq = 0
+
+    def forward(self, upstream, filename, size, flow=None):
+        """Pass a size byte body from upstream on to the next hop as it arrives.
+
+        Returns (status, received) like a host's receive_file: the next
+        hop's status once it has acknowledged, INCOMPLETE if the sender
+        disconnected, or NEXT_HOP if the next hop couldn't take the file.
+        Unless the sender disconnected the whole body is read.
+        """
+        relay = self.relay
+        flow = flow or throttle.NULL_FLOW
+        buf = SpillBuffer(relay.memory_limit, relay.spill, relay.spill_dir)
+        result = {}
+        sender = threading.Thread(target=self._send, args=(filename, size, buf, result))
+        sender.daemon = True
+        sender.start()
+        received = 0
+        try:
+            while received < size:
+                data = upstream.recv(min(CHUNK_SIZE, size - received))
+                if not data:
+                    break
+                buf.write(data)
+                received += len(data)
+                flow.throttle(len(data))
+        finally:
+            buf.close()
+            sender.join()
+            buf.discard()
+        if received < size:
+            status = protocol.INCOMPLETE
+        else:
+            status = result.get('status', protocol.NEXT_HOP)
+        relay.count(status, size, buf.spilled)
+        return status, received
+
+    def _send(self, filename, size, buf, result):
+        try:
+            result['status'] = self._deliver(filename, size, buf)
+        except Exception as e:
+            if self.relay.log:
+                self.relay.log("Relay: couldn't pass %s on to %s:%d: %s" % (
+                    filename, self.relay.host, self.relay.port, str(e)))
+            self._drop()
+            result['status'] = protocol.NEXT_HOP
+        finally:
+            buf.fail()  # Anything still arriving has nowhere to go
+
+    def _deliver(self, filename, size, buf):
+        legacy = False
+        if self.sock is None:
+            try:
+                self.sock = session.open_session(self.relay.host, self.relay.port,
+                                                 self.relay.timeout)
+                self.seq = 0
+            except session.SessionUnsupported:
+                legacy = True
+                self.sock = protocol.connect(self.relay.host, self.relay.port, self.relay.timeout)
+            # Chunks go out as they arrive rather than waiting to fill a segment
+            self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        sock = self.sock
+        sent = 0
+        try:
+            sock.sendall(protocol.encode_header(filename, size))
+            while True:
+                data = buf.read()
+                if not data:
+                    break
+                sock.sendall(data)
+                sent += len(data)
+        except socket.error:
+            # The next hop may have refused the file and hung up
+            refusal = None if legacy else self._refusal()
+            if refusal is None:
+                raise
+            return refusal
+        if sent < size:
+            # The sender dropped out; make sure the next hop doesn't keep a partial file
+            self._drop()
+            return protocol.INCOMPLETE
+        if legacy:
+            self.sock = None
+            try:
+                protocol.wait_for_close(sock)
+            finally:
+                sock.close()
+            return protocol.OK
+        self.seq += 1
+        seq, status, _ = protocol.decode_ack(protocol.recv_exact(sock, protocol.ACK_SIZE))
+        if seq != self.seq:
+            raise protocol.ProtocolError("Acknowledgement %d out of order (expected %d)" %
+                                         (seq, self.seq))
+        if status == protocol.INCOMPLETE or status in protocol.UNREAD:
+            self.close()  # The next hop has ended the session
+        return status
+
+    def _refusal(self):
+        """A refusal the next hop sent before hanging up on us, if there is one"""
+        try:
+            self.sock.settimeout(1)
+            seq, status, _ = protocol.decode_ack(
+                protocol.recv_exact(self.sock, protocol.ACK_SIZE))
+        except Exception:
+            return None
+        finally:
+            self._drop()
+        if seq != self.seq + 1 or status not in protocol.UNREAD:
+            return None
+        return status
+
+    def _drop(self):
+        """Reset the downstream connection; the next file opens a new one"""
+        if self.sock is not None:
+            protocol.abort(self.sock)
+            self.sock = None
+
+    def close(self):
+        """End the downstream session cleanly"""
+        if self.sock is not None:
+            try:
+                self.sock.sendall(session.END_OF_SESSION)
+            except socket.error:
+                pass  # It hung up already; nothing was in flight
+            finally:
+                self.sock.close()
+                self.sock = None
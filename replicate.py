@@ -0,0 +1,151 @@
+"""Send one file to several receivers while reading it from disk only once.
+
+The file is memory-mapped and every destination gets its own thread that
+streams slices of the shared mapping, so a dozen receivers cost one disk
+read instead of a dozen.  A destination only counts as done once its
+receiver acknowledges the file.
+"""
+import mmap
+import os
+import threading
+import time
+
+import protocol
+import session
+import throttle
+import tuning
+
+CHUNK_SIZE = 32768
+PROGRESS_EVERY = 10  # Report progress every N chunks
+
+
+class Destination(object):
+    """Progress and completion state for one receiver"""
+
+    def __init__(self, host, port, total):
+        self.host = host
+        self.port = port
+        self.total = total
+        self.sent = 0
+        self.status = 'pending'
+        self.error = None
+        self.elapsed = 0.0
+
+    @property
+    def label(self):
+        return "%s:%d" % (self.host, self.port)
+
+    @property
+    def done(self):
+        return self.status == 'done'
+
+
+def _open_shared_buffer(f, filesize):
+    """Map the file read-only, falling back to one in-memory copy"""
+    if filesize == 0:
+        return b'', None
+    try:
+        m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (mmap.error, ValueError, OSError):
+        return f.read(), None
+    try:
+        return memoryview(m), m
+    except TypeError:
+        # Python 2 mmap objects don't support memoryview, but slice fine
+        return m, m
+
+
+def _send_to(dest, filename, data, chunk_size, timeout, log, progress, limiter):
+    dest.status = 'sending'
+    start_time = time.time()
+    flow = limiter.open_flow(dest.host) if limiter else throttle.NULL_FLOW
+    chunk_size = flow.chunk_size(tuning.chunk_size(dest.host, chunk_size))
+    def slices():
+        chunks = 0
+        while dest.sent < dest.total:
+            end = min(dest.sent + chunk_size, dest.total)
+            yield data[dest.sent:end]
+            flow.throttle(end - dest.sent)
+            dest.sent = end
+            chunks += 1
+            if progress and (chunks % PROGRESS_EVERY == 0 or dest.sent == dest.total):
+                progress(dest)
+
+    try:
+        try:
+            sock = session.open_session(dest.host, dest.port, timeout)
+        except session.SessionUnsupported:
+            # Old receiver: one file per connection, EOF means it has it all
+            sock = protocol.connect(dest.host, dest.port, timeout)
+            try:
+                sock.sendall(protocol.encode_header(filename, dest.total))
+                for chunk in slices():
+                    sock.sendall(chunk)
+                protocol.wait_for_close(sock)
+            finally:
+                sock.close()
+        else:
+            acks = []
+            sender = session.SenderSession(sock, log=log)
+            sender.send(filename, dest.total, slices(),
+                        lambda status, received: acks.append(status))
+            sender.close()
+            if acks != [protocol.OK]:
+                raise protocol.ProtocolError("receiver reported %s" %
+                                             (acks[0] if acks else session.FAILED))
+        dest.status = 'done'
+        if flow is throttle.NULL_FLOW:
+            tuning.record(dest.host, dest.total, time.time() - start_time)
+    except Exception as e:
+        dest.status = 'failed'
+        dest.error = str(e)
+        if log:
+            log("Replication to %s failed: %s" % (dest.label, dest.error))
+    flow.close()
+    dest.elapsed = time.time() - start_time
+
+
+def replicate_file(filepath, destinations, chunk_size=CHUNK_SIZE,
+                   timeout=protocol.CONNECT_TIMEOUT, log=None, progress=None,
+                   filename=None, limiter=None):
+    """Stream filepath to every (host, port) in destinations concurrently.
+
+    Returns the list of Destination objects; the file was delivered
+    everywhere only if all of them are done.  limiter is an optional
+    throttle.BandwidthManager shared by all destinations.
+    """
+    filename = filename or os.path.basename(filepath)
+    filesize = os.path.getsize(filepath)
+    targets = [Destination(host, port, filesize) for host, port in destinations]
+
+    if log:
+        log("Replicating %s (%d bytes) to %d receivers" % (filename, filesize, len(targets)))
+
+    with open(filepath, 'rb') as f:
+        data, mapping = _open_shared_buffer(f, filesize)
+        try:
+            threads = []
+            for dest in targets:
+                t = threading.Thread(target=_send_to,
+                                     args=(dest, filename, data, chunk_size,
+                                           timeout, log, progress, limiter))
+                t.daemon = True
+                t.start()
+                threads.append(t)
+            for t in threads:
+                t.join()
+        finally:
+            if isinstance(data, memoryview) and hasattr(data, 'release'):
+                data.release()
+            if mapping is not None:
+                mapping.close()
+
+    if log:
+        for dest in targets:
+            if dest.done:
+                speed = filesize / (dest.elapsed if dest.elapsed > 0 else 1)
+                log("Delivered %s to %s (%.1f KB/s)" % (filename, dest.label, speed / 1024))
+        failed = [d.label for d in targets if not d.done]
+        if failed:
+            log("%s not delivered to: %s" % (filename, ', '.join(failed)))
+    return targets
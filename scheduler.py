@@ -0,0 +1,398 @@
+"""Holding bulk files back until off-peak windows or a quiet network.
+
+Rules are separated by semicolons.  Each is a send filter (see
+filters.py), "@", and when files it matches may be sent:
+
+    size>50MB, !*.pdf @ 19:00-07:00 sat,sun idle
+    *.zip, *.7z @ mon-fri 22:00-06:00
+
+When is any mix of
+
+    19:00-07:00          every day between these times (may cross midnight)
+    mon-fri 09:00-12:00  only on these days (a range, or a list like sat,sun)
+    sat,sun              all day on these days
+    idle                 whenever the network has been less than
+                         idle_below percent busy for IDLE_SECONDS
+
+Files that match no rule (small ones and printable ones, with rules
+like the above) are sent straight away, as before.  Bulk files are
+queued with their rule's when in the job's data, so the send queue's
+journal keeps them held back across restarts.  Once their time comes
+they are drained on a separate thread over `streams` parallel sessions,
+and files dropped in meanwhile still go out straight away.
+
+How busy the network is comes from the interface byte counters
+(/proc/net/dev on Linux, GetIfTable on Windows) compared with the
+fastest rate seen, either on those counters or measured by tuning.py to
+a receiver.  Where there are no counters, idle never holds.
+
+Must stay Python 2.7 compatible.
+"""
+import datetime
+import os
+import sys
+import threading
+import time
+
+import filters
+import tuning
+
+IDLE_BELOW = 30          # Percent of the link's capacity
+IDLE_SECONDS = 60        # How long the network must stay that quiet
+BULK_STREAMS = 4         # Parallel sessions bulk files are drained over
+IDLE = 'idle'
+DAYS = ('mon', 'tue', 'wed', 'thu', 'fri', 'sat', 'sun')
+
+
+class ScheduleError(ValueError):
+    """A schedule rule couldn't be understood"""
+
+
+def _parse_time(text, rule):
+    try:
+        hours, minutes = [int(part) for part in text.split(':')]
+    except ValueError:
+        hours, minutes = -1, 0
+    if not (0 <= minutes < 60 and 0 <= hours * 60 + minutes <= 24 * 60):
+        raise ScheduleError("Bad time %r in %r (use HH:MM)" % (text, rule))
+    return hours * 60 + minutes
+
+
+def _parse_days(text, rule):
+    days = set()
+    for part in text.split(','):
+        ends = part.split('-')
+        if len(ends) > 2 or any(end not in DAYS for end in ends):
+            raise ScheduleError("Bad days %r in %r (use e.g. mon-fri or sat,sun)" % (text, rule))
+        first, last = DAYS.index(ends[0]), DAYS.index(ends[-1])
+        day = first
+        days.add(day)
+        while day != last:
+            day = (day + 1) % 7
+            days.add(day)
+    return days
+
+
+class Window(object):
+    """A daily time range, on some days of the week"""
+
+    def __init__(self, days, start, end, text):
+        self.days = days    # Weekday numbers (Monday is 0) the range starts on
+        self.start = start  # Minutes after midnight
+        self.end = end
+        self.text = text
+
+    def contains(self, when):
+        minute = when.hour * 60 + when.minute
+        today = when.weekday()
+        if self.start < self.end:
+            return today in self.days and self.start <= minute < self.end
+        # Crosses midnight: the evening part of today or the morning after yesterday
+        return ((today in self.days and minute >= self.start) or
+                ((today - 1) % 7 in self.days and minute < self.end))
+
+    def __str__(self):
+        return self.text
+
+
+def parse_when(text):
+    """(windows, idle) for the part of a rule after the @"""
+    windows, idle = [], False
+    days = None  # (weekdays, as written) waiting for the time range they qualify
+    for token in text.lower().split():
+        if token == IDLE:
+            idle = True
+        elif '-' in token and ':' in token:
+            start, end = token.split('-', 1)
+            if days is None:
+                windows.append(Window(set(range(7)), _parse_time(start, text),
+                                      _parse_time(end, text), token))
+            else:
+                windows.append(Window(days[0], _parse_time(start, text),
+                                      _parse_time(end, text), days[1] + ' ' + token))
+            days = None
+        else:
+            if days is not None:
+                windows.append(Window(days[0], 0, 24 * 60, days[1]))  # A whole day
+            days = (_parse_days(token, text), token)
+    if days is not None:
+        windows.append(Window(days[0], 0, 24 * 60, days[1]))
+    return windows, idle
+
+
+class Rule(object):
+    def __init__(self, text):
+        if '@' not in text:
+            raise ScheduleError("Rule %r needs \"@ when\", e.g. size>50MB @ 19:00-07:00" % text)
+        filter_text, when = text.split('@', 1)
+        if not when.strip():
+            raise ScheduleError("Rule %r says nothing after @ about when to send" % text)
+        self.filter = filters.FileFilter.parse(filter_text)
+        self.windows, self.idle = parse_when(when.strip())
+        self.when = ' '.join([str(window) for window in self.windows] +
+                             ([IDLE] if self.idle else []))
+
+    def __str__(self):
+        return "%s @ %s" % (self.filter, self.when)
+
+
+class Schedule(object):
+    """Parsed rules; the first one a file matches decides"""
+
+    def __init__(self, rules=()):
+        self.rules = list(rules)
+
+    @classmethod
+    def parse(cls, text):
+        return cls([Rule(part.strip()) for part in (text or '').split(';') if part.strip()])
+
+    def classify(self, path, stat=None):
+        """The when of the first rule that holds path back, or None to send it now"""
+        for rule in self.rules:
+            if rule.filter.matches(path, stat):
+                return rule.when
+        return None
+
+    def __str__(self):
+        return '; '.join(str(rule) for rule in self.rules)
+
+
+_whens = {}
+
+
+def window_open(when, now=None):
+    """Whether one of the time windows in when contains now (a timestamp)"""
+    if when not in _whens:
+        _whens[when] = parse_when(when)
+    windows = _whens[when][0]
+    moment = datetime.datetime.fromtimestamp(time.time() if now is None else now)
+    return any(window.contains(moment) for window in windows)
+
+
+def waits_for_idle(when):
+    if when not in _whens:
+        _whens[when] = parse_when(when)
+    return _whens[when][1]
+
+
+# Network load -------------------------------------------------------------
+
+def interface_bytes():
+    """{interface: bytes in + out} for the network interfaces, or None if unknown"""
+    if os.path.exists('/proc/net/dev'):
+        counters = {}
+        with open('/proc/net/dev') as f:
+            for line in f:
+                if ':' not in line:
+                    continue
+                name, fields = line.split(':', 1)
+                fields = fields.split()
+                if name.strip() != 'lo' and len(fields) >= 9:
+                    counters[name.strip()] = int(fields[0]) + int(fields[8])
+        return counters
+    if sys.platform == 'win32':
+        return _windows_interface_bytes()
+    return None
+
+
+def _windows_interface_bytes():
+    import ctypes
+    from ctypes import wintypes
+
+    class MIB_IFROW(ctypes.Structure):
+        _fields_ = [('wszName', wintypes.WCHAR * 256), ('dwIndex', wintypes.DWORD),
+                    ('dwType', wintypes.DWORD), ('dwMtu', wintypes.DWORD),
+                    ('dwSpeed', wintypes.DWORD), ('dwPhysAddrLen', wintypes.DWORD),
+                    ('bPhysAddr', ctypes.c_ubyte * 8), ('dwAdminStatus', wintypes.DWORD),
+                    ('dwOperStatus', wintypes.DWORD), ('dwLastChange', wintypes.DWORD),
+                    ('dwInOctets', wintypes.DWORD), ('dwInUcastPkts', wintypes.DWORD),
+                    ('dwInNUcastPkts', wintypes.DWORD), ('dwInDiscards', wintypes.DWORD),
+                    ('dwInErrors', wintypes.DWORD), ('dwInUnknownProtos', wintypes.DWORD),
+                    ('dwOutOctets', wintypes.DWORD), ('dwOutUcastPkts', wintypes.DWORD),
+                    ('dwOutNUcastPkts', wintypes.DWORD), ('dwOutDiscards', wintypes.DWORD),
+                    ('dwOutErrors', wintypes.DWORD), ('dwOutQLen', wintypes.DWORD),
+                    ('dwDescrLen', wintypes.DWORD), ('bDescr', ctypes.c_ubyte * 256)]
+
+    get_if_table = ctypes.windll.iphlpapi.GetIfTable
+    size = wintypes.ULONG(0)
+    get_if_table(None, ctypes.byref(size), False)
+    buf = ctypes.create_string_buffer(size.value)
+    if get_if_table(buf, ctypes.byref(size), False) != 0:
+        return None
+    count = wintypes.DWORD.from_buffer(buf).value
+    rows = (MIB_IFROW * count).from_buffer(buf, ctypes.sizeof(wintypes.DWORD))
+    # 24 is the software loopback interface
+    return dict((row.dwIndex, row.dwInOctets + row.dwOutOctets)
+                for row in rows if row.dwType != 24)
+
+
+class LinkMeter(object):
+    """How busy the network is, from the interface counters"""
+    WRAP = 2 ** 32 if sys.platform == 'win32' else None  # GetIfTable's counters are 32 bit
+
+    def __init__(self, counters=interface_bytes):
+        self.counters = counters
+        self.last = None
+        self.last_time = None
+        self.rate = None  # Bytes/second at the last sample
+        self.peak = 0.0
+        self.quiet_since = None
+
+    def sample(self, now=None):
+        """Read the counters; returns bytes/second since the last sample, or None"""
+        now = time.time() if now is None else now
+        try:
+            counts = self.counters()
+        except Exception:
+            counts = None
+        if counts is None:
+            self.last = None
+            return None
+        if self.last is not None and now > self.last_time:
+            moved = 0
+            for name, count in counts.items():
+                delta = count - self.last.get(name, count)
+                if delta < 0:
+                    delta = delta + self.WRAP if self.WRAP else 0  # Wrapped, or reset
+                moved += delta
+            self.rate = moved / (now - self.last_time)
+            self.peak = max(self.peak, self.rate)
+        self.last, self.last_time = counts, now
+        return self.rate
+
+    def idle_for(self, idle_below, capacity=0, now=None):
+        """Seconds the network has been below idle_below percent busy (0 if it isn't)"""
+        now = time.time() if now is None else now
+        capacity = max(capacity, self.peak)
+        if self.rate is None or capacity <= 0 or self.rate > capacity * idle_below / 100.0:
+            self.quiet_since = None
+            return 0
+        if self.quiet_since is None:
+            self.quiet_since = now
+        return now - self.quiet_since
+
+
+# Scheduler ----------------------------------------------------------------
+
+class Scheduler(object):
+    """Sends a send_queue.SendQueue's files now or in their bulk windows.
+
+    Use enqueue() and process_due() instead of the queue's own.  hosts()
+    returns the receivers' addresses, whose measured rates help judge
+    how busy the link is.
+    """
+
+    def __init__(self, queue, rules='', idle_below=IDLE_BELOW, streams=BULK_STREAMS,
+                 hosts=None, log=None, meter=None):
+        self.queue = queue
+        self.schedule = Schedule.parse(rules)
+        self.idle_below = idle_below
+        self.streams = streams
+        self.hosts = hosts or (lambda: [])
+        self.log = log or (lambda message: None)
+        self.meter = meter or LinkMeter()
+        self.lock = threading.Lock()
+        self.released = set()  # Bulk jobs let go because the network was idle
+        self.drainer = None
+        self.should_continue = None
+
+    def configure(self, rules=None, idle_below=None, streams=None):
+        """Arguments left as None keep their value; raises ScheduleError"""
+        schedule = Schedule.parse(rules) if rules is not None else None
+        with self.lock:
+            if schedule is not None:
+                self.schedule = schedule
+            if idle_below is not None:
+                self.idle_below = idle_below
+            if streams is not None:
+                self.streams = max(1, int(streams))
+
+    def enqueue(self, filepath, stat=None):
+        """Queue a file, marking it bulk if a rule holds it back.
+
+        stat is an optional function returning the file's os.stat(), as
+        for FileFilter.matches().
+        """
+        when = self.schedule.classify(filepath, stat)
+        job = self.queue.enqueue(filepath, data={'bulk': when} if when else None)
+        if when:
+            self.log("%s is bulk: held until %s" % (job.name, when))
+        return job
+
+    def process_due(self, should_continue=None):
+        """Send due files that aren't bulk; start draining bulk ones whose time has come"""
+        self.should_continue = should_continue
+        delivered = self.queue.process_due(should_continue, select=lambda job: not is_bulk(job))
+        self.meter.sample()
+        capacity = max([rate for rate in map(tuning.link_rate, self.hosts()) if rate] or [0])
+        quiet = self.meter.idle_for(self.idle_below, capacity)
+        bulk = self.queue.due_jobs(select=is_bulk)
+        if not bulk:
+            return delivered
+        with self.lock:
+            if self.drainer is not None:
+                return delivered
+            ready = [job for job in bulk if window_open(job.data['bulk'])]
+            idle = [job for job in bulk if waits_for_idle(job.data['bulk'])]
+            if not ready and idle and quiet >= IDLE_SECONDS:
+                self.released.update(job.id for job in idle)
+                ready = idle
+                self.log("Network quiet for %d s, sending %d bulk files" % (quiet, len(idle)))
+            if ready:
+                self.drainer = threading.Thread(target=self._drain)
+                self.drainer.daemon = True
+                self.drainer.start()
+        return delivered
+
+    def _releasable(self, job):
+        return is_bulk(job) and (job.id in self.released or window_open(job.data['bulk']))
+
+    def _drain(self):
+        """Send bulk files over parallel sessions until none may go now"""
+        try:
+            while self.should_continue is None or self.should_continue():
+                jobs = self.queue.due_jobs(select=self._releasable)
+                if not jobs:
+                    break
+                # Biggest first, dealt round so each session gets a similar share
+                jobs.sort(key=lambda job: -_size(job))
+                groups = [jobs[i::self.streams] for i in range(min(self.streams, len(jobs)))]
+                self.log("Sending %d bulk files (%.1f MB) over %d sessions" % (
+                    len(jobs), sum(map(_size, jobs)) / 1048576.0, len(groups)))
+                workers = [threading.Thread(target=self._send_group, args=(group,))
+                           for group in groups]
+                for worker in workers:
+                    worker.daemon = True
+                    worker.start()
+                for worker in workers:
+                    worker.join()
+        except Exception as e:
+            self.log("Bulk sending error: %s" % e)
+        finally:
+            with self.lock:
+                self.drainer = None
+                live = set(job.id for job in self.queue.due_jobs(now=float('inf'), select=is_bulk))
+                self.released &= live
+
+    def _send_group(self, jobs):
+        if self.queue.batch_func is not None:
+            self.queue.run_batch(jobs)
+        else:
+            for job in jobs:
+                self.queue.run_job(job)
+
+    def waiting(self):
+        """(files, bytes) of bulk files still queued"""
+        jobs = self.queue.due_jobs(now=float('inf'), select=is_bulk)
+        return len(jobs), sum(map(_size, jobs))
+
+
+def is_bulk(job):
+    return bool(job.data.get('bulk'))
+
+
+def _size(job):
+    try:
+        return os.path.getsize(job.path)
+    except OSError:
+        return 0
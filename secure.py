@@ -0,0 +1,359 @@
+"""Optional TLS for every connection, with pinned self-signed certificates.
+
+The host makes itself a self-signed certificate the first time it needs
+one (with the cryptography package if it is installed, otherwise the
+openssl command) and keeps it in tls/.  Senders don't use certificate
+authorities: the first time they talk to a host they remember the
+SHA-256 fingerprint of its certificate in tls/known_hosts.json, and
+from then on refuse to talk to it if the fingerprint changes (like ssh).
+Delete the entry to accept a new certificate.
+
+Hosts take TLS and plain connections on the same port.  A TLS
+ClientHello starts with byte 0x16, which no plain header does, so the
+first byte is peeked to tell them apart.  With require=True plain
+connections are turned away.
+
+Senders keep the TLS session of their last connection to each host and
+offer it on the next one, so a stream of small files skips most of the
+handshake.  The cipher can be picked per host: "aesgcm" or "chacha20"
+hold the connection to TLS 1.2 with that cipher (Python can't choose
+TLS 1.3 suites), "auto" lets OpenSSL negotiate TLS 1.3.
+benchmarks/bench_tls.py shows which is faster on a given machine.
+
+Must stay Python 2.7 compatible (2.7.9 or later for SSLContext).
+"""
+import hashlib
+import json
+import os
+import socket
+import ssl
+import threading
+
+import fileutil
+
+TLS_DIR = 'tls'
+CERT_FILE = 'cert.pem'
+KEY_FILE = 'key.pem'
+KNOWN_HOSTS_FILE = 'known_hosts.json'
+COMMON_NAME = 'PyPrintFileTransfer'
+CERT_DAYS = 3650
+
+TLS_HANDSHAKE = b'\x16'  # First byte of every TLS ClientHello
+
+AUTO = 'auto'
+AESGCM = 'aesgcm'
+CHACHA20 = 'chacha20'
+CIPHERS = {AESGCM: 'ECDHE+AESGCM', CHACHA20: 'ECDHE+CHACHA20'}
+
+
+class TLSError(Exception):
+    """TLS is switched on but can't be used"""
+
+
+class CertificateMismatch(TLSError):
+    """A host presented a different certificate from the one we pinned"""
+
+
+class _Settings(object):
+    def __init__(self):
+        self.tls_dir = TLS_DIR
+        self.enabled = False   # Senders use TLS
+        self.require = False   # Hosts turn plain connections away
+        self.cipher = AUTO
+        self.host_ciphers = {}
+
+
+settings = _Settings()
+_lock = threading.Lock()
+_client_contexts = {}
+_server_context = []
+_sessions = {}  # (host, port, cipher) -> ssl.SSLSession from the last connection
+_known_hosts = {}
+
+
+def configure(base_dir=None, enabled=None, require=None, cipher=None, host_ciphers=None):
+    """Change the TLS settings; arguments left as None keep their value"""
+    with _lock:
+        if base_dir is not None:
+            settings.tls_dir = os.path.join(base_dir, TLS_DIR)
+            del _server_context[:]
+            _known_hosts.clear()
+        if enabled is not None:
+            settings.enabled = bool(enabled)
+        if require is not None:
+            settings.require = bool(require)
+        if cipher is not None:
+            settings.cipher = _check_cipher(cipher)
+        if host_ciphers is not None:
+            settings.host_ciphers = dict((host, _check_cipher(c))
+                                         for host, c in host_ciphers.items())
+
+
+def _check_cipher(cipher):
+    cipher = cipher.strip().lower()
+    if cipher != AUTO and cipher not in CIPHERS:
+        raise ValueError("Unknown cipher %r (use auto, aesgcm or chacha20)" % cipher)
+    return cipher
+
+
+def parse_ciphers(text):
+    """Parse "auto, 10.0.0.5=chacha20" into (default cipher, {ip: cipher})"""
+    default = AUTO
+    overrides = {}
+    for item in (text or '').split(','):
+        item = item.strip()
+        if not item:
+            continue
+        if '=' in item:
+            ip, cipher = item.split('=', 1)
+            overrides[ip.strip()] = _check_cipher(cipher)
+        else:
+            default = _check_cipher(item)
+    return default, overrides
+
+
+def is_tls(sock):
+    return isinstance(sock, ssl.SSLSocket)
+
+
+def is_eof(error):
+    """True for the error older ssl modules raise when the peer hangs up without a TLS goodbye"""
+    return (isinstance(error, getattr(ssl, 'SSLEOFError', ())) or
+            (isinstance(error, ssl.SSLError) and 'EOF' in str(error).upper()))
+
+
+def clear_sessions():
+    """Forget saved sessions, so the next connections do full handshakes"""
+    with _lock:
+        _sessions.clear()
+
+
+# Certificates
+
+def _paths():
+    return (os.path.join(settings.tls_dir, CERT_FILE),
+            os.path.join(settings.tls_dir, KEY_FILE))
+
+
+def ensure_certificate():
+    """Return (cert path, key path), generating a certificate if there isn't one"""
+    cert_path, key_path = _paths()
+    if os.path.exists(cert_path) and os.path.exists(key_path):
+        return cert_path, key_path
+    fileutil.ensure_dir(settings.tls_dir)
+    try:
+        cert_pem, key_pem = _generate_with_cryptography()
+    except ImportError:
+        cert_pem, key_pem = _generate_with_openssl()
+    fileutil.atomic_write(key_path, key_pem)
+    try:
+        os.chmod(key_path, 0o600)
+    except OSError:
+        pass
+    fileutil.atomic_write(cert_path, cert_pem)
+    return cert_path, key_path
+
+
+def _generate_with_cryptography():
+    import datetime
+    from cryptography import x509
+    from cryptography.hazmat.primitives import hashes, serialization
+    from cryptography.hazmat.primitives.asymmetric import ec
+    from cryptography.x509.oid import NameOID
+
+    key = ec.generate_private_key(ec.SECP256R1())
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, COMMON_NAME)])
+    now = datetime.datetime.utcnow()
+    cert = (x509.CertificateBuilder()
+            .subject_name(name)
+            .issuer_name(name)
+            .public_key(key.public_key())
+            .serial_number(x509.random_serial_number())
+            .not_valid_before(now - datetime.timedelta(days=1))
+            .not_valid_after(now + datetime.timedelta(days=CERT_DAYS))
+            .sign(key, hashes.SHA256()))
+    key_pem = key.private_bytes(serialization.Encoding.PEM,
+                                serialization.PrivateFormat.PKCS8,
+                                serialization.NoEncryption())
+    return cert.public_bytes(serialization.Encoding.PEM), key_pem
+
+
+def _generate_with_openssl():
+    import subprocess  # Only ever needed once, so not worth importing at startup
+    cert_tmp = os.path.join(settings.tls_dir, CERT_FILE + '.new')
+    key_tmp = os.path.join(settings.tls_dir, KEY_FILE + '.new')
+    command = ['openssl', 'req', '-x509', '-newkey', 'ec',
+               '-pkeyopt', 'ec_paramgen_curve:prime256v1', '-nodes',
+               '-days', str(CERT_DAYS), '-subj', '/CN=' + COMMON_NAME,
+               '-keyout', key_tmp, '-out', cert_tmp]
+    try:
+        with open(os.devnull, 'wb') as devnull:
+            subprocess.check_call(command, stdout=devnull, stderr=devnull)
+        with open(cert_tmp, 'rb') as f:
+            cert_pem = f.read()
+        with open(key_tmp, 'rb') as f:
+            key_pem = f.read()
+    except (OSError, subprocess.CalledProcessError) as e:
+        raise TLSError("Can't create a TLS certificate (install the cryptography "
+                       "package or openssl): %s" % e)
+    finally:
+        for path in (cert_tmp, key_tmp):
+            if os.path.exists(path):
+                os.remove(path)
+    return cert_pem, key_pem
+
+
+def fingerprint_of(der):
+    digest = hashlib.sha256(der).hexdigest().upper()
+    return ':'.join(digest[i:i + 2] for i in range(0, len(digest), 2))
+
+
+def fingerprint():
+    """Fingerprint of our own certificate, for comparing with what senders pinned"""
+    cert_path = ensure_certificate()[0]
+    with open(cert_path, 'r') as f:
+        return fingerprint_of(ssl.PEM_cert_to_DER_cert(f.read()))
+
+
+def _load_known_hosts():
+    if not _known_hosts:
+        try:
+            with open(os.path.join(settings.tls_dir, KNOWN_HOSTS_FILE), 'rb') as f:
+                _known_hosts.update(json.loads(f.read().decode('utf-8')))
+        except (IOError, OSError, ValueError):
+            pass
+    return _known_hosts
+
+
+def _check_pin(tls, host, port):
+    key = "%s:%d" % (host, port)
+    actual = fingerprint_of(tls.getpeercert(binary_form=True))
+    with _lock:
+        known = _load_known_hosts()
+        pinned = known.get(key)
+        if pinned is None:
+            # Trust on first use, then hold the host to it
+            known[key] = actual
+            fileutil.ensure_dir(settings.tls_dir)
+            fileutil.atomic_write(os.path.join(settings.tls_dir, KNOWN_HOSTS_FILE),
+                                  json.dumps(known, indent=1, sort_keys=True).encode('utf-8'))
+            return
+    if pinned != actual:
+        raise CertificateMismatch(
+            "Certificate of %s changed (pinned %s, got %s); remove it from %s if this is expected"
+            % (key, pinned, actual, KNOWN_HOSTS_FILE))
+
+
+# Contexts
+
+def _secure_defaults(context):
+    context.options |= getattr(ssl, 'OP_NO_SSLv2', 0) | getattr(ssl, 'OP_NO_SSLv3', 0)
+    if hasattr(context, 'minimum_version'):
+        context.minimum_version = ssl.TLSVersion.TLSv1_2
+    else:
+        context.options |= getattr(ssl, 'OP_NO_TLSv1', 0) | getattr(ssl, 'OP_NO_TLSv1_1', 0)
+
+
+if hasattr(ssl, 'SSLSession'):
+    class _ResumableSocket(ssl.SSLSocket):
+        """Saves its session on close so the next connection can resume it.
+
+        TLS 1.3 tickets only arrive after the handshake, so closing is the
+        first moment we can be sure to have one.
+        """
+        resume_key = None
+
+        def close(self):
+            if self.resume_key is not None:
+                tls_session = self.session
+                if tls_session is not None and tls_session.has_ticket:
+                    with _lock:
+                        _sessions[self.resume_key] = tls_session
+                self.resume_key = None
+            super(_ResumableSocket, self).close()
+else:
+    _ResumableSocket = None
+
+
+def _client_context(cipher):
+    with _lock:
+        context = _client_contexts.get(cipher)
+        if context is None:
+            context = ssl.SSLContext(getattr(ssl, 'PROTOCOL_TLS_CLIENT', ssl.PROTOCOL_SSLv23))
+            context.check_hostname = False
+            context.verify_mode = ssl.CERT_NONE  # We pin the certificate ourselves
+            _secure_defaults(context)
+            if cipher in CIPHERS:
+                context.set_ciphers(CIPHERS[cipher])
+                if hasattr(context, 'maximum_version'):
+                    context.maximum_version = ssl.TLSVersion.TLSv1_2
+                else:
+                    context.options |= getattr(ssl, 'OP_NO_TLSv1_3', 0)
+            if _ResumableSocket is not None and hasattr(context, 'sslsocket_class'):
+                context.sslsocket_class = _ResumableSocket
+            _client_contexts[cipher] = context
+        return context
+
+
+def _get_server_context():
+    with _lock:
+        if _server_context:
+            return _server_context[0]
+    cert_path, key_path = ensure_certificate()
+    context = ssl.SSLContext(getattr(ssl, 'PROTOCOL_TLS_SERVER', ssl.PROTOCOL_SSLv23))
+    _secure_defaults(context)
+    context.load_cert_chain(cert_path, key_path)
+    with _lock:
+        if not _server_context:
+            _server_context.append(context)
+        return _server_context[0]
+
+
+# Connections
+
+def wrap_client(sock, host, port):
+    """Start TLS on a freshly connected socket if senders are set to use it"""
+    if not settings.enabled:
+        return sock
+    # Every write becomes a whole TLS record; Nagle would only hold the
+    # next one back waiting for a delayed ACK
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    cipher = settings.host_ciphers.get(host, settings.cipher)
+    context = _client_context(cipher)
+    key = (host, port, cipher)
+    kwargs = {}
+    with _lock:
+        saved = _sessions.get(key)
+    if saved is not None:
+        kwargs['session'] = saved
+    try:
+        tls = context.wrap_socket(sock, **kwargs)
+    except Exception:
+        sock.close()
+        raise
+    try:
+        _check_pin(tls, host, port)
+    except Exception:
+        tls.close()
+        raise
+    if _ResumableSocket is not None and isinstance(tls, _ResumableSocket):
+        tls.resume_key = key
+    return tls
+
+
+def accept(sock):
+    """Prepare a newly accepted connection.
+
+    Returns the socket to use (TLS wrapped if the client started a
+    handshake), or None if it is a plain connection and TLS is required.
+    """
+    try:
+        first = sock.recv(1, socket.MSG_PEEK)
+    except socket.error:
+        return sock  # Let the normal code report the broken connection
+    if first == TLS_HANDSHAKE:
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return _get_server_context().wrap_socket(sock, server_side=True)
+    if settings.require and first:
+        return None
+    return sock
@@ -0,0 +1,289 @@
+"""Durable send queue with crash recovery and exponential backoff.
+
+Files picked up by a watcher are moved into outbox/ and recorded in an
+append-only journal (outbox/.journal).  Each job moves through the
+states outbox -> inflight -> done, or back to outbox with a backoff
+delay when a send fails, and to failed/ once it runs out of attempts.
+Files only reach sent/ after the receiver has acknowledged them.
+
+On restart the journal is replayed: jobs that were in flight when the
+program died go back to the outbox, and files found in outbox/ without a
+journal entry are queued again.
+"""
+import json
+import os
+import random
+import shutil
+import threading
+import time
+import uuid
+
+import fileutil
+
+OUTBOX = 'outbox'
+INFLIGHT = 'inflight'
+DONE = 'done'
+FAILED = 'failed'
+
+JOURNAL_NAME = '.journal'
+COMPACT_AFTER = 1000  # Rewrite the journal after this many appended records
+
+
+class Job(object):
+    """One file waiting to be delivered"""
+
+    def __init__(self, job_id, name, state=OUTBOX, attempts=0, next_attempt=0.0,
+                 last_error=None, created=None, data=None):
+        self.id = job_id
+        self.name = name
+        self.state = state
+        self.attempts = attempts
+        self.next_attempt = next_attempt
+        self.last_error = last_error
+        self.created = created or time.time()
+        self.data = data or {}  # Free-form per-job state kept by the sender
+        self.path = None
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'name': self.name,
+            'state': self.state,
+            'attempts': self.attempts,
+            'next_attempt': self.next_attempt,
+            'last_error': self.last_error,
+            'created': self.created,
+            'data': self.data,
+        }
+
+    @classmethod
+    def from_dict(cls, record):
+        return cls(record['id'], record['name'], record.get('state', OUTBOX),
+                   record.get('attempts', 0), record.get('next_attempt', 0.0),
+                   record.get('last_error'), record.get('created'),
+                   record.get('data'))
+
+
+class SendQueue(object):
+    """Persistent queue of files to deliver.
+
+    send_func(job) is called with the job's file at job.path and must
+    return True once the receiver has acknowledged it.  Returning False or
+    raising schedules a retry.
+
+    If batch_func is given, all due jobs are handed to it together as
+    batch_func(jobs, complete) and it calls complete(job, ok, error) for
+    each one as acknowledgements arrive.
+    """
+
+    def __init__(self, base_dir, send_func, log=None, max_attempts=50,
+                 base_delay=2.0, max_delay=300.0, batch_func=None):
+        self.base_dir = base_dir
+        self.outbox_dir = fileutil.ensure_dir(os.path.join(base_dir, 'outbox'))
+        self.sent_dir = fileutil.ensure_dir(os.path.join(base_dir, 'sent'))
+        self.failed_dir = fileutil.ensure_dir(os.path.join(base_dir, 'failed'))
+        self.journal_path = os.path.join(self.outbox_dir, JOURNAL_NAME)
+        self.send_func = send_func
+        self.batch_func = batch_func
+        self.log = log or (lambda message: None)
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.jobs = {}
+        self.lock = threading.Lock()
+        self._journal = None
+        self._appended = 0
+        self._recover()
+
+    # Journal -----------------------------------------------------------
+
+    def _recover(self):
+        """Replay the journal and pick up orphaned outbox files"""
+        if os.path.exists(self.journal_path):
+            with open(self.journal_path, 'rb') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line.decode('utf-8'))
+                    except ValueError:
+                        continue  # Torn write from a crash - ignore the tail
+                    if record.get('removed'):
+                        self.jobs.pop(record['id'], None)
+                    else:
+                        self.jobs[record['id']] = Job.from_dict(record)
+
+        recovered = 0
+        for job in list(self.jobs.values()):
+            job.path = self._outbox_path(job)
+            if job.state in (DONE, FAILED):
+                del self.jobs[job.id]
+            elif not os.path.exists(job.path):
+                self.log("Queued file %s is missing from the outbox - dropping it" % job.name)
+                del self.jobs[job.id]
+            elif job.state == INFLIGHT:
+                # We died mid-send: the receiver never acknowledged it
+                job.state = OUTBOX
+                job.next_attempt = 0.0
+                recovered += 1
+
+        known = set(os.path.basename(job.path) for job in self.jobs.values())
+        for entry in sorted(os.listdir(self.outbox_dir)):
+            if entry.startswith('.') or entry in known:
+                continue
+            if '_' not in entry:
+                continue
+            job_id, name = entry.split('_', 1)
+            job = Job(job_id, name)
+            job.path = os.path.join(self.outbox_dir, entry)
+            self.jobs[job.id] = job
+            recovered += 1
+
+        self._compact()
+        if self.jobs:
+            self.log("Send queue: %d pending files (%d recovered after restart)" %
+                     (len(self.jobs), recovered))
+
+    def _outbox_path(self, job):
+        return os.path.join(self.outbox_dir, "%s_%s" % (job.id, job.name))
+
+    def _write(self, record):
+        if self._journal is None:
+            self._journal = open(self.journal_path, 'ab')
+        self._journal.write((json.dumps(record) + '\n').encode('utf-8'))
+        fileutil.fsync_file(self._journal)
+        self._appended += 1
+        if self._appended >= COMPACT_AFTER:
+            self._compact()
+
+    def _compact(self):
+        """Rewrite the journal with only the live jobs"""
+        if self._journal is not None:
+            self._journal.close()
+            self._journal = None
+        lines = [json.dumps(job.to_dict()) + '\n' for job in self.jobs.values()]
+        fileutil.atomic_write(self.journal_path, ''.join(lines).encode('utf-8'))
+        self._appended = 0
+
+    def _save(self, job):
+        self._write(job.to_dict())
+
+    def close(self):
+        with self.lock:
+            if self._journal is not None:
+                self._journal.close()
+                self._journal = None
+
+    # Queue operations --------------------------------------------------
+
+    def enqueue(self, filepath, data=None):
+        """Claim a file by moving it into the outbox and journal it"""
+        job = Job(uuid.uuid4().hex[:12], os.path.basename(filepath), data=data)
+        job.path = self._outbox_path(job)
+        with self.lock:
+            shutil.move(filepath, job.path)
+            self.jobs[job.id] = job
+            self._save(job)
+        return job
+
+    def pending(self):
+        with self.lock:
+            return len(self.jobs)
+
+    def due_jobs(self, now=None, select=None):
+        """Jobs waiting in the outbox whose retry time has come (and that select(job) likes)"""
+        now = time.time() if now is None else now
+        with self.lock:
+            jobs = [job for job in self.jobs.values()
+                    if job.state == OUTBOX and job.next_attempt <= now and
+                    (select is None or select(job))]
+        return sorted(jobs, key=lambda job: job.created)
+
+    def backoff_delay(self, attempts):
+        """Exponential backoff with a little jitter so senders don't sync up"""
+        delay = min(self.base_delay * (2 ** max(attempts - 1, 0)), self.max_delay)
+        return delay * random.uniform(0.9, 1.1)
+
+    def process_due(self, should_continue=None, select=None):
+        """Try every job whose retry time has come; returns how many were delivered"""
+        jobs = self.due_jobs(select=select)
+        if self.batch_func is not None and jobs:
+            return self.run_batch(jobs)
+        delivered = 0
+        for job in jobs:
+            if should_continue is not None and not should_continue():
+                break
+            if self.run_job(job):
+                delivered += 1
+        return delivered
+
+    def run_job(self, job):
+        self.start(job)
+        error = None
+        try:
+            ok = self.send_func(job)
+        except Exception as e:
+            ok = False
+            error = str(e)
+        return self.complete(job, ok, error)
+
+    def run_batch(self, jobs):
+        """Hand several jobs to batch_func at once so they can be pipelined"""
+        for job in jobs:
+            self.start(job)
+        results = []
+
+        def complete(job, ok, error=None):
+            results.append(self.complete(job, ok, error))
+
+        try:
+            self.batch_func(jobs, complete)
+        except Exception as e:
+            for job in jobs:
+                if job.state == INFLIGHT:
+                    complete(job, False, str(e))
+        return sum(1 for ok in results if ok)
+
+    def start(self, job):
+        """Mark a job as in flight"""
+        with self.lock:
+            job.state = INFLIGHT
+            job.attempts += 1
+            self._save(job)
+
+    def complete(self, job, ok, error=None):
+        """Record the outcome of an attempt: move to sent/, retry later or give up"""
+        with self.lock:
+            if job.state != INFLIGHT:
+                return False  # Already completed
+            if ok:
+                self._finish(job)
+                return True
+            job.last_error = error or job.last_error or "send failed"
+            if self.max_attempts and job.attempts >= self.max_attempts:
+                job.state = FAILED
+                failed_path = os.path.join(self.failed_dir, job.name)
+                if os.path.exists(failed_path):
+                    os.remove(failed_path)
+                shutil.move(job.path, failed_path)
+                del self.jobs[job.id]
+                self._write({'id': job.id, 'removed': True})
+                self.log("Giving up on %s after %d attempts (moved to failed folder): %s" %
+                         (job.name, job.attempts, job.last_error))
+            else:
+                delay = self.backoff_delay(job.attempts)
+                job.state = OUTBOX
+                job.next_attempt = time.time() + delay
+                self._save(job)
+                self.log("Will retry %s in %d seconds (attempt %d failed: %s)" %
+                         (job.name, delay, job.attempts, job.last_error))
+        return False
+
+    def _finish(self, job):
+        """Move a delivered file to sent/ and drop it from the journal"""
+        sent_path = os.path.join(self.sent_dir, job.name)
+        if os.path.exists(sent_path):
+            self.log("File %s already exists in sent folder - will overwrite" % job.name)
+            os.remove(sent_path)
+        shutil.move(job.path, sent_path)
+        job.state = DONE
+        del self.jobs[job.id]
+        self._write({'id': job.id, 'removed': True})
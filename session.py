@@ -0,0 +1,289 @@
+"""Acknowledged, pipelined transfer sessions.
+
+A sender that wants acknowledgements opens the connection with the 8
+byte SESSION_MAGIC instead of a filename length.  A receiver that
+understands sessions answers with the same magic; older receivers fail
+to parse it as a number and hang up, and the sender falls back to the
+one-file-per-connection protocol.
+
+Inside a session every file uses the usual header (name length, name,
+size) followed by the body, and the receiver answers each one with a
+fixed 32 byte acknowledgement: an 8 digit sequence number, an 8 character
+status and a 16 digit count of bytes written.  The sender doesn't wait
+for an acknowledgement before starting the next file, so several files
+can be in flight at once.  A filename length of zero ends the session.
+"""
+import os
+import socket
+import threading
+import time
+from collections import deque
+
+import delta
+import fastio
+import protocol
+import throttle
+import tuning
+
+SESSION_MAGIC = b'FTSESS01'
+END_OF_SESSION = b'0' * protocol.NAME_LENGTH_SIZE
+WINDOW = 8  # Files allowed in flight before waiting for acknowledgements
+
+FAILED = 'failed'  # Sender side only: the connection died before an ack arrived
+
+# Receivers that answered the session magic by hanging up
+_legacy_receivers = set()
+_legacy_lock = threading.Lock()
+
+
+class SessionUnsupported(Exception):
+    """The receiver only speaks the original one-file protocol"""
+
+
+def is_legacy(host, port):
+    with _legacy_lock:
+        return (host, port) in _legacy_receivers
+
+
+def open_session(host, port, timeout=protocol.CONNECT_TIMEOUT):
+    """Connect and negotiate a session, raising SessionUnsupported for old receivers"""
+    if is_legacy(host, port):
+        raise SessionUnsupported("%s:%d only accepts single files" % (host, port))
+    sock = protocol.connect(host, port, timeout)
+    try:
+        sock.sendall(SESSION_MAGIC)
+        reply = protocol.recv_exact(sock, len(SESSION_MAGIC))
+    except protocol.ProtocolError:
+        # Old receivers can't parse the magic as a length and hang up
+        sock.close()
+        with _legacy_lock:
+            _legacy_receivers.add((host, port))
+        raise SessionUnsupported("%s:%d only accepts single files" % (host, port))
+    except Exception:
+        sock.close()
+        raise
+    if reply != SESSION_MAGIC:
+        sock.close()
+        raise protocol.ProtocolError("Unexpected session reply: %r" % reply)
+    return sock
+
+
+class SenderSession(object):
+    """Send several files over one connection with pipelined acknowledgements.
+
+    Callbacks passed to send() are called as callback(status, received)
+    from the acknowledgement reader thread, in the order files were sent.
+    """
+
+    def __init__(self, sock, window=WINDOW, log=None):
+        self.sock = sock
+        self.log = log
+        self.window = threading.Semaphore(window)
+        self.pending = deque()
+        self.lock = threading.Lock()
+        self.seq = 0
+        self.closed = False
+        self.error = None
+        self.last_sent = time.time()
+        self.reader = threading.Thread(target=self._read_acks)
+        self.reader.daemon = True
+        self.reader.start()
+
+    def send(self, filename, filesize, body, callback):
+        """Stream one file into the session; returns once it is written, not acknowledged.
+
+        body is either an iterable of byte chunks or a callable
+        body(sock, progress) that writes the file itself (see fastio).
+        """
+        self.window.acquire()
+        with self.lock:
+            if self.error is not None:
+                self.window.release()
+                callback(FAILED, 0)
+                return False
+            self.seq += 1
+            self.pending.append((self.seq, callback))
+        try:
+            self.sock.sendall(protocol.encode_header(filename, filesize))
+            if callable(body):
+                body(self.sock, self._touch)
+            else:
+                for chunk in body:
+                    self.sock.sendall(chunk)
+                    self._touch()
+            return True
+        except Exception as e:
+            self._fail(e)
+            return False
+
+    def _touch(self, sent=None):
+        self.last_sent = time.time()
+
+    def close(self):
+        """End the session and wait for every outstanding acknowledgement"""
+        if not self.closed:
+            self.closed = True
+            if self.error is None:
+                try:
+                    self.sock.sendall(END_OF_SESSION)
+                except Exception as e:
+                    self._fail(e)
+            self.reader.join()
+            self.sock.close()
+        return self.error is None
+
+    def _read_acks(self):
+        try:
+            while True:
+                try:
+                    data = self.sock.recv(protocol.ACK_SIZE)
+                except socket.timeout:
+                    # A big file takes a while to acknowledge; only give up
+                    # if we've also stopped making progress sending
+                    timeout = self.sock.gettimeout() or 0
+                    if time.time() - self.last_sent < timeout:
+                        continue
+                    raise
+                if not data:
+                    break
+                if len(data) < protocol.ACK_SIZE:
+                    data += protocol.recv_exact(self.sock, protocol.ACK_SIZE - len(data))
+                seq, status, received = protocol.decode_ack(data)
+                with self.lock:
+                    expected, callback = self.pending.popleft()
+                if seq != expected:
+                    raise protocol.ProtocolError("Acknowledgement %d out of order (expected %d)" %
+                                                 (seq, expected))
+                self.window.release()
+                callback(status, received)
+        except Exception as e:
+            self._fail(e)
+            return
+        with self.lock:
+            leftover = bool(self.pending)
+        if leftover:
+            self._fail(protocol.ProtocolError("Receiver closed the session early"))
+
+    def _fail(self, error):
+        """Report every unacknowledged file as failed"""
+        with self.lock:
+            if self.error is None:
+                self.error = error
+                if self.log:
+                    self.log("Session error: %s" % str(error))
+            pending = list(self.pending)
+            self.pending.clear()
+        for _, callback in pending:
+            self.window.release()
+            callback(FAILED, 0)
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except Exception:
+            pass
+
+
+def send_batch(host, port, jobs, complete, send_single, window=WINDOW, log=None,
+               timeout=protocol.CONNECT_TIMEOUT, limiter=None):
+    """Deliver send queue jobs over one pipelined session.
+
+    Receivers that don't support sessions get the jobs one at a time
+    through send_single(job), which returns True on success.  If a
+    throttle.BandwidthManager is given every file is paced by it.
+
+    Large files are first offered as deltas against the receiver's
+    existing copy (see delta.py); anything the receiver can't rebuild
+    that way goes through the session as a whole file.
+    """
+    if not is_legacy(host, port):
+        jobs = _send_deltas(host, port, jobs, complete, log, timeout, limiter)
+        if not jobs:
+            return
+    try:
+        sock = open_session(host, port, timeout)
+    except SessionUnsupported:
+        for job in jobs:
+            complete(job, send_single(job))
+        return
+    if log:
+        log("Sending %d files to %s:%d in one session" % (len(jobs), host, port))
+    sender = SenderSession(sock, window, log)
+    chunk_size = tuning.chunk_size(host, fastio.CHUNK_SIZE)
+    acked = {'bytes': 0, 'at': None}  # For tuning: how fast the batch went
+    started = time.time()
+    for job in jobs:
+        size = os.path.getsize(job.path)
+
+        def on_ack(status, received, job=job):
+            if log:
+                log("%s: receiver reported %s (%d bytes)" % (job.name, status, received))
+            if status == protocol.OK:
+                acked['bytes'] += received
+                acked['at'] = time.time()
+                complete(job, True)
+            else:
+                complete(job, False, "receiver reported %s" % status)
+        flow = limiter.open_flow(host) if limiter else throttle.NULL_FLOW
+
+        def body(sock, progress, job=job, size=size, flow=flow):
+            if fastio.send_body(sock, job.path, size, flow, chunk_size, progress=progress) < size:
+                raise protocol.ProtocolError("%s shrank while being sent" % job.name)
+        try:
+            sender.send(job.name, size, body, on_ack)
+        finally:
+            flow.close()
+    sender.close()
+    if acked['at'] is not None and not (limiter and limiter.enabled):
+        tuning.record(host, acked['bytes'], acked['at'] - started)
+
+
+def _send_deltas(host, port, jobs, complete, log, timeout, limiter):
+    """Send the jobs worth sending as deltas; returns the ones still to send"""
+    remaining = []
+    for job in jobs:
+        if not delta.worth_trying(host, port, os.path.getsize(job.path)):
+            remaining.append(job)
+            continue
+        flow = limiter.open_flow(host) if limiter else throttle.NULL_FLOW
+        try:
+            status = delta.send_delta(host, port, job.path, job.name, flow, log, timeout)[0]
+        except delta.DeltaUnsupported:
+            status = None
+        except Exception as e:
+            complete(job, False, str(e))
+            continue
+        finally:
+            flow.close()
+        if status == protocol.OK:
+            complete(job, True)
+        elif status == protocol.REJECTED or status in protocol.UNREAD:
+            complete(job, False, "receiver reported %s" % status)
+        else:
+            remaining.append(job)  # Fall back to sending the whole file
+    return remaining
+
+
+def serve_session(sock, receive_file, log=None):
+    """Receive files until the sender ends the session.
+
+    receive_file(filename, file_size) must consume exactly file_size body
+    bytes from the socket (use protocol.drain() to reject a file) and return
+    (status, bytes_written).  It may instead return one of protocol.UNREAD
+    without reading the body, which ends the session.
+    """
+    sock.sendall(SESSION_MAGIC)
+    seq = 0
+    while True:
+        name_length = protocol.decode_name_length(
+            protocol.recv_exact(sock, protocol.NAME_LENGTH_SIZE))
+        if name_length == 0:
+            if log:
+                log("Session finished after %d files" % seq)
+            return seq
+        filename = protocol.recv_exact(sock, name_length).decode('utf-8')
+        file_size = int(protocol.recv_exact(sock, protocol.FILE_SIZE_SIZE).decode('ascii'))
+        seq += 1
+        status, received = receive_file(filename, file_size)
+        sock.sendall(protocol.encode_ack(seq, status, received))
+        if status == protocol.INCOMPLETE or status in protocol.UNREAD:
+            return seq  # The stream is out of sync; nothing more can be read
+
@@ -1,17 +1,126 @@
 import socket
 import os
+import hashlib
 import sys
-import shutil
 import time
 from datetime import datetime
 import threading
 
+import auth
+import catalog
+import delta
+import diskspace
+import fastio
+import file_index
+import filters
+import layout
+import multiplex
+import protocol
+import pull
+import quota
+import relay
+import replicate
+import scheduler
+import secure
+import send_queue
+import session
+import stream
+import throttle
+import tree_sync
+import tuning
+
 # Version 2025-4-14_1455
 
 # Configuration
 PORT = 25565
-CHUNK_SIZE = 8192  # Smaller chunks for better compatibility
+CHUNK_SIZE = 8192  # Smaller chunks for better compatibility; the starting point for tuning
 SCAN_INTERVAL = 3  # Seconds between folder scans
+REQUEUE_DELAY = 60  # Seconds before retrying a file that couldn't be queued
+
+# Learn the best chunk size and socket buffers for each receiver from how
+# fast transfers go, and remember them in .link_tuning.json (see tuning.py)
+ADAPTIVE_TUNING = True
+
+# Bandwidth limits in KB/s (0 = unlimited), used when sending and receiving
+LIMIT_TOTAL = 0         # Shared by all transfers
+LIMIT_PER_CLIENT = 0    # Per remote IP address
+LIMIT_PER_TRANSFER = 0  # Per file
+
+# Which files in this folder get sent; see filters.py for the rule syntax,
+# e.g. filters.DEFAULT_SEND_RULES + ", *.pdf, size<100MB, age>5s"
+SEND_FILTER = filters.DEFAULT_SEND_RULES
+
+# Bulk files held back until off-peak; see scheduler.py for the syntax, e.g.
+# "size>50MB, !*.pdf @ 19:00-07:00 sat,sun idle" sends big files (but not
+# PDFs) overnight, at weekends, or once the network has been less than
+# BULK_IDLE_BELOW percent busy for a minute.  Blank sends everything at once.
+# Held files are sent BULK_STREAMS at a time when their time comes
+BULK_SCHEDULE = ""
+BULK_IDLE_BELOW = 30
+BULK_STREAMS = 4
+
+# TLS (needs Python 2.7.9+; the receiver needs openssl or the cryptography
+# package to make its certificate).  Receivers always accept TLS senders;
+# REQUIRE_TLS turns plain ones away.  TLS_CIPHERS is auto, aesgcm or
+# chacha20, optionally per receiver: "auto, 10.0.0.5=chacha20"
+USE_TLS = False
+REQUIRE_TLS = False
+TLS_CIPHERS = "auto"
+
+# Pre-shared key; when set, the same key must be set on both ends
+AUTH_KEY = ""
+
+# Limits on what each client may send to this receiver (0 = unlimited)
+MAX_FILE_SIZE_MB = 0
+QUOTA_MB_PER_DAY = 0
+QUOTA_FILES_PER_DAY = 0
+MAX_CONNECTIONS_PER_CLIENT = 0
+
+# Folders received files are saved in: flat, sender, date, hash, or a
+# combination like "sender/date".  A file whose name is taken is saved
+# as name_1, name_2, ... ("keep") or replaces the old one ("overwrite")
+RECEIVE_LAYOUT = "flat"
+ON_NAME_COLLISION = layout.KEEP
+
+# Received files are catalogued in .received_catalog.db (see catalog.py).
+# Files older than KEEP_RECEIVED_DAYS, and the oldest ones once they take
+# more than MAX_RECEIVED_GB, are deleted (0 = keep).  CATALOG_HTTP_PORT
+# answers catalog queries on 127.0.0.1 (0 = off)
+KEEP_RECEIVED_DAYS = 0
+MAX_RECEIVED_GB = 0
+CATALOG_HTTP_PORT = 0
+
+# Pass everything received straight on to another receiver ("ip[:port]")
+# instead of saving it, forwarding each file while it arrives.  With
+# RELAY_SPILL a slower next hop falls behind onto disk rather than
+# slowing down whoever is sending to us
+RELAY_TO = ""
+RELAY_SPILL = True
+
+# Let clients fetch the files in this folder (see pull.py) while receiving,
+# instead of sending to each of them.  Clients pull with menu option 4 or
+# "python pull.py host"; only files they don't have yet are sent
+PUBLISH_FOLDER = ""
+
+# Serve every sender from one thread (see multiplex.py) instead of starting
+# a thread per connection, which is lighter on old machines.  TLS, deltas,
+# folder sync, streams and pulls still get a thread each.  Relays always use threads
+SINGLE_THREADED_RECEIVER = False
+
+# Files that couldn't be queued are remembered (by name, size and mtime)
+# so they aren't retried every scan; set to None to keep this in memory only
+PROCESSED_INDEX_FILE = '.processed_index.json'
+PROCESSED_INDEX_SIZE = 10000
+
+bandwidth = throttle.BandwidthManager(LIMIT_TOTAL * 1024, LIMIT_PER_CLIENT * 1024,
+                                      LIMIT_PER_TRANSFER * 1024)
+disk_space = None  # diskspace.DiskSpace for the received folder, once receiving
+received_catalog = None  # catalog.Catalog, once receiving
+storage = None  # layout.Layout for the received folder, once receiving
+relaying = None  # relay.Relay when RELAY_TO is set, once receiving
+publisher = None  # pull.Publisher when PUBLISH_FOLDER is set, once receiving
+quotas = quota.Quotas(MAX_FILE_SIZE_MB * 1024 * 1024, QUOTA_MB_PER_DAY * 1024 * 1024,
+                      QUOTA_FILES_PER_DAY, MAX_CONNECTIONS_PER_CLIENT)
 
 def get_timestamp():
     """Get current time formatted as string"""
@@ -22,11 +131,26 @@ def print_with_timestamp(message):
     timestamp = get_timestamp()
     print("[%s] %s" % (timestamp, message))
 
-def send_file(filepath, server_ip, port=PORT):
-    """Send a single file to the server"""
+def progress_printer(total):
+    """Make a progress callback that prints every CHUNK_SIZE * 10 bytes"""
+    state = {'start': time.time(), 'shown': 0}
+    
+    def show_progress(done):
+        # Show progress occasionally
+        if done - state['shown'] >= CHUNK_SIZE * 10 or done == total:
+            state['shown'] = done
+            percent = int(done * 100 / total) if total else 100
+            elapsed = time.time() - state['start']
+            speed = done / (elapsed if elapsed > 0 else 1)
+            print_with_timestamp("Progress: %d%% (%d/%d bytes) - %.1f KB/s" % 
+                               (percent, done, total, speed/1024))
+    return show_progress
+
+def send_file(filepath, server_ip, port=PORT, filename=None):
+    """Send a single file to the server and wait for it to confirm receipt"""
     try:
         # Get file info
-        filename = os.path.basename(filepath)
+        filename = filename or os.path.basename(filepath)
         filesize = os.path.getsize(filepath)
         
         print_with_timestamp("Sending file: %s (%d bytes)" % (filename, filesize))
@@ -35,10 +159,12 @@ def send_file(filepath, server_ip, port=PORT):
         # Create socket with timeout
         sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         sock.settimeout(30)
+        flow = bandwidth.open_flow(server_ip)
         
         try:
-            # Connect to server
-            sock.connect((server_ip, port))
+            # Connect to server, with the socket settings that suit this link
+            tuning.connect(sock, server_ip, port)
+            sock = protocol.start_client(sock, server_ip, port)
             print_with_timestamp("Connected successfully")
             
             # Send filename length (8 bytes, padded ASCII number)
@@ -53,117 +179,153 @@ def send_file(filepath, server_ip, port=PORT):
             size_bytes = str(filesize).zfill(16).encode('ascii')
             sock.sendall(size_bytes)
             
-            # Send file data in chunks
-            bytes_sent = 0
-            with open(filepath, 'rb') as f:
-                start_time = time.time()
-                
-                while bytes_sent < filesize:
-                    # Read chunk
-                    chunk = f.read(CHUNK_SIZE)
-                    if not chunk:
-                        break
-                    
-                    # Send chunk
-                    sock.sendall(chunk)
-                    bytes_sent += len(chunk)
-                    
-                    # Show progress occasionally
-                    if bytes_sent % (CHUNK_SIZE * 10) == 0 or bytes_sent == filesize:
-                        percent = int(bytes_sent * 100 / filesize)
-                        print_with_timestamp("Progress: %d%% (%d/%d bytes)" % (percent, bytes_sent, filesize))
-                
-                # Calculate speed
-                elapsed = time.time() - start_time
-                speed = filesize / (elapsed if elapsed > 0 else 1)
-                print_with_timestamp("File sent successfully! (%.1f KB/s)" % (speed/1024))
-            
-            print_with_timestamp("Transfer complete")
+            # Send file data (in chunks, or sendfile/mmap for big files)
+            start_time = time.time()
+            fastio.send_body(sock, filepath, filesize, flow,
+                             tuning.chunk_size(server_ip, CHUNK_SIZE),
+                             progress=progress_printer(filesize))
             
-            # Create sent folder if it doesn't exist
-            base_dir = os.path.dirname(os.path.abspath(filepath))
-            sent_dir = os.path.join(base_dir, "sent")
-            if not os.path.exists(sent_dir):
-                os.makedirs(sent_dir)
+            # The receiver hangs up once it has the whole file
+            protocol.wait_for_close(sock)
             
-            # Move file to sent folder
-            sent_path = os.path.join(sent_dir, filename)
-            print_with_timestamp("Moving file to sent folder")
-            shutil.move(filepath, sent_path)
+            # Calculate speed
+            elapsed = time.time() - start_time
+            speed = filesize / (elapsed if elapsed > 0 else 1)
+            print_with_timestamp("File sent successfully! (%.1f KB/s)" % (speed/1024))
+            if flow is throttle.NULL_FLOW:  # A limited transfer says nothing about the link
+                tuning.record(server_ip, filesize, elapsed)
             
+            print_with_timestamp("Transfer complete")
             return True
             
         except socket.error as e:
             print_with_timestamp("Socket error: %s" % str(e))
             return False
         finally:
+            flow.close()
             sock.close()
             
     except Exception as e:
         print_with_timestamp("Error: %s" % str(e))
         return False
 
-def watch_folder(server_ip, port=PORT):
-    """Watch folder for files and send them"""
+def replicate_to_all(job, destinations):
+    """Send a queued file to every receiver that doesn't have it yet"""
+    def show_progress(dest):
+        percent = int(dest.sent * 100 / dest.total) if dest.total else 100
+        print_with_timestamp("%s: %d%% (%d/%d bytes)" % (dest.label, percent, dest.sent, dest.total))
+
+    delivered = set(job.data.get('delivered', []))
+    remaining = [d for d in destinations if "%s:%d" % d not in delivered]
+    results = replicate.replicate_file(job.path, remaining, CHUNK_SIZE,
+                                       log=print_with_timestamp, progress=show_progress,
+                                       filename=job.name, limiter=bandwidth)
+    delivered.update(dest.label for dest in results if dest.done)
+    job.data['delivered'] = sorted(delivered)
+    if not all(dest.done for dest in results):
+        print_with_timestamp("Keeping %s queued - not every receiver got it" % job.name)
+        return False
+    return True
+
+def watch_folder(server_ip, port=PORT, destinations=None):
+    """Watch folder for files and send them
+
+    If destinations lists more than one (ip, port) pair every file is
+    replicated to all of them.
+    """
     base_dir = os.path.dirname(os.path.abspath(__file__))
-    processed_files = set()  # Track already processed files
+    # Track files we already gave up on, until they change (or for a while)
+    processed_files = file_index.FileIndex(
+        PROCESSED_INDEX_SIZE,
+        os.path.join(base_dir, PROCESSED_INDEX_FILE) if PROCESSED_INDEX_FILE else None)
     
     try:
         print("\n" + "="*50)
         print("SIMPLE FILE SENDER")
         print("="*50)
-        print("\nWatching for files to send to %s:%d" % (server_ip, port))
+        if destinations and len(destinations) > 1:
+            print("\nReplicating files to %s" %
+                  ", ".join("%s:%d" % d for d in destinations))
+        else:
+            print("\nWatching for files to send to %s:%d" % (server_ip, port))
         print("Place files in this folder to send them automatically")
-        print("Files will be moved to 'sent' folder after transfer")
+        print("Files will be moved to 'sent' folder once the receiver has them")
         print("Press Ctrl+C to stop\n")
         
-        # Create sent folder if needed
-        sent_dir = os.path.join(base_dir, "sent")
-        if not os.path.exists(sent_dir):
-            os.makedirs(sent_dir)
+        def deliver(job):
+            if destinations and len(destinations) > 1:
+                return replicate_to_all(job, destinations)
+            return send_file(job.path, server_ip, port, job.name)
+
+        def deliver_batch(jobs, complete):
+            if destinations and len(destinations) > 1:
+                for job in jobs:
+                    complete(job, replicate_to_all(job, destinations))
+                return
+            # Pipelined over one acknowledged session if the receiver supports it
+            session.send_batch(server_ip, port, jobs, complete, deliver,
+                               log=print_with_timestamp, limiter=bandwidth)
+
+        send_filter = filters.FileFilter.parse(SEND_FILTER)
+        
+        # Files wait in the outbox until the receiver confirms them, and
+        # anything left over from the last run is picked up again
+        queue = send_queue.SendQueue(base_dir, deliver, log=print_with_timestamp,
+                                     batch_func=deliver_batch)
+        
+        # Big files can wait for their window while small ones go at once
+        bulk = scheduler.Scheduler(
+            queue, BULK_SCHEDULE, BULK_IDLE_BELOW, BULK_STREAMS,
+            hosts=lambda: [d[0] for d in destinations] if destinations else [server_ip],
+            log=print_with_timestamp)
         
         # Main loop
         while True:
             try:
-                # List files in current directory
+                # Skip this script, our own modules and anything the
+                # send filter rules out
+                own_files = protocol.own_files(base_dir)
+                own_files.update([os.path.basename(__file__), "file_transfer_xp.py"])
+                send_filter.set_excluded_names(own_files)
+                
+                # List files in current directory, with their stat results
                 files = []
                 try:
                     # More efficient way to scan directory
                     with os.scandir(base_dir) as entries:
                         for entry in entries:
-                            if entry.is_file() and not entry.name in processed_files:
-                                files.append(entry.name)
+                            if entry.is_file() and send_filter.matches(entry.path, entry.stat):
+                                files.append((entry.name, entry.stat()))
                 except AttributeError:
                     # Fallback for older Python versions
-                    files = [f for f in os.listdir(base_dir) 
-                           if os.path.isfile(os.path.join(base_dir, f)) 
-                           and not f in processed_files]
-                
+                    for f in os.listdir(base_dir):
+                        path = os.path.join(base_dir, f)
+                        if os.path.isfile(path) and send_filter.matches(path):
+                            try:
+                                files.append((f, os.stat(path)))
+                            except OSError:
+                                pass
+
                 # Process new files
-                for filename in files:
+                for filename, st in files:
+                    if processed_files.seen(filename, st.st_size, st.st_mtime):
+                        continue
                     filepath = os.path.join(base_dir, filename)
                     
-                    # Skip directories, this script, and system files
-                    if (not filename.startswith('.') and
-                        not filename.endswith('.exe') and
-                        not filename.endswith('.pyc') and
-                        not filename.endswith('.pyd') and
-                        not filename.endswith('.dll') and
-                        not filename.endswith('.bat') and
-                        not filename.endswith('.log') and
-                        filename != os.path.basename(__file__) and
-                        not filename == "file_transfer_xp.py"):
-                        
-                        # Send the file
-                        success = send_file(filepath, server_ip, port)
-                        
-                        # Add to processed files even if sending failed 
-                        # to avoid repeated attempts on problem files
-                        processed_files.add(filename)
+                    # Hand the file to the send queue, which retries
+                    # failed sends with backoff
+                    try:
+                        bulk.enqueue(filepath)
+                        print_with_timestamp("Queued %s for sending" % filename)
+                    except (IOError, OSError) as e:
+                        # Probably still open in another program
+                        print_with_timestamp("Can't queue %s: %s" % (filename, str(e)))
                         
-                        # Keep the processed files list manageable
-                        if len(processed_files) > 1000:
-                            processed_files = set(list(processed_files)[-500:])
+                        # Leave it for a while rather than retrying every scan
+                        processed_files.add(filename, st.st_size, st.st_mtime, REQUEUE_DELAY)
+                processed_files.save()
+                
+                bulk.process_due()
                 
                 # Wait before checking again - increase this value to reduce CPU usage
                 time.sleep(SCAN_INTERVAL)
@@ -175,22 +337,119 @@ def watch_folder(server_ip, port=PORT):
     except Exception as e:
         print_with_timestamp("Error in main loop: %s" % str(e))
 
-def handle_client(client_socket, client_address, received_dir):
-    """Handle incoming file transfer from a client"""
+def handle_client(client_socket, client_address, received_dir, first=None):
+    """Handle incoming file transfer from a client.
+    
+    first is the first 8 bytes of the stream if the single-threaded
+    receiver has already read them.
+    """
+    forwarder = relaying.open() if relaying else None
     try:
         print_with_timestamp("New connection from %s:%d" % client_address)
         client_socket.settimeout(30)
         
-        # Receive filename length (8 bytes)
-        name_length_data = client_socket.recv(8)
-        if not name_length_data:
-            print_with_timestamp("Client disconnected - no filename length received")
+        if first is None:
+            # Start TLS if the client asked for it
+            tls_socket = secure.accept(client_socket)
+            if tls_socket is None:
+                print_with_timestamp("Rejected plain connection - TLS is required")
+                return
+            client_socket = tls_socket
+            
+            # Receive filename length (8 bytes)
+            try:
+                name_length_data = protocol.recv_exact(client_socket, 8)
+            except protocol.ProtocolError:
+                print_with_timestamp("Client disconnected - no filename length received")
+                return
+            
+            # Check the pre-shared key before reading anything else
+            try:
+                if auth.server_handshake(client_socket, name_length_data):
+                    print_with_timestamp("Client authenticated")
+                    name_length_data = protocol.recv_exact(client_socket, 8)
+            except auth.AuthError as e:
+                print_with_timestamp("Rejected client: %s" % str(e))
+                protocol.abort(client_socket)
+                return
+        else:
+            name_length_data = first  # The key has been checked too
+        
+        if name_length_data == session.SESSION_MAGIC:
+            # Acknowledged session: many files, one ack per file
+            print_with_timestamp("Client opened an acknowledged session")
+            if forwarder:
+                receive = lambda name, size: relay_file(client_socket, forwarder, name, size,
+                                                        client_address[0])
+            else:
+                receive = lambda name, size: receive_file(client_socket, received_dir, name, size,
+                                                          client_address[0])
+            session.serve_session(client_socket, receive, log=print_with_timestamp)
+            return
+        
+        if name_length_data == pull.PULL_MAGIC:
+            # A client fetching published files; hanging up tells it there are none
+            if publisher is None:
+                print_with_timestamp("Turned away a pull - no folder is published")
+                return
+            print_with_timestamp("Client is pulling published files")
+            sent = pull.serve_pull(client_socket, publisher, print_with_timestamp,
+                                   lambda: bandwidth.open_flow(client_address[0]))
+            print_with_timestamp("Pull finished, %d bytes sent" % sent)
+            return
+        
+        if forwarder and name_length_data in (delta.DELTA_MAGIC, tree_sync.SYNC_MAGIC,
+                                              stream.STREAM_MAGIC):
+            # Hanging up makes delta senders send the whole file instead
+            print_with_timestamp("Turned away a delta, folder sync or stream - relays only forward files")
+            return
+        
+        if name_length_data == delta.DELTA_MAGIC:
+            # Only the changed parts of a file we already have; the
+            # result is saved alongside the old copy like any other file
+            print_with_timestamp("Client is sending a delta")
+            started = time.time()
+            name, filepath, status = delta.serve_delta(
+                client_socket, received_dir, print_with_timestamp,
+                lambda: bandwidth.open_flow(client_address[0]),
+                lambda name: claim_path(name, client_address[0]),
+                quotas.for_client(client_address[0]), disk_space,
+                lambda name: storage.path_for(name, client_address[0]))
+            if status == protocol.OK and received_catalog:
+                received_catalog.record(client_address[0], filepath, os.path.getsize(filepath),
+                                        status, started)
+            return
+        
+        if name_length_data == tree_sync.SYNC_MAGIC:
+            print_with_timestamp("Client is syncing a folder")
+            tree_sync.serve_sync(client_socket, received_dir, client_address[0],
+                                 print_with_timestamp,
+                                 lambda: bandwidth.open_flow(client_address[0]),
+                                 quotas.for_client(client_address[0]), disk_space,
+                                 lambda path, size, status, started, sha256:
+                                 received_catalog and received_catalog.record(
+                                     client_address[0], path, size, status, started,
+                                     sha256=sha256))
+            return
+        
+        if name_length_data == stream.STREAM_MAGIC:
+            # Piped in by stream.py, length unknown until it ends
+            print_with_timestamp("Client is streaming a file")
+            stream.serve_stream(client_socket, received_dir, print_with_timestamp,
+                                lambda: bandwidth.open_flow(client_address[0]),
+                                lambda name: claim_path(name, client_address[0]),
+                                quotas.for_client(client_address[0]), disk_space,
+                                lambda name: storage.path_for(name, client_address[0]),
+                                lambda path, size, status, started, sha256:
+                                received_catalog and received_catalog.record(
+                                    client_address[0], path, size, status, started,
+                                    sha256=sha256))
             return
             
         try:
-            name_length = int(name_length_data.decode('ascii'))
+            name_length = protocol.decode_name_length(name_length_data)
             print_with_timestamp("Filename length: %d bytes" % name_length)
-        except (ValueError, UnicodeDecodeError) as e:
+        except (ValueError, UnicodeDecodeError, protocol.ProtocolError) as e:
             print_with_timestamp("Error decoding filename length: %s" % str(e))
             return
             
@@ -220,60 +479,136 @@ def handle_client(client_socket, client_address, received_dir):
             print_with_timestamp("Error decoding file size: %s" % str(e))
             return
             
-        # Prepare file path
-        filepath = os.path.join(received_dir, filename)
-        if os.path.exists(filepath):
-            base, ext = os.path.splitext(filename)
-            i = 1
-            while os.path.exists(os.path.join(received_dir, "%s_%d%s" % (base, i, ext))):
-                i += 1
-            filepath = os.path.join(received_dir, "%s_%d%s" % (base, i, ext))
-            print_with_timestamp("File already exists - saving as %s" % os.path.basename(filepath))
-        
-        # Receive file data
-        received = 0
-        start_time = time.time()
-        
-        with open(filepath, 'wb') as f:
-            while received < file_size:
-                # Calculate remaining bytes
-                remaining = file_size - received
-                # Read chunk (or remaining bytes if smaller)
-                chunk = client_socket.recv(min(CHUNK_SIZE, remaining))
-                if not chunk:
-                    print_with_timestamp("Connection lost during transfer - got %d/%d bytes" % 
-                                       (received, file_size))
-                    break
-                
-                # Write chunk and update progress
-                f.write(chunk)
-                received += len(chunk)
-                
-                # Show progress occasionally
-                if received % (CHUNK_SIZE * 10) == 0 or received == file_size:
-                    percent = int(received * 100 / file_size)
-                    elapsed = time.time() - start_time
-                    speed = received / (elapsed if elapsed > 0 else 1)
-                    print_with_timestamp("Progress: %d%% (%d/%d bytes) - %.1f KB/s" % 
-                                       (percent, received, file_size, speed/1024))
-        
-        # Check if transfer was complete
-        if received == file_size:
-            elapsed = time.time() - start_time
-            speed = file_size / (elapsed if elapsed > 0 else 1)
-            print_with_timestamp("File received successfully: %s (%.1f KB/s)" % 
-                               (os.path.basename(filepath), speed/1024))
+        if forwarder:
+            status, received = relay_file(client_socket, forwarder, filename, file_size,
+                                          client_address[0])
         else:
-            print_with_timestamp("Incomplete file received: %s (%d of %d bytes)" % 
-                               (os.path.basename(filepath), received, file_size))
+            status, received = receive_file(client_socket, received_dir, filename, file_size,
+                                            client_address[0])
+        if status != protocol.OK:
+            # A clean close is the legacy sender's ack; a file that wasn't
+            # kept (or passed on) must look like a failed send
+            protocol.abort(client_socket)
                 
     except Exception as e:
         print_with_timestamp("Error handling client: %s" % str(e))
+        protocol.abort(client_socket)  # Whatever it was sending didn't arrive
     finally:
+        if forwarder:
+            forwarder.close()
         client_socket.close()
+        quotas.disconnect(client_address[0])
+
+def claim_path(filename, client_ip=None):
+    """Path to save filename under, following RECEIVE_LAYOUT and ON_NAME_COLLISION"""
+    filepath = storage.claim(filename, client_ip)
+    if os.path.basename(filepath) != filename:
+        print_with_timestamp("File already exists - saving as %s" % os.path.basename(filepath))
+    return filepath
+
+def receive_file(client_socket, received_dir, filename, file_size, client_ip=None):
+    """Receive one file body into received_dir; returns (status, bytes written)"""
+    if protocol.safe_filename(filename) is None:
+        print_with_timestamp("Rejected file with unsafe name: %r" % filename)
+        protocol.drain(client_socket, file_size, CHUNK_SIZE)
+        return protocol.REJECTED, 0
+    
+    # Refuse oversize or over-quota files before anything touches the disk
+    refusal = quotas.admit(client_ip, file_size)
+    if refusal:
+        print_with_timestamp("Refused %s: %s" % (filename, refusal))
+        return protocol.QUOTA, 0
+    
+    # ... or that won't fit on disk, waiting a little for other transfers first
+    reservation = disk_space.reserve(file_size) if disk_space else None
+    if disk_space and reservation is None:
+        print_with_timestamp("Refused %s: not enough disk space (%s)" % (filename, disk_space.describe()))
+        quotas.finish(client_ip, file_size, 0)
+        return protocol.NO_SPACE, 0
+    
+    # Receive file data
+    start_time = time.time()
+    flow = bandwidth.open_flow(client_ip)
+    status, received = protocol.INCOMPLETE, 0
+    sha256 = hashlib.sha256()
+    try:
+        # Inside the try, so a name the disk won't take still frees the reservation
+        filepath = claim_path(filename, client_ip)
+        status, received = fastio.receive_file(client_socket, filepath, file_size, flow,
+                                               CHUNK_SIZE, progress=progress_printer(file_size),
+                                               reservation=reservation, digest=sha256)
+    finally:
+        flow.close()
+        if reservation:
+            reservation.release()
+        quotas.finish(client_ip, file_size, received if status != protocol.DISK_FULL else 0)
+    if received_catalog:
+        received_catalog.record(client_ip, filepath, received, status, start_time,
+                                sha256=sha256.hexdigest())
+    
+    # Check if transfer was complete
+    if status == protocol.OK:
+        elapsed = time.time() - start_time
+        speed = file_size / (elapsed if elapsed > 0 else 1)
+        print_with_timestamp("File received successfully: %s (%.1f KB/s)" % 
+                           (os.path.basename(filepath), speed/1024))
+    elif status == protocol.DISK_FULL:
+        print_with_timestamp("Disk full - discarded %s (%d of %d bytes)" % 
+                           (os.path.basename(filepath), received, file_size))
+        os.remove(filepath)
+    else:
+        print_with_timestamp("Connection lost during transfer - got %d/%d bytes" % 
+                           (received, file_size))
+        print_with_timestamp("Incomplete file received: %s (%d of %d bytes)" % 
+                           (os.path.basename(filepath), received, file_size))
+    return status, received
+
+def relay_file(client_socket, forwarder, filename, file_size, client_ip=None):
+    """Pass one file on to RELAY_TO while it arrives; returns (status, bytes received)"""
+    if protocol.safe_filename(filename) is None:
+        print_with_timestamp("Rejected file with unsafe name: %r" % filename)
+        protocol.drain(client_socket, file_size, CHUNK_SIZE)
+        return protocol.REJECTED, 0
+    
+    refusal = quotas.admit(client_ip, file_size)
+    if refusal:
+        print_with_timestamp("Refused %s: %s" % (filename, refusal))
+        return protocol.QUOTA, 0
+    
+    print_with_timestamp("Relaying %s (%d bytes) to %s" % (filename, file_size, RELAY_TO))
+    start_time = time.time()
+    flow = bandwidth.open_flow(client_ip)
+    status, received = protocol.INCOMPLETE, 0
+    try:
+        status, received = forwarder.forward(client_socket, filename, file_size, flow)
+    finally:
+        flow.close()
+        quotas.finish(client_ip, file_size, received)
+    
+    if status == protocol.OK:
+        elapsed = time.time() - start_time
+        speed = file_size / (elapsed if elapsed > 0 else 1)
+        print_with_timestamp("Relayed %s (%.1f KB/s)" % (filename, speed/1024))
+    else:
+        print_with_timestamp("Relaying %s failed: %s (%d of %d bytes received)" %
+                             (filename, status, received, file_size))
+    return status, received
+
+def enforce_retention():
+    """Delete received files past KEEP_RECEIVED_DAYS / MAX_RECEIVED_GB, once an hour"""
+    while True:
+        try:
+            count = received_catalog.prune(KEEP_RECEIVED_DAYS * 86400,
+                                           int(MAX_RECEIVED_GB * 1024 ** 3))
+            if count:
+                print_with_timestamp("Retention: deleted %d old received files" % count)
+        except Exception as e:
+            print_with_timestamp("Retention error: %s" % str(e))
+        time.sleep(catalog.RETENTION_INTERVAL)
 
 def receive_files(listen_ip=None, port=PORT):
     """Start server to receive files"""
+    global disk_space, received_catalog, storage, relaying, publisher
     try:
         # Create received directory if needed
         base_dir = os.path.dirname(os.path.abspath(__file__))
@@ -288,7 +623,8 @@ def receive_files(listen_ip=None, port=PORT):
         # Bind to address
         ip = listen_ip or ''  # Empty string means listen on all interfaces
         server.bind((ip, port))
-        server.listen(5)
+        tuning.tune_listener(server)
+        server.listen(socket.SOMAXCONN if SINGLE_THREADED_RECEIVER else 5)
         server.settimeout(1)  # Allow keyboard interrupt to work
         
         print("\n" + "="*50)
@@ -296,13 +632,58 @@ def receive_files(listen_ip=None, port=PORT):
         print("="*50)
         print("\nListening for incoming files on %s:%d" % (ip or '*', port))
         print("Received files will be saved to: %s" % received_dir)
+        disk_space = diskspace.DiskSpace(received_dir)
+        print("Disk: %s" % disk_space.describe())
+        received_catalog = catalog.Catalog(os.path.join(base_dir, catalog.CATALOG_FILE))
+        storage = layout.Layout(received_dir, RECEIVE_LAYOUT, ON_NAME_COLLISION)
+        if RELAY_TO:
+            next_host, next_port = protocol.parse_destinations(RELAY_TO)[0]
+            relaying = relay.Relay(next_host, next_port, RELAY_SPILL, log=print_with_timestamp)
+            print("Relaying received files to %s:%d instead of saving them" % (next_host, next_port))
+        if PUBLISH_FOLDER:
+            publisher = pull.Publisher(PUBLISH_FOLDER, print_with_timestamp)
+            print("Publishing %s for clients to pull" % os.path.abspath(PUBLISH_FOLDER))
+        if KEEP_RECEIVED_DAYS or MAX_RECEIVED_GB:
+            retention = threading.Thread(target=enforce_retention)
+            retention.daemon = True
+            retention.start()
+        if CATALOG_HTTP_PORT:
+            catalog.serve_http(received_catalog, CATALOG_HTTP_PORT)
+            print("Catalog queries: http://127.0.0.1:%d/files" % CATALOG_HTTP_PORT)
+        try:
+            print("TLS certificate fingerprint: %s" % secure.fingerprint())
+        except secure.TLSError as e:
+            print("TLS unavailable: %s" % str(e))
         print("Press Ctrl+C to stop\n")
         
+        if SINGLE_THREADED_RECEIVER and not relaying:
+            def hand_off(client, addr, first):
+                handler = threading.Thread(target=handle_client,
+                                           args=(client, addr, received_dir, first))
+                handler.daemon = True
+                handler.start()
+            
+            receiver = multiplex.Receiver(
+                server, claim_path, print_with_timestamp, quotas, disk_space,
+                lambda client, path, size, status, started, sha256: received_catalog.record(
+                    client, path, size, status, started, sha256=sha256),
+                bandwidth, hand_off)
+            print_with_timestamp("Serving all senders from one thread")
+            try:
+                receiver.serve()
+            except KeyboardInterrupt:
+                print_with_timestamp("Server stopping... (%s)" % receiver.describe())
+            return
+        
         # Accept connections until interrupted
         while True:
             try:
                 # Accept connection with timeout
                 client, addr = server.accept()
+                if not quotas.connect(addr[0]):
+                    print_with_timestamp("Refused connection from %s - too many open connections" % addr[0])
+                    protocol.abort(client)
+                    continue
                 
                 # Handle client in a separate thread
                 handler = threading.Thread(target=handle_client, 
@@ -329,6 +710,51 @@ def receive_files(listen_ip=None, port=PORT):
             pass
         print_with_timestamp("Server stopped")
 
+def sync_loop(folder, server_ip, port=PORT, delete=False):
+    """Keep a folder tree mirrored on the receiver until interrupted"""
+    print("\n" + "="*50)
+    print("FOLDER SYNC")
+    print("="*50)
+    print("\nMirroring %s to %s:%d every %d seconds" % (folder, server_ip, port, tree_sync.SYNC_INTERVAL))
+    print("Press Ctrl+C to stop\n")
+    
+    while True:
+        try:
+            sent, failed, deleted = tree_sync.sync_tree(folder, server_ip, port, delete,
+                                                        log=print_with_timestamp,
+                                                        limiter=bandwidth)
+            if sent or failed or deleted:
+                print_with_timestamp("Sync done: %d sent, %d failed, %d deleted" %
+                                     (sent, len(failed), deleted))
+        except KeyboardInterrupt:
+            print_with_timestamp("Stopping folder sync")
+            break
+        except Exception as e:
+            print_with_timestamp("Sync error: %s" % str(e))
+        
+        try:
+            time.sleep(tree_sync.SYNC_INTERVAL)
+        except KeyboardInterrupt:
+            print_with_timestamp("Stopping folder sync")
+            break
+
+def pull_loop(host, port=PORT):
+    """Fetch the files a host publishes into received/ as they appear, until interrupted"""
+    received_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "received")
+    print("\n" + "="*50)
+    print("PULL FILES")
+    print("="*50)
+    print("\nFetching files published by %s:%d into %s" % (host, port, received_dir))
+    print("Press Ctrl+C to stop\n")
+    
+    puller = pull.Puller(host, port, received_dir, print_with_timestamp, bandwidth)
+    try:
+        puller.watch()
+    except pull.PullUnsupported as e:
+        print_with_timestamp(str(e))
+    except KeyboardInterrupt:
+        print_with_timestamp("Stopping pulling")
+
 # Python 2 compatible input function that always returns a string
 def get_input(prompt):
     """Get user input as string, compatible with both Python 2 and 3"""
@@ -343,14 +769,22 @@ if __name__ == "__main__":
         # Clear screen for better readability
         os.system('cls' if os.name == 'nt' else 'clear')
         
+        cipher, host_ciphers = secure.parse_ciphers(TLS_CIPHERS)
+        secure.configure(os.path.dirname(os.path.abspath(__file__)), USE_TLS, REQUIRE_TLS,
+                         cipher, host_ciphers)
+        auth.configure(AUTH_KEY)
+        tuning.configure(os.path.dirname(os.path.abspath(__file__)), ADAPTIVE_TUNING)
+        
         print("\n" + "="*50)
         print("SIMPLE FILE TRANSFER TOOL")
         print("="*50)
         print("\nWhat would you like to do?")
         print("1. Send files")
         print("2. Receive files")
+        print("3. Sync a folder tree")
+        print("4. Pull files from a host")
         
-        choice = get_input("\nEnter your choice (1 or 2): ").strip()
+        choice = get_input("\nEnter your choice (1, 2, 3 or 4): ").strip()
         
         if choice == "1":
             # Sending files
@@ -359,12 +793,24 @@ if __name__ == "__main__":
                 server_ip = sys.argv[1]
             else:
                 # Use the safe input function
-                print("\nEnter the IP address of the receiver computer:")
+                print("\nEnter the IP address of the receiver computer")
+                print("(separate several addresses with commas to send to all of them):")
                 server_ip = get_input("IP Address: ").strip()
             
+            # Several receivers separated by commas means replicate mode
+            destinations = None
+            if server_ip and "," in server_ip:
+                try:
+                    destinations = protocol.parse_destinations(server_ip, PORT)
+                except ValueError as e:
+                    print("Error: %s" % str(e))
+                    server_ip = ""
+
             # Parse IP and port if provided in format IP:PORT
             port = PORT  # Default port
-            if server_ip and ":" in server_ip:
+            if destinations:
+                server_ip, port = destinations[0]
+            elif server_ip and ":" in server_ip:
                 try:
                     parts = server_ip.split(":")
                     ip_part = parts[0]
@@ -379,7 +825,7 @@ if __name__ == "__main__":
             
             # Start the file watcher if we have an IP
             if server_ip:
-                watch_folder(server_ip, port)
+                watch_folder(server_ip, port, destinations)
             else:
                 print("Error: IP address is required")
                 
@@ -410,6 +856,29 @@ if __name__ == "__main__":
             # Start the receiver
             receive_files(listen_ip, port)
             
+        elif choice == "3":
+            # Mirror a folder tree, sending only new or changed files
+            print("\nEnter the folder to sync:")
+            folder = get_input("Folder: ").strip()
+            print("\nEnter the IP address of the receiver computer (IP or IP:PORT):")
+            targets = protocol.parse_destinations(get_input("IP Address: ").strip(), PORT)
+            delete = get_input("\nDelete files on the receiver that were removed here? (y/n): ").strip().lower() == 'y'
+            
+            if folder and targets:
+                sync_loop(folder, targets[0][0], targets[0][1], delete)
+            else:
+                print("Error: folder and IP address are required")
+            
+        elif choice == "4":
+            # Fetch what a host publishes instead of waiting to be sent it
+            print("\nEnter the IP address of the host (IP or IP:PORT):")
+            hosts = protocol.parse_destinations(get_input("IP Address: ").strip(), PORT)
+            
+            if hosts:
+                pull_loop(hosts[0][0], hosts[0][1])
+            else:
+                print("Error: IP address is required")
+            
         else:
             print("Invalid choice.")
             
@@ -0,0 +1,264 @@
+"""Sending data whose length isn't known up front, e.g. from a pipe.
+
+The usual header carries the file size before the body, so sending the
+output of a program meant writing it to a file first and waiting for the
+folder watcher.  A stream instead goes out in chunks as it is produced:
+
+    client -> host   STREAM_MAGIC, name length, name
+    host -> client   STREAM_MAGIC
+    client -> host   chunks: an 8 digit length and that many bytes, as
+                     many as needed, then a zero length
+    host -> client   one 32 byte acknowledgement (see protocol.encode_ack)
+
+The host writes each chunk as it arrives, so memory use doesn't depend
+on the size of the stream, and only gives the file its name once the
+final chunk is in.  Quotas and disk space are reserved as the stream
+grows; if either runs out the host acknowledges early with the refusal
+and the sender, which looks for an early answer between chunks, stops.
+Receivers that don't know about streams hang up on the magic.
+
+Command line, reading standard input:
+
+    some_report_generator | python stream.py 192.168.1.5 report.pdf
+
+Must stay Python 2.7 compatible.
+"""
+import errno
+import hashlib
+import os
+import select
+import socket
+import sys
+import time
+import uuid
+
+import auth
+import diskspace
+import fileutil
+import protocol
+import secure
+import throttle
+
+STREAM_MAGIC = b'FTSTRM01'
+CHUNK_LENGTH_SIZE = 8
+END_OF_STREAM = b'0' * CHUNK_LENGTH_SIZE
+CHUNK_SIZE = 65536
+MAX_CHUNK = 1024 * 1024              # Hosts refuse longer chunks
+RESERVE_STEP = 16 * 1024 * 1024      # Disk space is reserved this much at a time
+PARTIAL_SUFFIX = '.ftstream_part'
+
+
+class StreamUnsupported(Exception):
+    """The receiver doesn't understand streams"""
+
+
+def send_stream(host, port, source, filename, flow=None, progress=None,
+                timeout=protocol.CONNECT_TIMEOUT):
+    """Send everything read from the file object source as filename.
+
+    Returns (status, bytes sent).  Raises StreamUnsupported for receivers
+    that only take files of known size.
+    """
+    flow = flow or throttle.NULL_FLOW
+    read = getattr(source, 'read1', source.read)  # Don't wait for a full chunk from a pipe
+    sock = protocol.connect(host, port, timeout)
+    sent = 0
+    try:
+        sock.sendall(STREAM_MAGIC + protocol.encode_name(filename))
+        try:
+            reply = protocol.recv_exact(sock, len(STREAM_MAGIC))
+        except (protocol.ProtocolError, socket.error):
+            raise StreamUnsupported("%s:%d doesn't take streams" % (host, port))
+        if reply != STREAM_MAGIC:
+            raise protocol.ProtocolError("Unexpected stream reply: %r" % reply)
+        block = flow.chunk_size(CHUNK_SIZE)
+        try:
+            while True:
+                if _answered(sock):
+                    break  # Refused part way; the acknowledgement says why
+                data = read(block)
+                if not data:
+                    sock.sendall(END_OF_STREAM)
+                    break
+                sock.sendall(("%08d" % len(data)).encode('ascii') + data)
+                sent += len(data)
+                flow.throttle(len(data))
+                if progress:
+                    progress(sent)
+        except socket.error:
+            pass  # The host may have refused and hung up; its answer is still readable
+        status = protocol.decode_ack(protocol.recv_exact(sock, protocol.ACK_SIZE))[1]
+        return status, sent
+    finally:
+        sock.close()
+
+
+def _answered(sock):
+    """Whether the host has already said something"""
+    if secure.is_tls(sock) and sock.pending():
+        return True
+    return bool(select.select([sock], [], [], 0)[0])
+
+
+def serve_stream(sock, received_dir, log=None, flow_factory=None, choose_target=None,
+                 quota=None, space=None, locate=None, record=None):
+    """Host side of a stream; called after STREAM_MAGIC has been read.
+
+    The stream is written next to locate(name), by default
+    received_dir/<name>, and moved to choose_target(name) (by default the
+    same place) once complete.  quota is an optional quota.ClientQuota
+    and space an optional diskspace.DiskSpace, both drawn on as the
+    stream grows.  record(path, size, status, started, sha256) is called
+    for a stream that was received.  Returns (name, target path, status).
+    """
+    log = log or (lambda message: None)
+    name_length = protocol.decode_name_length(
+        protocol.recv_exact(sock, protocol.NAME_LENGTH_SIZE))
+    name = protocol.recv_exact(sock, name_length).decode('utf-8')
+    sock.sendall(STREAM_MAGIC)
+
+    refused = refusal = None
+    reservation = None
+    if protocol.safe_filename(name) is None:
+        refused, refusal = protocol.REJECTED, "unsafe name"
+    else:
+        refusal = quota.admit(0) if quota else None
+        if refusal:
+            refused = protocol.QUOTA
+        elif space:
+            reservation = space.reserve(RESERVE_STEP)
+            if reservation is None:
+                refused, refusal = protocol.NO_SPACE, "no room (%s)" % space.describe()
+    if refused:
+        log("Refused stream %r: %s" % (name, refusal))
+        _refuse(sock, refused, 0)
+        return name, None, refused
+
+    path = locate(name) if locate else os.path.join(received_dir, name)
+    partial = "%s.%s%s" % (path, uuid.uuid4().hex[:8], PARTIAL_SUFFIX)
+    flow = flow_factory() if flow_factory else throttle.NULL_FLOW
+    buf = bytearray(flow.chunk_size(CHUNK_SIZE))
+    view = memoryview(buf)
+    sha256 = hashlib.sha256()
+    started = time.time()
+    received = admitted = 0
+    status = protocol.INCOMPLETE
+    out = open(partial, 'wb')
+    if reservation:
+        reservation.flush = lambda: diskspace.flush_to_disk(out)
+    try:
+        while True:
+            length = int(protocol.recv_exact(sock, CHUNK_LENGTH_SIZE).decode('ascii'))
+            if length == 0:
+                status = protocol.OK
+                break
+            if length > MAX_CHUNK:
+                raise protocol.ProtocolError("Stream chunk of %d bytes is too long" % length)
+            refusal = quota.extend(admitted, length) if quota else None
+            if refusal:
+                status = protocol.QUOTA
+                break
+            admitted += length
+            while reservation and reservation.size < received + length:
+                if not reservation.grow(RESERVE_STEP):
+                    status, refusal = protocol.NO_SPACE, "no room (%s)" % space.describe()
+                    break
+            if status == protocol.NO_SPACE:
+                break
+            remaining = length
+            while remaining:
+                n = sock.recv_into(view, min(len(buf), remaining))
+                if not n:
+                    raise protocol.ProtocolError("Stream ended inside a chunk")
+                try:
+                    out.write(view[:n])
+                except (IOError, OSError) as e:
+                    if e.errno != errno.ENOSPC:
+                        raise
+                    status, refusal = protocol.DISK_FULL, "disk full"
+                    break
+                sha256.update(view[:n])
+                remaining -= n
+                received += n
+                if reservation:
+                    reservation.wrote(n)
+                flow.throttle(n)
+            if status == protocol.DISK_FULL:
+                break
+    except Exception:
+        log("Stream %s broke off after %d bytes" % (name, received))
+        raise
+    finally:
+        try:
+            out.close()
+        except (IOError, OSError):
+            pass  # Nothing more could be written anyway
+        flow.close()
+        if reservation:
+            reservation.release()
+        if quota:
+            quota.finish(admitted, received if status == protocol.OK else 0)
+        if status != protocol.OK and os.path.exists(partial):
+            os.remove(partial)
+
+    target = None
+    if status == protocol.OK:
+        target = choose_target(name) if choose_target else path
+        fileutil.replace_file(partial, target)
+        log("Received stream %s (%d bytes)" % (os.path.basename(target), received))
+        sock.sendall(protocol.encode_ack(1, status, received))
+        if record:
+            record(target, received, status, started, sha256.hexdigest())
+    else:
+        log("Refused stream %s after %d bytes: %s" % (name, received, refusal))
+        _refuse(sock, status, received)
+    return name, target, status
+
+
+def _refuse(sock, status, received):
+    """Answer now, then read and drop whatever the sender had already sent"""
+    sock.sendall(protocol.encode_ack(1, status, received))
+    try:
+        protocol.drain(sock, sys.maxsize)
+    except socket.error:
+        pass
+
+
+def main(argv=None):
+    import argparse
+    parser = argparse.ArgumentParser(
+        description="Send standard input (or a pipe) to a receiver without a temporary file")
+    parser.add_argument('destination', help="ip[:port] of the receiver")
+    parser.add_argument('name', help="Name to save it under")
+    parser.add_argument('--input', help="Read from this file or named pipe instead of stdin")
+    parser.add_argument('--tls', action='store_true', help="Encrypt the transfer")
+    parser.add_argument('--key', default=os.environ.get('FT_AUTH_KEY', ''),
+                        help="Pre-shared key (default: $FT_AUTH_KEY)")
+    parser.add_argument('--limit', type=float, default=0, help="Bandwidth limit in KB/s")
+    args = parser.parse_args(argv)
+
+    host, port = protocol.parse_destinations(args.destination)[0]
+    secure.configure(os.path.dirname(os.path.abspath(__file__)), enabled=args.tls)
+    auth.configure(args.key)
+    flow = throttle.BandwidthManager(int(args.limit * 1024)).open_flow(host)
+    if args.input:
+        source = open(args.input, 'rb')
+    else:
+        source = getattr(sys.stdin, 'buffer', sys.stdin)
+        if os.name == 'nt' and source is sys.stdin:
+            import msvcrt  # Python 2 opens stdin in text mode on Windows
+            msvcrt.setmode(sys.stdin.fileno(), os.O_BINARY)
+    try:
+        status, sent = send_stream(host, port, source, args.name, flow)
+    except StreamUnsupported as e:
+        sys.stderr.write("%s\n" % str(e))
+        return 2
+    finally:
+        flow.close()
+        source.close()
+    sys.stderr.write("Sent %d bytes to %s:%d as %s: %s\n" % (sent, host, port, args.name, status))
+    return 0 if status == protocol.OK else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
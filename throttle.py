@@ -0,0 +1,255 @@
+"""Token-bucket bandwidth shaping with fair sharing between transfers.
+
+A BandwidthManager enforces three optional limits, all in bytes per
+second (0 means unlimited):
+
+- a total limit shared by every transfer,
+- a per-client limit (with optional per-IP overrides),
+- a per-transfer cap.
+
+Every transfer opens a Flow and calls flow.throttle(n) after moving n
+bytes.  Capacity is split max-min fairly: first between clients, then
+between each client's transfers.  Transfers that can't use their share,
+because they are capped or simply slow, get only what they use, and the
+rest goes to the others.  Allocations are recomputed a few times a
+second from measured rates.  Per chunk this costs one lock and some
+arithmetic.
+"""
+import threading
+import time
+
+REBALANCE_INTERVAL = 0.25  # Seconds between fair-share recalculations
+BURST_SECONDS = 0.05       # Bucket depth, as a fraction of a second of traffic
+MIN_BURST = 4096
+UNDERUSE_RATIO = 0.9       # A flow using less than this of its share is "idle"
+HEADROOM = 1.25            # Let idle flows grow back by this factor each round
+
+INFINITY = float('inf')
+
+
+class TokenBucket(object):
+    """Classic token bucket that lets the balance go negative.
+
+    consume() takes the tokens immediately and sleeps off any debt, so a
+    chunk costs one call however large it is.  Refill is based on the
+    real clock, so coarse sleep granularity doesn't hurt long-run
+    accuracy at high rates.
+    """
+
+    def __init__(self, rate):
+        self.lock = threading.Lock()
+        self.rate = 0.0
+        self.burst = MIN_BURST
+        self.tokens = 0.0
+        self.stamp = time.time()
+        self.set_rate(rate)
+
+    def set_rate(self, rate):
+        with self.lock:
+            self._refill(time.time())
+            self.rate = float(rate or 0)
+            self.burst = max(self.rate * BURST_SECONDS, MIN_BURST)
+            self.tokens = min(self.tokens, self.burst)
+
+    def _refill(self, now):
+        if self.rate > 0:
+            self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+    def consume(self, nbytes):
+        """Take nbytes worth of tokens, sleeping if we have overdrawn"""
+        delay = self.charge(nbytes)
+        if delay > 0:
+            time.sleep(delay)
+
+    def charge(self, nbytes):
+        """Take nbytes worth of tokens; returns how long to wait before the next chunk"""
+        with self.lock:
+            if self.rate <= 0:
+                return 0
+            self._refill(time.time())
+            self.tokens -= nbytes
+            return max(0.0, -self.tokens / self.rate)
+
+
+def water_fill(capacity, demands):
+    """Max-min fair split of capacity between {key: demand} entries"""
+    allocation = {}
+    if not demands:
+        return allocation
+    if capacity == INFINITY:
+        return dict(demands)
+    remaining = capacity
+    ordered = sorted(demands.items(), key=lambda item: item[1])
+    for i, (key, demand) in enumerate(ordered):
+        share = remaining / (len(ordered) - i)
+        allocation[key] = min(demand, share)
+        remaining -= allocation[key]
+    return allocation
+
+
+def parse_rate(text):
+    """Parse a KB/s value typed by the user into bytes per second"""
+    text = (text or '').strip()
+    if not text:
+        return 0
+    value = float(text)
+    if value < 0:
+        raise ValueError("Rate limits can't be negative")
+    return int(value * 1024)
+
+
+def parse_client_rates(text):
+    """Parse "200, 10.0.0.5=1000" into (default bytes/s, {ip: bytes/s})"""
+    default = 0
+    overrides = {}
+    for item in (text or '').split(','):
+        item = item.strip()
+        if not item:
+            continue
+        if '=' in item:
+            ip, rate = item.split('=', 1)
+            overrides[ip.strip()] = parse_rate(rate)
+        else:
+            default = parse_rate(item)
+    return default, overrides
+
+
+class Flow(object):
+    """One rate-limited transfer"""
+
+    def __init__(self, manager, client):
+        self.manager = manager
+        self.client = client
+        self.bucket = TokenBucket(0)
+        self.allocated = INFINITY
+        self.moved = 0  # Bytes since the last rebalance
+        self.closed = False
+
+    def throttle(self, nbytes):
+        """Account for nbytes just sent or received, sleeping to stay under the limit"""
+        self.moved += nbytes
+        manager = self.manager
+        if time.time() - manager.last_rebalance >= REBALANCE_INTERVAL:
+            manager.rebalance()
+        self.bucket.consume(nbytes)
+
+    def charge(self, nbytes):
+        """Like throttle(), but returns the seconds to pause instead of sleeping them"""
+        self.moved += nbytes
+        manager = self.manager
+        if time.time() - manager.last_rebalance >= REBALANCE_INTERVAL:
+            manager.rebalance()
+        return self.bucket.charge(nbytes)
+
+    def chunk_size(self, default):
+        """Smaller chunks at low rates keep the output smooth instead of bursty"""
+        rate = self.bucket.rate
+        if rate <= 0:
+            return default
+        return int(max(1024, min(default, rate * BURST_SECONDS * 4)))
+
+    def close(self):
+        self.manager.close_flow(self)
+
+
+class _NullFlow(object):
+    """Stand-in used when no limits are configured"""
+    client = None
+
+    def throttle(self, nbytes):
+        pass
+
+    def charge(self, nbytes):
+        return 0
+
+    def chunk_size(self, default):
+        return default
+
+    def close(self):
+        pass
+
+
+NULL_FLOW = _NullFlow()
+
+
+class BandwidthManager(object):
+    """Shares configured bandwidth limits fairly between active flows"""
+
+    def __init__(self, total=0, per_client=0, per_transfer=0, client_rates=None):
+        self.lock = threading.Lock()
+        self.flows = set()
+        self.last_rebalance = 0.0
+        self.configure(total, per_client, per_transfer, client_rates)
+
+    def configure(self, total=0, per_client=0, per_transfer=0, client_rates=None):
+        """Change the limits (bytes per second, 0 = unlimited) on the fly"""
+        with self.lock:
+            self.total = total or 0
+            self.per_client = per_client or 0
+            self.per_transfer = per_transfer or 0
+            self.client_rates = dict(client_rates or {})
+        self.rebalance(force=True)
+
+    @property
+    def enabled(self):
+        return bool(self.total or self.per_client or self.per_transfer or
+                    any(self.client_rates.values()))
+
+    def open_flow(self, client):
+        if not self.enabled:
+            return NULL_FLOW
+        flow = Flow(self, client)
+        with self.lock:
+            self.flows.add(flow)
+        self.rebalance(force=True)
+        return flow
+
+    def close_flow(self, flow):
+        with self.lock:
+            flow.closed = True
+            self.flows.discard(flow)
+        self.rebalance(force=True)
+
+    def client_limit(self, client):
+        return self.client_rates.get(client, self.per_client) or INFINITY
+
+    def rebalance(self, force=False):
+        """Recompute every flow's share from the limits and measured use"""
+        with self.lock:
+            now = time.time()
+            elapsed = now - self.last_rebalance
+            if not force and elapsed < REBALANCE_INTERVAL:
+                return
+            self.last_rebalance = now
+
+            # What each flow could use: its cap, or a bit more than it
+            # actually managed last round if it didn't use its share
+            demands = {}
+            for flow in self.flows:
+                demand = self.per_transfer or INFINITY
+                if not force and flow.allocated != INFINITY and elapsed > 0:
+                    used = flow.moved / elapsed
+                    if used < flow.allocated * UNDERUSE_RATIO:
+                        demand = min(demand, max(used * HEADROOM, MIN_BURST))
+                flow.moved = 0
+                demands[flow] = demand
+
+            by_client = {}
+            for flow, demand in demands.items():
+                by_client.setdefault(flow.client, {})[flow] = demand
+
+            client_demands = {}
+            for client, flows in by_client.items():
+                client_demands[client] = min(self.client_limit(client), sum(flows.values()))
+            client_shares = water_fill(self.total or INFINITY, client_demands)
+
+            for client, flows in by_client.items():
+                shares = water_fill(client_shares[client], flows)
+                for flow, share in shares.items():
+                    flow.allocated = share
+
+            updates = [(flow, flow.allocated) for flow in self.flows]
+        for flow, rate in updates:
+            flow.bucket.set_rate(0 if rate == INFINITY else rate)
+
@@ -0,0 +1,289 @@
+"""Mirror a directory tree to the host, sending only new or changed files.
+
+Both sides describe their copy of the tree with a manifest of
+{relative path: (size, mtime, sha1)}.  Hashes are cached on disk in
+CACHE_NAME at the root of each tree and only recomputed for files whose
+size or mtime changed, so rescanning a large, mostly unchanged tree
+mostly costs the directory walk.
+
+Wire exchange, after the 8 byte SYNC_MAGIC:
+
+    client -> host   name length + tree name (as in a normal header)
+    host -> client   SYNC_MAGIC, 16 digit length, zlib'd JSON manifest
+    client -> host   16 digit length, JSON {"delete": [paths]}
+    host -> client   session magic, then an ordinary acknowledged
+                     session whose filenames are relative paths
+
+The host keeps each tree under received/<sender IP>/<tree name>/, so two
+clients syncing folders of the same name don't overwrite each other's
+mirrors, and writes every
+file to a temporary name first, so an interrupted sync never leaves a
+half-written file in the mirror.
+"""
+import hashlib
+import json
+import os
+import stat
+import time
+import zlib
+
+import fastio
+import fileutil
+import protocol
+import session
+
+SYNC_MAGIC = b'FTSYNC01'
+CACHE_NAME = '.ftsync_cache.json'
+PARTIAL_SUFFIX = '.ftsync_part'
+HASH_BLOCK = 1024 * 1024
+SYNC_INTERVAL = 30  # Seconds between automatic syncs
+
+
+def file_hash(path):
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        while True:
+            block = f.read(HASH_BLOCK)
+            if not block:
+                break
+            h.update(block)
+    return h.hexdigest()
+
+
+def _walk(root, rel=''):
+    """Yield (relative posix path, size, mtime) for every regular file under root"""
+    top = os.path.join(root, rel) if rel else root
+    scandir = getattr(os, 'scandir', None)
+    if scandir is not None:
+        entries = [(entry.name, entry) for entry in scandir(top)]
+    else:
+        entries = [(name, None) for name in os.listdir(top)]
+    for name, entry in entries:
+        if name == CACHE_NAME or name.endswith(PARTIAL_SUFFIX):
+            continue
+        child = rel + '/' + name if rel else name
+        try:
+            if entry is not None:
+                st = entry.stat(follow_symlinks=False)
+            else:
+                st = os.lstat(os.path.join(root, child))
+        except OSError:
+            continue  # Vanished while we were looking
+        if stat.S_ISDIR(st.st_mode):
+            for item in _walk(root, child):
+                yield item
+        elif stat.S_ISREG(st.st_mode):
+            yield child, st.st_size, st.st_mtime
+
+
+def scan(root, log=None, unreadable=None):
+    """Build the manifest for root, reusing cached hashes where possible.
+
+    A changed file that can't be read right now (locked by the program
+    editing it, say) keeps its cached entry.  If it has none it is left
+    out and its path added to unreadable, when that is a set.
+    """
+    cache_path = os.path.join(root, CACHE_NAME)
+    cache = {}
+    try:
+        with open(cache_path, 'rb') as f:
+            cache = json.loads(f.read().decode('utf-8'))
+    except (IOError, OSError, ValueError):
+        pass
+
+    manifest = {}
+    hashed = 0
+    for rel, size, mtime in _walk(root):
+        cached = cache.get(rel)
+        if cached and cached[0] == size and cached[1] == mtime:
+            manifest[rel] = cached
+            continue
+        try:
+            manifest[rel] = [size, mtime, file_hash(os.path.join(root, *rel.split('/')))]
+        except (IOError, OSError):
+            if cached:
+                manifest[rel] = cached
+            elif unreadable is not None:
+                unreadable.add(rel)
+            continue
+        hashed += 1
+
+    if hashed or len(manifest) != len(cache):
+        fileutil.atomic_write(cache_path, json.dumps(manifest).encode('utf-8'))
+    if log and hashed:
+        log("Hashed %d new or changed files under %s" % (hashed, root))
+    return manifest
+
+
+def diff(local, remote, delete=False, keep=()):
+    """Work out which paths to send and which to delete on the other side.
+
+    Paths in keep (files here that couldn't be read) are never deleted.
+    """
+    to_send = sorted(rel for rel, entry in local.items()
+                     if rel not in remote or
+                     (remote[rel][0], remote[rel][2]) != (entry[0], entry[2]))
+    to_delete = sorted(rel for rel in remote
+                       if rel not in local and rel not in keep) if delete else []
+    return to_send, to_delete
+
+
+def safe_relpath(rel):
+    """Split a relative posix path into parts, or return None if it escapes the tree"""
+    parts = rel.replace('\\', '/').split('/')
+    if not rel or any(protocol.safe_filename(part) is None for part in parts):
+        return None
+    return parts
+
+
+def tree_name(root):
+    name = os.path.basename(os.path.normpath(os.path.abspath(root)))
+    return protocol.safe_filename(name) or 'sync'
+
+
+def _send_blob(sock, data):
+    sock.sendall(str(len(data)).zfill(protocol.FILE_SIZE_SIZE).encode('ascii') + data)
+
+
+def _recv_blob(sock):
+    size = int(protocol.recv_exact(sock, protocol.FILE_SIZE_SIZE).decode('ascii'))
+    return protocol.recv_exact(sock, size)
+
+
+def sync_tree(root, host, port, delete=False, log=None, limiter=None,
+              timeout=protocol.CONNECT_TIMEOUT):
+    """Mirror root to received/<our IP>/<tree name>/ on the host.
+
+    Returns (files sent, list of paths that failed, paths deleted).
+    """
+    log = log or (lambda message: None)
+    unreadable = set()
+    local = scan(root, log, unreadable)
+    if unreadable:
+        log("Couldn't read %d files under %s; they will be tried again next time" %
+            (len(unreadable), root))
+    name = tree_name(root)
+
+    sock = protocol.connect(host, port, timeout)
+    try:
+        sock.sendall(SYNC_MAGIC + protocol.encode_name(name))
+        try:
+            reply = protocol.recv_exact(sock, len(SYNC_MAGIC))
+        except protocol.ProtocolError:
+            raise protocol.ProtocolError("%s:%d doesn't support folder sync" % (host, port))
+        if reply != SYNC_MAGIC:
+            raise protocol.ProtocolError("Unexpected sync reply: %r" % reply)
+        remote = json.loads(zlib.decompress(_recv_blob(sock)).decode('utf-8'))
+
+        to_send, to_delete = diff(local, remote, delete, unreadable)
+        log("Sync %s: %d files, %d to send, %d to delete" %
+            (name, len(local), len(to_send), len(to_delete)))
+        _send_blob(sock, json.dumps({'delete': to_delete}).encode('utf-8'))
+        if protocol.recv_exact(sock, len(session.SESSION_MAGIC)) != session.SESSION_MAGIC:
+            raise protocol.ProtocolError("Host didn't start the sync session")
+    except Exception:
+        sock.close()
+        raise
+
+    failed = []
+    sender = session.SenderSession(sock, log=log)
+    for rel in to_send:
+        path = os.path.join(root, *rel.split('/'))
+        size = local[rel][0]
+        flow = limiter.open_flow(host) if limiter else None
+
+        def body(sock, progress, path=path, size=size, flow=flow):
+            if fastio.send_body(sock, path, size, flow, progress=progress) < size:
+                raise protocol.ProtocolError("%s shrank while being sent" % path)
+
+        def on_ack(status, received, rel=rel):
+            if status != protocol.OK:
+                failed.append(rel)
+                log("Sync of %s failed: %s" % (rel, status))
+        try:
+            sender.send(rel, size, body, on_ack)
+        finally:
+            if flow:
+                flow.close()
+    sender.close()
+    return len(to_send) - len(failed), failed, len(to_delete)
+
+
+def serve_sync(sock, received_dir, sender, log=None, flow_factory=None, quota=None,
+               space=None, record=None):
+    """Host side of a sync; called after SYNC_MAGIC has been read.
+
+    sender is the client's IP address, which keeps its trees apart from
+    other clients' trees of the same name.  quota is an optional
+    quota.ClientQuota every file is checked against, and space an optional
+    diskspace.DiskSpace to reserve room in.  record(path, size, status,
+    started, sha256) is called for each file received.
+    """
+    log = log or (lambda message: None)
+    name_length = protocol.decode_name_length(
+        protocol.recv_exact(sock, protocol.NAME_LENGTH_SIZE))
+    name = protocol.recv_exact(sock, name_length).decode('utf-8')
+    if protocol.safe_filename(name) is None:
+        log("Rejected sync with unsafe tree name %r" % name)
+        return
+    folder = sender.replace(':', '_')  # IPv6 addresses aren't valid Windows names
+    root = fileutil.ensure_dir(os.path.join(received_dir, folder, name))
+
+    manifest = scan(root, log)
+    sock.sendall(SYNC_MAGIC)
+    _send_blob(sock, zlib.compress(json.dumps(manifest).encode('utf-8')))
+
+    request = json.loads(_recv_blob(sock).decode('utf-8'))
+    for rel in request.get('delete', []):
+        parts = safe_relpath(rel)
+        if parts is None:
+            continue
+        path = os.path.join(root, *parts)
+        if os.path.isfile(path):
+            os.remove(path)
+            log("Sync %s: deleted %s" % (name, rel))
+
+    def receive(rel, size):
+        parts = safe_relpath(rel)
+        if parts is None:
+            log("Sync %s: rejected unsafe path %r" % (name, rel))
+            protocol.drain(sock, size)
+            return protocol.REJECTED, 0
+        refusal = quota.admit(size) if quota else None
+        if refusal:
+            log("Sync %s: refused %s: %s" % (name, rel, refusal))
+            return protocol.QUOTA, 0
+        reservation = space.reserve(size) if space else None
+        if space and reservation is None:
+            log("Sync %s: no room for %s (%s)" % (name, rel, space.describe()))
+            if quota:
+                quota.finish(size, 0)
+            return protocol.NO_SPACE, 0
+        path = os.path.join(root, *parts)
+        fileutil.ensure_dir(os.path.dirname(path))
+        partial = path + PARTIAL_SUFFIX
+        flow = flow_factory() if flow_factory else None
+        received = 0
+        started = time.time()
+        sha256 = hashlib.sha256()
+        try:
+            status, received = fastio.receive_file(sock, partial, size, flow,
+                                                   reservation=reservation, digest=sha256)
+        finally:
+            if flow:
+                flow.close()
+            if reservation:
+                reservation.release()
+            if quota:
+                quota.finish(size, received)
+        if status == protocol.OK:
+            fileutil.replace_file(partial, path)
+        elif os.path.exists(partial):
+            os.remove(partial)
+        if record:
+            record(path, size, status, started,
+                   sha256.hexdigest() if status == protocol.OK else None)
+        return status, received
+
+    count = session.serve_session(sock, receive)
+    log("Sync %s: received %d files" % (name, count))
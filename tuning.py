@@ -0,0 +1,284 @@
+"""Socket settings that adapt to each link.
+
+Fixed chunk sizes and default socket options suit neither a gigabit LAN
+nor a slow WAN link.  Senders ask this module how to set up a connection
+to a host and tell it how fast each big transfer went:
+
+- The round trip time is taken from how long connect() took, keeping
+  the smallest seen since queues only ever add to it.
+- Each transfer of at least MEASURE_MIN bytes measures the settings it
+  used: the chunk size (how much a buffered send writes at a time),
+  SO_SNDBUF/SO_RCVBUF (0 leaves them to the OS) and TCP_NODELAY.
+- Every EXPLORE_EVERY transfers one neighbouring setting is tried for
+  TRIAL_TRANSFERS transfers: the chunk doubled or halved, the buffers
+  doubled or halved (or, while they are left to the OS, sized to twice
+  the bandwidth-delay product) or TCP_NODELAY flipped.  It replaces the
+  best settings only if it was at least IMPROVEMENT times faster.  Once
+  every neighbour has lost, exploring stops until the link's speed
+  changes a lot.
+
+What was learnt is kept per destination in CACHE_FILE next to the
+program, so the next run starts from the best settings found.
+
+Hosts can't know who will connect, so they only size the listening
+socket's receive buffer, and only on Windows before Vista, whose fixed
+8 KB default holds a WAN link to a few hundred KB/s; newer systems tune
+their own receive window.
+
+Must stay Python 2.7 compatible.
+"""
+import json
+import os
+import socket
+import sys
+import threading
+import time
+
+import fileutil
+
+CACHE_FILE = '.link_tuning.json'
+MAX_LINKS = 256                  # Destinations remembered
+MEASURE_MIN = 1024 * 1024        # Smaller transfers say more about latency than the link
+EXPLORE_EVERY = 4                # Measurements with the best settings between trials
+TRIAL_TRANSFERS = 3              # Measurements a trial gets; the median is judged
+IMPROVEMENT = 1.1                # How much faster a trial must be to win
+DRIFT = 2.0                      # Re-explore once the link is this much faster or slower
+SMOOTHING = 0.3                  # Weight of the newest measurement in a running rate
+MIN_CHUNK = 8 * 1024
+MAX_CHUNK = 1024 * 1024
+MIN_BUFFER = 64 * 1024
+MAX_BUFFER = 8 * 1024 * 1024
+LISTEN_BUFFER = 256 * 1024       # Receive buffer for hosts on old Windows
+
+OLD_WINDOWS = sys.platform == 'win32' and sys.getwindowsversion()[0] < 6
+
+
+class Link(object):
+    """What has been learnt about one destination"""
+
+    def __init__(self, chunk):
+        self.best = (chunk, 0, True)  # (chunk size, socket buffers, TCP_NODELAY)
+        self.rate = None              # Running bytes/second with the best settings
+        self.baseline = None          # ... when they became the best
+        self.rtt = None
+        self.results = {}             # Settings tried -> bytes/second they managed
+        self.trial = None
+        self.trial_rates = []
+        self.since_trial = 0
+        self.seen = time.time()
+
+    @property
+    def current(self):
+        return self.trial or self.best
+
+    def to_json(self):
+        return {'best': list(self.best), 'rate': self.rate, 'baseline': self.baseline,
+                'rtt': self.rtt, 'results': self.results, 'seen': self.seen}
+
+    @classmethod
+    def from_json(cls, data):
+        chunk, buffer, nodelay = data['best']
+        link = cls(int(chunk))
+        link.best = (int(chunk), int(buffer), bool(nodelay))
+        link.rate = data.get('rate')
+        link.baseline = data.get('baseline')
+        link.rtt = data.get('rtt')
+        link.results = dict(data.get('results') or {})
+        link.seen = data.get('seen', link.seen)
+        return link
+
+
+class _Settings(object):
+    def __init__(self):
+        self.enabled = True
+        self.path = None  # Nothing is saved until configure() gives a folder
+
+
+settings = _Settings()
+_lock = threading.Lock()
+_links = {}
+
+
+def configure(base_dir=None, enabled=None):
+    """Set where the cache lives and load it; arguments left as None keep their value"""
+    with _lock:
+        if enabled is not None:
+            settings.enabled = bool(enabled)
+        if base_dir is not None:
+            settings.path = os.path.join(base_dir, CACHE_FILE)
+            _links.clear()
+            try:
+                with open(settings.path, 'rb') as f:
+                    for host, data in json.loads(f.read().decode('utf-8')).items():
+                        _links[host] = Link.from_json(data)
+            except (IOError, OSError, ValueError, KeyError, TypeError):
+                pass  # Start from scratch
+
+
+def _key(choice):
+    return "%d/%d/%d" % (choice[0], choice[1], choice[2])
+
+
+def _current(host):
+    with _lock:
+        link = _links.get(host)
+        return link.current if link is not None and settings.enabled else None
+
+
+def connect(sock, host, port):
+    """sock.connect() with the host's socket settings, timing the handshake"""
+    choice = _current(host)
+    if choice and choice[1]:
+        # Before connecting, so the window scale offered can cover the buffer
+        for option in (socket.SO_SNDBUF, socket.SO_RCVBUF):
+            try:
+                sock.setsockopt(socket.SOL_SOCKET, option, choice[1])
+            except socket.error:
+                pass
+    started = time.time()
+    sock.connect((host, port))
+    rtt = time.time() - started
+    if settings.enabled and (choice is None or choice[2]):
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    if settings.enabled:
+        with _lock:
+            link = _links.get(host)
+            if link is None:
+                link = _links[host] = Link(None)  # chunk_size() fills in the chunk
+            if link.rtt is None or rtt < link.rtt:
+                link.rtt = rtt
+
+
+def chunk_size(host, default):
+    """How much to write at a time to host, given the caller's usual size"""
+    if not settings.enabled:
+        return default
+    with _lock:
+        link = _links.get(host)
+        if link is None:
+            link = _links[host] = Link(default)
+        elif link.best[0] is None:
+            link.best = (default,) + link.best[1:]
+        return link.current[0]
+
+
+def record(host, nbytes, seconds):
+    """Report that nbytes reached host (acknowledged) in seconds"""
+    if not settings.enabled or nbytes < MEASURE_MIN or seconds <= 0:
+        return
+    rate = nbytes / seconds
+    with _lock:
+        link = _links.get(host)
+        if link is None or link.best[0] is None:
+            return  # Sent without asking chunk_size(); nothing to judge
+        link.seen = time.time()
+        if link.trial is not None:
+            link.trial_rates.append(rate)
+            if len(link.trial_rates) >= TRIAL_TRANSFERS:
+                _judge(link)
+        else:
+            link.rate = rate if link.rate is None else (
+                (1 - SMOOTHING) * link.rate + SMOOTHING * rate)
+            link.results[_key(link.best)] = link.rate
+            if link.baseline is None:
+                link.baseline = link.rate
+            elif not 1 / DRIFT < link.rate / link.baseline < DRIFT:
+                # The link changed (another route, a busier network); what
+                # lost before might win now
+                link.results = {_key(link.best): link.rate}
+                link.baseline = link.rate
+            link.since_trial += 1
+            if link.since_trial >= EXPLORE_EVERY:
+                _explore(link)
+        links = dict((h, l.to_json()) for h, l in _links.items() if l.best[0] is not None)
+    _save(links)
+
+
+def _judge(link):
+    rate = sorted(link.trial_rates)[len(link.trial_rates) // 2]  # One lucky run doesn't win
+    link.results[_key(link.trial)] = rate
+    if link.rate is None or rate >= link.rate * IMPROVEMENT:
+        link.best, link.rate, link.baseline = link.trial, rate, rate
+        link.results[_key(link.best)] = rate
+    link.trial = None
+    link.trial_rates = []
+    link.since_trial = 0
+
+
+def _explore(link):
+    link.since_trial = 0
+    for choice in _neighbours(link):
+        if _key(choice) not in link.results:
+            link.trial = choice
+            link.trial_rates = []
+            return
+
+
+def _neighbours(link):
+    chunk, buffer, nodelay = link.best
+    choices = []
+    if chunk * 2 <= MAX_CHUNK:
+        choices.append((chunk * 2, buffer, nodelay))
+    if chunk // 2 >= MIN_CHUNK:
+        choices.append((chunk // 2, buffer, nodelay))
+    if buffer == 0:
+        choices.append((chunk, _bdp_buffer(link), nodelay))
+    else:
+        if buffer * 2 <= MAX_BUFFER:
+            choices.append((chunk, buffer * 2, nodelay))
+        choices.append((chunk, buffer // 2 if buffer // 2 >= MIN_BUFFER else 0, nodelay))
+    choices.append((chunk, buffer, not nodelay))
+    return choices
+
+
+def _bdp_buffer(link):
+    """A power of two at least twice the bandwidth-delay product"""
+    wanted = 2 * (link.rate or 0) * (link.rtt or 0)
+    size = MIN_BUFFER * 4
+    while size < wanted and size < MAX_BUFFER:
+        size *= 2
+    return size
+
+
+def _save(links):
+    if settings.path is None:
+        return
+    if len(links) > MAX_LINKS:
+        keep = sorted(links, key=lambda host: links[host]['seen'])[-MAX_LINKS:]
+        links = dict((host, links[host]) for host in keep)
+    try:
+        fileutil.atomic_write(settings.path,
+                              json.dumps(links, indent=1, sort_keys=True).encode('utf-8'))
+    except (IOError, OSError):
+        pass  # Only a cache
+
+
+def describe(host):
+    """The settings in use for host, for the logs"""
+    with _lock:
+        link = _links.get(host)
+        if link is None:
+            return "%s: not measured yet" % host
+        chunk, buffer, nodelay = link.current
+        return "%s: %s chunks of %d KB, %s buffers, Nagle %s%s%s" % (
+            host, "trying" if link.trial else "best", chunk // 1024,
+            "%d KB" % (buffer // 1024) if buffer else "OS",
+            "off" if nodelay else "on",
+            ", %.1f MB/s" % (link.rate / 1048576.0) if link.rate else "",
+            ", RTT %.1f ms" % (link.rtt * 1000) if link.rtt is not None else "")
+
+
+def link_rate(host):
+    """Bytes/second the best settings manage to host, or None if not measured"""
+    with _lock:
+        link = _links.get(host)
+        return link.rate if link is not None else None
+
+
+def tune_listener(server):
+    """Size a listening socket's receive buffer where the OS won't (call before listen)"""
+    if OLD_WINDOWS:
+        try:
+            server.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, LISTEN_BUFFER)
+        except socket.error:
+            pass